@@ -0,0 +1,134 @@
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from chat.conditional import touch_history
+from chat.history_cache import write_message
+from chat.models import ChatMessage
+from chat.tokens import message_token_counts
+
+
+class ReplyAccumulator:
+    """
+    AI回复消息收集器
+
+    以分块列表收集流式增量，避免字符串反复拼接；消息行在 message_start 时创建，
+    之后每累计 N 个增量或间隔 T 毫秒写回一次检查点，结束时一次性提交
+    """
+
+    def __init__(self, checkpoint_tokens=None, checkpoint_interval_ms=None):
+        """
+        :param checkpoint_tokens: 每累计多少个增量写一次检查点，默认取 CHAT_CHECKPOINT_TOKENS
+        :param checkpoint_interval_ms: 检查点的最大间隔（毫秒），默认取 CHAT_CHECKPOINT_INTERVAL_MS
+        """
+        self.checkpoint_tokens = (
+            checkpoint_tokens
+            if checkpoint_tokens is not None
+            else getattr(settings, "CHAT_CHECKPOINT_TOKENS", 64)
+        )
+        self.checkpoint_interval_ms = (
+            checkpoint_interval_ms
+            if checkpoint_interval_ms is not None
+            else getattr(settings, "CHAT_CHECKPOINT_INTERVAL_MS", 1000)
+        )
+        self.message = None
+        self.response_id = ""
+        self.tokens = 0
+        # 上游返回的用量，生成完成时才有
+        self.usage = None
+        # 收到的增量数，近似为已生成的token数
+        self.deltas = 0
+        self._content_parts = []
+        self._reasoning_parts = []
+        self._pending = 0
+        self._last_checkpoint = time.monotonic()
+
+    @property
+    def content(self):
+        return self._join(self._content_parts)
+
+    @property
+    def reasoning_content(self):
+        return self._join(self._reasoning_parts)
+
+    @staticmethod
+    def _join(parts):
+        # 合并后替换为单个分块，下次拼接只需处理新增部分
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    def append_content(self, delta):
+        self._content_parts.append(delta)
+        self.deltas += 1
+        self._pending += 1
+
+    def append_reasoning(self, delta):
+        self._reasoning_parts.append(delta)
+        self.deltas += 1
+        self._pending += 1
+
+    def start(self, user_message, chat_session, chat_model):
+        """
+        创建状态为 streaming 的AI回复消息行
+        """
+        self.message = ChatMessage.objects.create(
+            session=chat_session,
+            role="assistant",
+            content="",
+            reasoning_content="",
+            model=chat_model,
+            parent_message=user_message,
+            status="streaming",
+        )
+        self._last_checkpoint = time.monotonic()
+        return self.message
+
+    def should_checkpoint(self):
+        """
+        判断是否需要写检查点
+        """
+        if not self._pending:
+            return False
+        if self._pending >= self.checkpoint_tokens:
+            return True
+        elapsed_ms = (time.monotonic() - self._last_checkpoint) * 1000
+        return elapsed_ms >= self.checkpoint_interval_ms
+
+    def checkpoint(self):
+        """
+        将已收集的内容写回消息行
+        """
+        self._save(status="streaming")
+
+    def finish(self, status="complete"):
+        """
+        提交最终内容并标记消息状态
+
+        :param status: complete 或 aborted
+        :return: 保存后的消息
+        """
+        self.message.content = self.content
+        self.message.reasoning_content = self.reasoning_content
+        counts = message_token_counts(self.message, self.usage)
+        self._save(status=status, tokens=self.tokens, **counts)
+        # 检查点只写数据库，消息历史缓存在结束时更新一次
+        write_message(self.message)
+        return self.message
+
+    def _save(self, **fields):
+        fields.update(
+            content=self.content,
+            reasoning_content=self.reasoning_content,
+            message_resp_id=self.response_id or None,
+            # QuerySet.update 不会更新 auto_now 字段
+            updated_at=timezone.now(),
+        )
+        ChatMessage.objects.filter(pk=self.message.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(self.message, name, value)
+        # QuerySet.update 不发送 post_save 信号
+        touch_history(self.message.session_id)
+        self._pending = 0
+        self._last_checkpoint = time.monotonic()
@@ -0,0 +1,526 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from chat.clients import endpoint_key
+from chat.leases import lease_keeper
+from chat.stream_buffer import get_async_redis
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认的上游并发控制配置，可在 settings.CHAT_ADMISSION 中覆盖
+DEFAULT_ADMISSION = {
+    # 是否限制同时进行的上游生成
+    "ENABLED": True,
+    # 整个集群同时进行的上游生成数
+    "GLOBAL_LIMIT": 64,
+    # 每个推理接入点（或模型）同时进行的上游生成数
+    "MODEL_LIMIT": 16,
+    # 按推理接入点ID或模型ID覆盖 MODEL_LIMIT，如 {"ep-xxx": 32}
+    "MODEL_LIMITS": {},
+    # 每个用户同时进行的上游生成数
+    "USER_LIMIT": 2,
+    # 排队的请求总数上限，超过后直接返回 429
+    "QUEUE_LIMIT": 200,
+    # 每个用户排队的请求数上限，超过后直接返回 429
+    "USER_QUEUE_LIMIT": 5,
+    # 按用户ID设置的排队权重，权重越大同时排队的请求越靠前，默认为 1
+    "USER_WEIGHTS": {},
+    # 返回 429 时建议客户端重试的间隔，单位秒
+    "RETRY_AFTER": 5,
+    # 最长排队时间，单位秒，超时后以错误结束
+    "QUEUE_TIMEOUT": 60,
+    # 排队时检查名额的间隔，单位毫秒
+    "POLL_MS": 200,
+    # 超过该时间未检查名额的排队请求视为已断开，单位秒
+    "STALE_SECONDS": 10,
+    # 名额的租期，单位秒，生成期间定期续期；进程异常退出时名额在租期后释放
+    "LEASE_SECONDS": 120,
+}
+
+# 所有键带有相同的哈希标签，在 Redis Cluster 中位于同一个槽，可以在一个脚本中访问；
+# 放行时按排队成员拼出其他用户、接入点占用名额的键，同样带有该哈希标签
+ADMISSION_PREFIX = "chat:{admission}:"
+QUEUE_KEY = ADMISSION_PREFIX + "queue"
+HEARTBEAT_KEY = ADMISSION_PREFIX + "heartbeat"
+# 接入点 -> 并发名额数，入队时写入，放行时用于计算其他接入点的空闲名额
+LIMITS_KEY = ADMISSION_PREFIX + "limits"
+
+# 入队：检查排队上限，并按用户已占用和排队的请求数计算公平排队的顺序
+# 同一用户的第 n 个请求排在所有用户的第 n / 权重 轮，轮内按入队时间排序
+# KEYS: 排队队列、心跳、用户的排队队列、用户占用的名额、接入点的名额数
+ENQUEUE_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+local queued = redis.call('ZCARD', KEYS[3])
+if queued >= tonumber(ARGV[4]) then
+    return 0
+end
+local round = math.floor((queued + redis.call('ZCARD', KEYS[4])) / tonumber(ARGV[5]))
+local score = round * 1e13 + now
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('ZADD', KEYS[3], score, ARGV[1])
+redis.call('HSET', KEYS[5], ARGV[7], ARGV[6])
+return 1
+"""
+
+# 尝试放行：按排队顺序依次为排在前面的请求预留名额，前面的请求所在的接入点或用户
+# 已满时跳过它，不占用全局名额；预留之后全局、接入点、用户三个范围都还有空闲名额时
+# 占用名额。排队靠前但被其他接入点或用户的上限挡住的请求不会阻塞后面的请求
+# KEYS: 排队队列、心跳、用户的排队队列、接入点的名额数
+# ARGV: 成员、当前时间、租期、全局上限、用户上限、默认的接入点上限、键前缀
+# 返回 {1, 0} 已放行；{0, 位置} 继续排队；{-1, 0} 已不在队列中
+ADMIT_SCRIPT = """
+local member = ARGV[1]
+local now = tonumber(ARGV[2])
+local rank = redis.call('ZRANK', KEYS[1], member)
+if not rank then
+    return {-1, 0}
+end
+redis.call('ZADD', KEYS[2], now, member)
+
+local prefix = ARGV[7]
+local free = {}
+local function remaining(scope, limit)
+    if free[scope] == nil then
+        local active = prefix .. 'active:' .. scope
+        redis.call('ZREMRANGEBYSCORE', active, '-inf', now)
+        free[scope] = limit - redis.call('ZCARD', active)
+    end
+    return free[scope]
+end
+
+local function scopes(queued)
+    local user, endpoint = string.match(queued, '^[^|]*|([^|]*)|(.*)$')
+    local model_limit = tonumber(redis.call('HGET', KEYS[4], endpoint)) or tonumber(ARGV[6])
+    return {
+        {'global', tonumber(ARGV[4])},
+        {'model:' .. endpoint, model_limit},
+        {'user:' .. user, tonumber(ARGV[5])},
+    }
+end
+
+local function admissible(items)
+    for _, item in ipairs(items) do
+        if remaining(item[1], item[2]) <= 0 then
+            return false
+        end
+    end
+    return true
+end
+
+local own = scopes(member)
+-- 排在前面且与自己竞争同一接入点或用户的名额、或预留了全局名额的请求数
+local ahead = 0
+if rank > 0 then
+    for _, queued in ipairs(redis.call('ZRANGE', KEYS[1], 0, rank - 1)) do
+        if remaining('global', tonumber(ARGV[4])) <= 0 then
+            return {0, rank + 1}
+        end
+        local items = scopes(queued)
+        if admissible(items) then
+            for _, item in ipairs(items) do
+                free[item[1]] = free[item[1]] - 1
+            end
+            ahead = ahead + 1
+        elseif items[2][1] == own[2][1] or items[3][1] == own[3][1] then
+            ahead = ahead + 1
+        end
+    end
+end
+if not admissible(own) then
+    return {0, ahead + 1}
+end
+
+for i = 1, 3 do
+    redis.call('ZREM', KEYS[i], member)
+end
+local expires = now + tonumber(ARGV[3])
+for _, item in ipairs(own) do
+    redis.call('ZADD', prefix .. 'active:' .. item[1], expires, member)
+end
+return {1, 0}
+"""
+
+
+class QueueFull(Exception):
+    """
+    排队的请求已达上限
+    """
+
+
+class QueueTimeout(Exception):
+    """
+    排队超过最长排队时间
+    """
+
+
+def admission_config():
+    """
+    获取上游并发控制配置
+    """
+    return {**DEFAULT_ADMISSION, **getattr(settings, "CHAT_ADMISSION", {})}
+
+
+def active_key(scope):
+    return f"{ADMISSION_PREFIX}active:{scope}"
+
+
+def queued_key(user_id):
+    return f"{ADMISSION_PREFIX}queued:user:{user_id}"
+
+
+class AdmissionTicket:
+    """
+    一次上游生成的排队票据
+
+    名额按全局、推理接入点和用户三个范围统计，保存在 Redis 中由所有工作进程共享；
+    票据先入队（队列已满时立即拒绝），再轮询等待三个范围都有空闲名额，
+    排在前面但所在接入点或用户已满的请求不阻塞其他接入点和用户的请求；
+    放行后由续期线程续期，生成结束后释放。Redis 不可用时不限制
+    """
+
+    def __init__(self, user_id, chat_model):
+        self.config = admission_config()
+        self.user_id = str(user_id)
+        self.endpoint = endpoint_key(chat_model)
+        self.model_limit = self.config["MODEL_LIMITS"].get(
+            self.endpoint,
+            self.config["MODEL_LIMITS"].get(
+                chat_model.model_id, self.config["MODEL_LIMIT"]
+            ),
+        )
+        # 排队成员为 "票据ID|用户ID|接入点"，清理断开的请求时据此找到其所在的队列；
+        # 票据ID以纳秒时间开头，同一毫秒入队的请求（分数相同）按入队顺序排列
+        ticket_id = f"{time.time_ns():016x}{uuid.uuid4().hex[:8]}"
+        self.member = "|".join([ticket_id, self.user_id, self.endpoint])
+        self.weight = max(int(self.config["USER_WEIGHTS"].get(self.user_id, 1)), 1)
+        self.enqueued = False
+        self.admitted = False
+        self.released = False
+        # 下次清理断开的排队请求的时间
+        self.reap_at = 0
+        self._lease = None
+
+    @classmethod
+    def for_request(cls, user_id, chat_model):
+        """
+        :return: 未启用并发控制时返回 None
+        """
+        if not admission_config()["ENABLED"]:
+            return None
+        return cls(user_id, chat_model)
+
+    def _scopes(self):
+        return ["global", f"model:{self.endpoint}", f"user:{self.user_id}"]
+
+    def _queue_keys(self):
+        return [QUEUE_KEY, HEARTBEAT_KEY, queued_key(self.user_id)]
+
+    def _enqueue_args(self):
+        keys = [
+            *self._queue_keys(),
+            active_key(f"user:{self.user_id}"),
+            LIMITS_KEY,
+        ]
+        args = [
+            self.member,
+            int(time.time() * 1000),
+            self.config["QUEUE_LIMIT"],
+            self.config["USER_QUEUE_LIMIT"],
+            self.weight,
+            self.model_limit,
+            self.endpoint,
+        ]
+        return keys, args
+
+    def _admit_args(self):
+        keys = [*self._queue_keys(), LIMITS_KEY]
+        args = [
+            self.member,
+            int(time.time() * 1000),
+            self.config["LEASE_SECONDS"] * 1000,
+            self.config["GLOBAL_LIMIT"],
+            self.config["USER_LIMIT"],
+            self.config["MODEL_LIMIT"],
+            ADMISSION_PREFIX,
+        ]
+        return keys, args
+
+    def _should_reap(self):
+        """
+        每个票据每隔 STALE_SECONDS 最多清理一次断开的排队请求
+        """
+        now = time.monotonic()
+        if now < self.reap_at:
+            return False
+        self.reap_at = now + self.config["STALE_SECONDS"]
+        return True
+
+    def _stale_before(self):
+        return int(time.time() * 1000) - self.config["STALE_SECONDS"] * 1000
+
+    @staticmethod
+    def _reap_pipeline(pipe, dead):
+        for member in dead:
+            _, user_id, _ = member.decode().split("|", 2)
+            pipe.zrem(QUEUE_KEY, member)
+            pipe.zrem(HEARTBEAT_KEY, member)
+            pipe.zrem(queued_key(user_id), member)
+
+    def reap(self):
+        """
+        移出超过 STALE_SECONDS 未检查名额的排队请求（进程异常退出或客户端已断开），
+        避免其占用排队位置
+        """
+        conn = get_redis_connection("default")
+        dead = conn.zrangebyscore(
+            HEARTBEAT_KEY, "-inf", self._stale_before(), start=0, num=100
+        )
+        if dead:
+            pipe = conn.pipeline(transaction=False)
+            self._reap_pipeline(pipe, dead)
+            pipe.execute()
+
+    async def areap(self):
+        """
+        reap 的异步版本
+        """
+        conn = get_async_redis()
+        dead = await conn.zrangebyscore(
+            HEARTBEAT_KEY, "-inf", self._stale_before(), start=0, num=100
+        )
+        if dead:
+            pipe = conn.pipeline(transaction=False)
+            self._reap_pipeline(pipe, dead)
+            await pipe.execute()
+
+    def enqueue(self):
+        """
+        入队，队列已满时抛出 QueueFull
+        """
+        try:
+            if self._should_reap():
+                self.reap()
+            conn = get_redis_connection("default")
+            keys, args = self._enqueue_args()
+            accepted = conn.register_script(ENQUEUE_SCRIPT)(keys=keys, args=args)
+        except Exception:
+            logger.exception("上游并发控制入队失败，不限制本次生成")
+            self.admitted = True
+            return
+        if not accepted:
+            metrics.incr("admission.rejected")
+            metrics.incr(f"admission.rejected.{self.endpoint}")
+            raise QueueFull("当前排队的请求过多，请稍后重试")
+        self.enqueued = True
+
+    def _handle_admit(self, result, started):
+        """
+        :return: 仍在排队时返回排队位置，已放行时返回 None
+        """
+        admitted, position = result
+        if admitted == 1:
+            self.admitted = True
+            # 生成期间由续期线程定期续期名额，与是否收到上游数据无关
+            self._lease = lease_keeper.register(
+                self.renew, self.config["LEASE_SECONDS"] / 3
+            )
+            waited = time.monotonic() - started
+            metrics.incr("admission.admitted")
+            metrics.incr("admission.wait_ms", int(waited * 1000))
+            return None
+        if admitted == -1:
+            # 长时间未检查名额被视为已断开，重新入队
+            self.enqueued = False
+            return 0
+        return position
+
+    def _check_timeout(self, started):
+        if time.monotonic() - started >= self.config["QUEUE_TIMEOUT"]:
+            metrics.incr("admission.timeout")
+            raise QueueTimeout("排队超时，请稍后重试")
+
+    def wait(self, cancel_token=None):
+        """
+        等待名额，排队期间每次排队位置变化时产生新的位置；
+        收到停止请求时退出队列并结束
+        """
+        started = time.monotonic()
+        last_position = None
+        try:
+            while not self.admitted:
+                if cancel_token is not None and cancel_token.cancelled:
+                    self.release()
+                    return
+                if not self.enqueued:
+                    self.enqueue()
+                    continue
+                try:
+                    if self._should_reap():
+                        self.reap()
+                    keys, args = self._admit_args()
+                    result = get_redis_connection("default").register_script(
+                        ADMIT_SCRIPT
+                    )(keys=keys, args=args)
+                except Exception:
+                    logger.exception("上游并发控制检查名额失败，不限制本次生成")
+                    self.admitted = True
+                    return
+                position = self._handle_admit(result, started)
+                if position is None:
+                    return
+                if position and position != last_position:
+                    if last_position is None:
+                        metrics.incr("admission.queued")
+                    last_position = position
+                    yield position
+                self._check_timeout(started)
+                time.sleep(self.config["POLL_MS"] / 1000)
+        except BaseException:
+            # 排队超时或客户端断开时退出队列
+            self.release()
+            raise
+
+    async def await_admission(self, cancel_token=None):
+        """
+        wait 的异步版本，排队期间不占用工作线程
+        """
+        started = time.monotonic()
+        last_position = None
+        try:
+            while not self.admitted:
+                if cancel_token is not None and cancel_token.cancelled:
+                    await self.arelease()
+                    return
+                if not self.enqueued:
+                    await self.aenqueue()
+                    continue
+                try:
+                    if self._should_reap():
+                        await self.areap()
+                    keys, args = self._admit_args()
+                    result = await get_async_redis().register_script(ADMIT_SCRIPT)(
+                        keys=keys, args=args
+                    )
+                except Exception:
+                    logger.exception("上游并发控制检查名额失败，不限制本次生成")
+                    self.admitted = True
+                    return
+                position = self._handle_admit(result, started)
+                if position is None:
+                    return
+                if position and position != last_position:
+                    if last_position is None:
+                        metrics.incr("admission.queued")
+                    last_position = position
+                    yield position
+                self._check_timeout(started)
+                await asyncio.sleep(self.config["POLL_MS"] / 1000)
+        except BaseException:
+            await self.arelease()
+            raise
+
+    async def aenqueue(self):
+        """
+        enqueue 的异步版本
+        """
+        try:
+            if self._should_reap():
+                await self.areap()
+            keys, args = self._enqueue_args()
+            accepted = await get_async_redis().register_script(ENQUEUE_SCRIPT)(
+                keys=keys, args=args
+            )
+        except Exception:
+            logger.exception("上游并发控制入队失败，不限制本次生成")
+            self.admitted = True
+            return
+        if not accepted:
+            metrics.incr("admission.rejected")
+            metrics.incr(f"admission.rejected.{self.endpoint}")
+            raise QueueFull("当前排队的请求过多，请稍后重试")
+        self.enqueued = True
+
+    def renew(self):
+        """
+        续期名额，在续期线程中调用
+        """
+        if self.released:
+            return
+        expires = int(time.time() * 1000) + self.config["LEASE_SECONDS"] * 1000
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            for scope in self._scopes():
+                pipe.zadd(active_key(scope), {self.member: expires}, xx=True)
+            pipe.execute()
+        except Exception:
+            logger.exception("上游并发名额续期失败")
+
+    def _stop_renewal(self):
+        self.released = True
+        if self._lease is not None:
+            lease_keeper.unregister(self._lease)
+            self._lease = None
+
+    def _release_pipeline(self, pipe):
+        for key in self._queue_keys():
+            pipe.zrem(key, self.member)
+        for scope in self._scopes():
+            pipe.zrem(active_key(scope), self.member)
+
+    def release(self):
+        """
+        退出队列或释放名额，可以重复调用
+        """
+        if self.released or not (self.enqueued or self.admitted):
+            return
+        self._stop_renewal()
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            self._release_pipeline(pipe)
+            pipe.execute()
+        except Exception:
+            logger.exception("释放上游并发名额失败")
+
+    async def arelease(self):
+        """
+        release 的异步版本
+        """
+        if self.released or not (self.enqueued or self.admitted):
+            return
+        self._stop_renewal()
+        try:
+            pipe = get_async_redis().pipeline(transaction=False)
+            self._release_pipeline(pipe)
+            await pipe.execute()
+        except Exception:
+            logger.exception("释放上游并发名额失败")
+
+
+def admission_stats():
+    """
+    当前排队的请求数与各范围占用的名额数
+    """
+    now = int(time.time() * 1000)
+    try:
+        conn = get_redis_connection("default")
+        active = {}
+        for key in conn.scan_iter(match=active_key("*"), count=100):
+            scope = key.decode()[len(active_key("")) :]
+            active[scope] = conn.zcount(key, now, "+inf")
+        return {"queued": conn.zcard(QUEUE_KEY), "active": active}
+    except Exception:
+        return {}
+
+
+metrics.register_stats("admission", admission_stats)
@@ -1,6 +1,65 @@
+import threading
+
 from django.apps import AppConfig
 
 
 class ChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chat"
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save, pre_delete
+
+        from chat.catalog import publish_catalog_change
+        from chat.clients import upstream_config, warmup_upstream_clients
+        from chat import history_cache
+        from chat.conditional import message_saved, session_changed
+        from chat.models import ChatMessage, ChatModel, ChatSession
+        from chat.tombstones import session_deleting
+
+        # 模型配置变更时使所有工作进程的模型目录失效
+        post_save.connect(
+            publish_catalog_change, sender=ChatModel, dispatch_uid="chat_model_saved"
+        )
+        post_delete.connect(
+            publish_catalog_change, sender=ChatModel, dispatch_uid="chat_model_deleted"
+        )
+
+        # 会话与消息变更时更新条件请求的校验信息；消息只随会话级联删除，
+        # 不监听其 post_delete，避免级联删除逐条加载消息
+        post_save.connect(
+            session_changed, sender=ChatSession, dispatch_uid="chat_session_saved"
+        )
+        post_delete.connect(
+            session_changed, sender=ChatSession, dispatch_uid="chat_session_deleted"
+        )
+        post_save.connect(
+            message_saved, sender=ChatMessage, dispatch_uid="chat_message_saved"
+        )
+        # 消息历史缓存写穿透
+        post_save.connect(
+            history_cache.message_saved,
+            sender=ChatMessage,
+            dispatch_uid="chat_history_message_saved",
+        )
+        post_save.connect(
+            history_cache.session_saved,
+            sender=ChatSession,
+            dispatch_uid="chat_history_session_saved",
+        )
+        post_delete.connect(
+            history_cache.session_deleted,
+            sender=ChatSession,
+            dispatch_uid="chat_history_session_deleted",
+        )
+
+        # 增量同步返回删除的会话与消息
+        pre_delete.connect(
+            session_deleting, sender=ChatSession, dispatch_uid="chat_session_deleting"
+        )
+
+        # 工作进程启动时在后台预热上游连接，不阻塞启动
+        if upstream_config()["WARMUP"]:
+            threading.Thread(
+                target=warmup_upstream_clients, name="upstream-warmup", daemon=True
+            ).start()
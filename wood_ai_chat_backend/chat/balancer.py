@@ -0,0 +1,245 @@
+import logging
+import random
+import threading
+import time
+
+import openai
+from django.conf import settings
+
+from chat.clients import endpoint_pool
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认的接入点负载均衡配置，可在 settings.CHAT_BALANCER 中覆盖
+DEFAULT_BALANCER = {
+    # "ewma"：按首token耗时的指数加权平均乘以进行中的请求数选择；
+    # "least_outstanding"：选择进行中的请求最少的接入点
+    "POLICY": "ewma",
+    # 新样本在首token耗时平均值中的权重
+    "EWMA_ALPHA": 0.3,
+    # 连续失败多少次后暂时摘除接入点
+    "FAILURE_THRESHOLD": 3,
+    # 摘除的时间，单位秒，之后恢复接收请求，再次失败会立即重新摘除
+    "EJECT_SECONDS": 30,
+    # 一次生成最多尝试的接入点数，请求上游失败时换一个接入点重试
+    "MAX_ATTEMPTS": 2,
+}
+
+# 计入接入点失败的错误：连接失败、超时、限流和服务端错误
+ENDPOINT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def balancer_config():
+    """
+    获取接入点负载均衡配置
+    """
+    return {**DEFAULT_BALANCER, **getattr(settings, "CHAT_BALANCER", {})}
+
+
+def is_endpoint_error(error):
+    return isinstance(error, ENDPOINT_ERRORS)
+
+
+class EndpointState:
+    """
+    单个接入点在当前进程内的统计
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.outstanding = 0
+        # 首token耗时的指数加权平均，单位毫秒，还没有样本时为 None
+        self.ewma_ttft_ms = None
+        self.failures = 0
+        self.ejected_until = 0
+        self.ejections = 0
+
+    def ejected(self, now):
+        return self.ejected_until > now
+
+    def to_dict(self, now):
+        return {
+            "requests": self.requests,
+            "outstanding": self.outstanding,
+            "ewma_ttft_ms": (
+                round(self.ewma_ttft_ms, 2) if self.ewma_ttft_ms is not None else None
+            ),
+            "failures": self.failures,
+            "ejected": self.ejected(now),
+            "ejections": self.ejections,
+        }
+
+
+class Route:
+    """
+    一次生成选中的接入点，记录首token耗时与结果
+    """
+
+    def __init__(self, balancer, key, model):
+        self.balancer = balancer
+        self.key = key
+        # 请求上游时使用的模型名
+        self.model = model
+        self.started = time.perf_counter()
+        self.first_token_seen = False
+        self.finished = False
+
+    def first_token(self):
+        """
+        收到第一个数据块时调用，只记录一次；未使用接入点时不记录
+        """
+        if self.first_token_seen or self.finished:
+            return
+        self.first_token_seen = True
+        self.balancer.record_ttft(self.key, (time.perf_counter() - self.started) * 1000)
+
+    def finish(self, error=None):
+        """
+        生成结束，可以重复调用
+
+        :param error: 请求或读取上游时的异常，连接失败、限流和服务端错误计入接入点失败
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.balancer.record_result(self.key, error)
+
+    def release(self):
+        """
+        没有使用接入点（如回放缓存），只结束进行中的计数
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.balancer.record_result(self.key, None, counted=False)
+
+
+class EndpointBalancer:
+    """
+    模型的多个推理接入点之间的负载均衡
+
+    统计保存在进程内：每个工作进程按自己观察到的首token耗时和进行中的请求数选择接入点，
+    连续失败的接入点暂时摘除；只有一个接入点的模型不受影响
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = EndpointState()
+        return state
+
+    def _score(self, policy, state, prior):
+        """
+        :param prior: 没有样本的接入点使用的首token耗时，为候选接入点的平均值
+        """
+        if policy == "least_outstanding":
+            return (state.outstanding, state.ewma_ttft_ms or 0)
+        # 没有样本的接入点按平均耗时参与比较，同样乘以进行中的请求数，
+        # 避免新接入点在第一个样本返回前收到所有请求
+        ttft = prior if state.ewma_ttft_ms is None else state.ewma_ttft_ms
+        return (ttft * (state.outstanding + 1),)
+
+    def _prior(self, candidates):
+        samples = [
+            self._state(key).ewma_ttft_ms
+            for key, _ in candidates
+            if self._state(key).ewma_ttft_ms is not None
+        ]
+        # 都没有样本时按进行中的请求数选择
+        return sum(samples) / len(samples) if samples else 1
+
+    def route(self, chat_model, exclude=()):
+        """
+        为一次生成选择接入点，并计入进行中的请求
+
+        :param exclude: 本次生成已失败的接入点
+        """
+        config = balancer_config()
+        members = endpoint_pool(chat_model)
+        pool = [item for item in members if item[0] not in exclude]
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                item for item in pool if not self._state(item[0]).ejected(now)
+            ]
+            if not candidates:
+                # 全部被摘除时仍然选择最早恢复的接入点，不直接拒绝请求
+                candidates = [
+                    min(pool, key=lambda item: self._state(item[0]).ejected_until)
+                ]
+            prior = self._prior(candidates)
+            scores = {
+                item: self._score(config["POLICY"], self._state(item[0]), prior)
+                for item in candidates
+            }
+            best = min(scores.values())
+            key, model = random.choice(
+                [item for item, score in scores.items() if score == best]
+            )
+            state = self._state(key)
+            state.requests += 1
+            state.outstanding += 1
+        if len(members) > 1:
+            metrics.incr(f"balancer.routed.{key}")
+            logger.debug("模型 %s 选择接入点 %s", chat_model.model_id, key)
+        return Route(self, key, model)
+
+    def can_failover(self, chat_model, error, tried):
+        """
+        判断请求上游失败后是否换一个接入点重试
+        """
+        if not is_endpoint_error(error):
+            return False
+        if len(tried) >= balancer_config()["MAX_ATTEMPTS"]:
+            return False
+        return any(key not in tried for key, _ in endpoint_pool(chat_model))
+
+    def record_ttft(self, key, ttft_ms):
+        alpha = balancer_config()["EWMA_ALPHA"]
+        with self._lock:
+            state = self._state(key)
+            if state.ewma_ttft_ms is None:
+                state.ewma_ttft_ms = ttft_ms
+            else:
+                state.ewma_ttft_ms += alpha * (ttft_ms - state.ewma_ttft_ms)
+
+    def record_result(self, key, error, counted=True):
+        config = balancer_config()
+        ejected = False
+        with self._lock:
+            state = self._state(key)
+            state.outstanding -= 1
+            if not counted:
+                state.requests -= 1
+            elif error is not None and is_endpoint_error(error):
+                state.failures += 1
+                if state.failures >= config["FAILURE_THRESHOLD"]:
+                    state.ejected_until = time.monotonic() + config["EJECT_SECONDS"]
+                    state.ejections += 1
+                    ejected = True
+            elif error is None:
+                state.failures = 0
+        if ejected:
+            metrics.incr(f"balancer.ejected.{key}")
+            logger.warning("接入点 %s 连续失败，暂时摘除: %s", key, error)
+
+    def stats(self):
+        """
+        各接入点的请求数、进行中的请求数、首token耗时与摘除状态
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {key: state.to_dict(now) for key, state in self._states.items()}
+
+
+endpoint_balancer = EndpointBalancer()
+metrics.register_stats("balancer", endpoint_balancer.stats)
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+
+from django_redis import get_redis_connection
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 取消生成的广播频道，消息内容为用户消息ID
+CANCEL_CHANNEL = "chat:cancel"
+# 取消标记的有效期，覆盖任务尚在排队、生成还未开始的情况
+CANCEL_FLAG_TTL = 600
+
+
+def cancel_flag_key(user_message_id):
+    return f"chat:cancel:{user_message_id}"
+
+
+class CancelToken:
+    """
+    单次生成的取消标记，生成循环在每个上游事件到达时检查
+    """
+
+    def __init__(self, user_message_id):
+        self.user_message_id = str(user_message_id)
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+
+class CancellationRegistry:
+    """
+    进程内进行中生成的取消标记注册表
+
+    首次注册时启动后台线程订阅 Redis 频道，任意工作进程发起的停止请求
+    都会广播到所有进程，由持有对应生成的进程设置取消标记
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._listener = None
+
+    def register(self, user_message_id):
+        """
+        注册一次生成，返回其取消标记；生成开始前已请求停止时直接返回已取消的标记
+        """
+        token = CancelToken(user_message_id)
+        with self._lock:
+            self._tokens.setdefault(token.user_message_id, set()).add(token)
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(
+                    target=self._listen, name="chat-cancel-listener", daemon=True
+                )
+                self._listener.start()
+        try:
+            conn = get_redis_connection("default")
+            if conn.exists(cancel_flag_key(user_message_id)):
+                token.cancel()
+        except Exception:
+            logger.exception("读取取消标记失败: %s", user_message_id)
+        return token
+
+    def unregister(self, token):
+        with self._lock:
+            tokens = self._tokens.get(token.user_message_id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens[token.user_message_id]
+
+    def cancel_local(self, user_message_id):
+        with self._lock:
+            tokens = list(self._tokens.get(str(user_message_id), ()))
+        for token in tokens:
+            token.cancel()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = get_redis_connection("default").pubsub(
+                    ignore_subscribe_messages=True
+                )
+                pubsub.subscribe(CANCEL_CHANNEL)
+                for message in pubsub.listen():
+                    self.cancel_local(message["data"].decode())
+            except Exception:
+                logger.exception("订阅取消频道失败，稍后重试")
+                time.sleep(1)
+
+
+cancellation = CancellationRegistry()
+
+
+def request_cancel(user_message_id):
+    """
+    请求停止一条用户消息的生成，生成可以运行在任意工作进程上
+    """
+    conn = get_redis_connection("default")
+    conn.set(cancel_flag_key(user_message_id), 1, ex=CANCEL_FLAG_TTL)
+    conn.publish(CANCEL_CHANNEL, str(user_message_id))
+    # 同一进程内的生成无需等待广播
+    cancellation.cancel_local(user_message_id)
+
+
+def clear_cancel(user_message_id):
+    """
+    清除取消标记，同一条用户消息重新生成前调用
+    """
+    try:
+        get_redis_connection("default").delete(cancel_flag_key(user_message_id))
+    except Exception:
+        logger.exception("清除取消标记失败: %s", user_message_id)
+
+
+def record_completion(chat_model, accumulator):
+    """
+    记录完整生成的增量数，用于估算取消节省的token数
+    """
+    metrics.incr(f"completion.count.{chat_model.model_id}")
+    metrics.incr(f"completion.deltas.{chat_model.model_id}", accumulator.deltas)
+
+
+def record_cancellation(chat_model, accumulator):
+    """
+    记录一次取消，并按该模型完整回复的平均长度估算节省的token数
+    """
+    count, deltas = metrics.values(
+        f"completion.count.{chat_model.model_id}",
+        f"completion.deltas.{chat_model.model_id}",
+    )
+    average = deltas / count if count else 0
+    saved = max(int(average) - accumulator.deltas, 0)
+    metrics.incr("cancel.count")
+    metrics.incr(f"cancel.count.{chat_model.model_id}")
+    metrics.incr("cancel.tokens_saved", saved)
+    metrics.incr(f"cancel.tokens_saved.{chat_model.model_id}", saved)
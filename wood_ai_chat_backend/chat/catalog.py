@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from chat.models import ChatModel
+from chat.serializers import ChatModelSerializer
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 模型目录失效的广播频道
+CATALOG_CHANNEL = "chat:catalog"
+# 未命中时重新加载的最小间隔，单位秒，避免不存在的模型ID反复触发加载
+MISS_RELOAD_INTERVAL = 1
+
+
+class ModelCatalog:
+    """
+    进程内的大模型目录缓存
+
+    按 id 与 model_id 缓存模型实例及其序列化后的数据，模型保存或删除时通过
+    Redis 频道通知所有工作进程失效；超过 CHAT_MODEL_CATALOG_TTL 秒也会重新加载，
+    覆盖订阅断开期间错过的通知
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listener = None
+        self._loaded_at = None
+        self._by_id = {}
+        self._by_model_id = {}
+        self._data = {}
+        self._listing = []
+        self._etag = ""
+        self._last_miss_reload = 0
+        self._reloads = 0
+
+    def _ttl(self):
+        return getattr(settings, "CHAT_MODEL_CATALOG_TTL", 300)
+
+    def _ensure_listener(self):
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(
+                target=self._listen, name="chat-catalog-listener", daemon=True
+            )
+            self._listener.start()
+
+    def _load(self):
+        chat_models = list(ChatModel.objects.order_by("id"))
+        data = {
+            chat_model.id: dict(ChatModelSerializer(chat_model).data)
+            for chat_model in chat_models
+        }
+        listing = [
+            data[chat_model.id] for chat_model in chat_models if chat_model.is_active
+        ]
+        digest = hashlib.md5(
+            json.dumps(listing, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        with self._lock:
+            self._by_id = {chat_model.id: chat_model for chat_model in chat_models}
+            self._by_model_id = {
+                chat_model.model_id: chat_model for chat_model in chat_models
+            }
+            self._data = data
+            self._listing = listing
+            self._etag = f'W/"{digest}"'
+            self._loaded_at = time.monotonic()
+            self._reloads += 1
+            self._ensure_listener()
+
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= self._ttl():
+            self._load()
+
+    def _lookup(self, index, key):
+        self._ensure_loaded()
+        chat_model = index().get(key)
+        if chat_model is not None:
+            return chat_model
+        # 模型可能刚刚创建，失效通知尚未到达
+        now = time.monotonic()
+        if now - self._last_miss_reload >= MISS_RELOAD_INTERVAL:
+            self._last_miss_reload = now
+            self._load()
+            chat_model = index().get(key)
+            if chat_model is not None:
+                return chat_model
+        raise ChatModel.DoesNotExist(f"模型不存在: {key}")
+
+    def get(self, id=None, model_id=None):
+        """
+        获取模型实例，不存在时抛出 ChatModel.DoesNotExist
+
+        返回的实例在多个请求间共享，不要修改
+        """
+        if id is not None:
+            return self._lookup(lambda: self._by_id, id)
+        return self._lookup(lambda: self._by_model_id, model_id)
+
+    def data(self, id):
+        """
+        获取模型序列化后的数据，与 ChatModelSerializer(chat_model).data 一致
+
+        :param id: 模型ID，为 None 时返回空模型的序列化数据
+        """
+        if id is None:
+            return ChatModelSerializer(None).data
+        chat_model = self.get(id=id)
+        return dict(self._data[chat_model.id])
+
+    def serialize(self, chat_model):
+        """
+        获取模型实例序列化后的数据，优先使用缓存；不访问数据库，可在异步生成器中调用
+        """
+        data = self._data.get(chat_model.id)
+        if data is None:
+            return ChatModelSerializer(chat_model).data
+        return dict(data)
+
+    def listing(self):
+        """
+        获取启用模型的列表及其 ETag
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return [dict(item) for item in self._listing], self._etag
+
+    def invalidate(self):
+        """
+        使本进程的缓存失效，下次访问时重新加载
+        """
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self._loaded_at is not None,
+                "models": len(self._by_id),
+                "etag": self._etag,
+                "reloads": self._reloads,
+            }
+
+    def _listen(self):
+        reconnecting = False
+        while True:
+            try:
+                pubsub = get_redis_connection("default").pubsub(
+                    ignore_subscribe_messages=True
+                )
+                pubsub.subscribe(CATALOG_CHANNEL)
+                # 重新订阅前可能错过了通知
+                if reconnecting:
+                    self.invalidate()
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except Exception:
+                logger.exception("订阅模型目录频道失败，稍后重试")
+                reconnecting = True
+                time.sleep(1)
+
+
+model_catalog = ModelCatalog()
+metrics.register_stats("model_catalog", model_catalog.stats)
+
+
+def _publish_catalog_change():
+    try:
+        get_redis_connection("default").publish(CATALOG_CHANNEL, "1")
+    except Exception:
+        logger.exception("广播模型目录失效失败")
+
+
+def publish_catalog_change(**kwargs):
+    """
+    模型保存或删除后使所有工作进程的模型目录失效，作为 ChatModel 的信号处理函数
+
+    在事务提交后再广播，避免其他进程读到未提交前的数据
+    """
+    model_catalog.invalidate()
+    transaction.on_commit(_publish_catalog_change)
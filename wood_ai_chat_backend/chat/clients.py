@@ -0,0 +1,481 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.conf import settings
+from openai import OpenAI, AsyncOpenAI
+
+from utils import metrics
+
+# 默认的上游连接配置，可在 settings.CHAT_UPSTREAM 中覆盖
+DEFAULT_UPSTREAM = {
+    "BASE_URL": "https://ark.cn-beijing.volces.com/api/v3",
+    # 设置服务响应超时时间，单位秒，推荐1800秒及以上
+    "TIMEOUT": 1800,
+    # 设置重试次数
+    "MAX_RETRIES": 2,
+    # 每个接入点连接池的最大连接数
+    "MAX_CONNECTIONS": 100,
+    # 每个接入点保持空闲的最大长连接数
+    "MAX_KEEPALIVE_CONNECTIONS": 20,
+    # 空闲长连接的过期时间，单位秒
+    "KEEPALIVE_EXPIRY": 120,
+    # 是否启用 HTTP/2（需要安装 h2）
+    "HTTP2": True,
+    # 工作进程启动时是否预热连接；异步客户端在每个事件循环首次使用时预热
+    "WARMUP": False,
+    # 每个接入点预热的连接数
+    "WARMUP_CONNECTIONS": 2,
+    # 请求上游时使用的模型名，为 None 时使用接入点标识；可在 ENDPOINTS 中按接入点设置
+    "MODEL": None,
+    # 按 ep_id / model_id 覆盖以上配置，如 {"ep-xxx": {"MAX_CONNECTIONS": 50}}
+    "ENDPOINTS": {},
+    # 模型的接入点池：model_id / ep_id -> 接入点标识列表，如 {"doubao": ["ep-a", "ep-b"]}；
+    # 每个接入点的 BASE_URL、MODEL 等在 ENDPOINTS 中配置，未配置的模型只使用自身的接入点
+    "POOLS": {},
+}
+
+
+def upstream_config(key=None):
+    """
+    获取上游连接配置
+
+    :param key: 接入点标识（ep_id 或 model_id），用于合并按接入点的覆盖配置
+    :return: 合并后的配置字典
+    """
+    config = {**DEFAULT_UPSTREAM, **getattr(settings, "CHAT_UPSTREAM", {})}
+    if key is not None:
+        config.update(config["ENDPOINTS"].get(key, {}))
+    return config
+
+
+def http2_available():
+    """
+    判断是否安装了 HTTP/2 支持
+    """
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def endpoint_key(chat_model):
+    """
+    获取模型对应的连接池标识，优先使用推理接入点ID
+    """
+    return chat_model.ep_id or chat_model.model_id
+
+
+def endpoint_pool(chat_model):
+    """
+    获取模型的接入点池
+
+    :return: [(接入点标识, 请求上游时使用的模型名)]
+    """
+    pools = upstream_config()["POOLS"]
+    keys = pools.get(chat_model.model_id) or pools.get(chat_model.ep_id)
+    if not keys:
+        return [(endpoint_key(chat_model), chat_model.model_id)]
+    return [(key, upstream_config(key)["MODEL"] or key) for key in keys]
+
+
+class PoolStats:
+    """
+    单个连接池的统计：等待获取连接的耗时、新建连接数、进行中的请求数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.new_connections = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def request_started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def connection_created(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def record_wait(self, wait_ms):
+        with self._lock:
+            self.wait_ms_total += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "new_connections": self.new_connections,
+                "wait_ms_avg": (
+                    round(self.wait_ms_total / self.requests, 2)
+                    if self.requests
+                    else 0.0
+                ),
+                "wait_ms_max": round(self.wait_ms_max, 2),
+            }
+
+
+class _PoolTracer:
+    """
+    通过 httpcore 的 trace 扩展记录一次请求获取连接的耗时
+
+    从请求开始到发送请求头之间的时间即为等待连接池 + 建立连接（TCP/TLS）的耗时
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.started = time.perf_counter()
+        self.recorded = False
+
+    def on_event(self, name, info):
+        if name == "connection.connect_tcp.started":
+            self.stats.connection_created()
+        elif name.endswith(".send_request_headers.started") and not self.recorded:
+            self.recorded = True
+            self.stats.record_wait((time.perf_counter() - self.started) * 1000)
+
+    def __call__(self, name, info):
+        self.on_event(name, info)
+
+    async def acall(self, name, info):
+        self.on_event(name, info)
+
+
+class _TrackedStream(httpx.SyncByteStream):
+    """
+    包装响应体，在响应关闭时结束进行中的请求计数
+    """
+
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._stats.request_finished()
+        self._stream.close()
+
+
+class _AsyncTrackedStream(httpx.AsyncByteStream):
+    """
+    _TrackedStream 的异步版本
+    """
+
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    async def __aiter__(self):
+        async for part in self._stream:
+            yield part
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._stats.request_finished()
+        await self._stream.aclose()
+
+
+class _TrackedTransport(httpx.HTTPTransport):
+    """
+    带统计的连接池传输层
+    """
+
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request):
+        tracer = _PoolTracer(self.stats)
+        request.extensions["trace"] = tracer
+        self.stats.request_started()
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            self.stats.request_finished()
+            raise
+        response.stream = _TrackedStream(response.stream, self.stats)
+        return response
+
+
+class _AsyncTrackedTransport(httpx.AsyncHTTPTransport):
+    """
+    带统计的异步连接池传输层
+    """
+
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        tracer = _PoolTracer(self.stats)
+        request.extensions["trace"] = tracer.acall
+        self.stats.request_started()
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self.stats.request_finished()
+            raise
+        response.stream = _AsyncTrackedStream(response.stream, self.stats)
+        return response
+
+
+def _pool_occupancy(transport, max_connections):
+    """
+    读取 httpcore 连接池的占用情况
+    """
+    pool = getattr(transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    queued = sum(1 for request in getattr(pool, "_requests", []) if request.is_queued())
+    return {
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "queued": queued,
+        "max_connections": max_connections,
+    }
+
+
+class UpstreamClientRegistry:
+    """
+    上游客户端注册表
+
+    每个推理接入点（ep_id / model_id）共享一个带长连接池的 OpenAI 客户端，
+    避免每次请求重新握手；异步客户端按事件循环隔离
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._http_clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_http_clients = weakref.WeakKeyDictionary()
+        # 接入点标识 -> [(传输层, 是否异步)]，用于统计连接池占用
+        self._transports = {}
+        self._stats = {}
+        # 启动时预热的接入点，异步客户端在每个事件循环首次使用时预热同样的接入点
+        self._warmup_keys = ()
+        # 进行中的异步预热任务，保持引用避免被回收
+        self._warmup_tasks = set()
+
+    def _get_stats(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats.setdefault(key, PoolStats())
+        return stats
+
+    @staticmethod
+    def _transport_kwargs(config):
+        return {
+            "limits": httpx.Limits(
+                max_connections=config["MAX_CONNECTIONS"],
+                max_keepalive_connections=config["MAX_KEEPALIVE_CONNECTIONS"],
+                keepalive_expiry=config["KEEPALIVE_EXPIRY"],
+            ),
+            "http2": config["HTTP2"] and http2_available(),
+        }
+
+    @staticmethod
+    def _client_kwargs(config):
+        return {
+            "base_url": config["BASE_URL"],
+            "api_key": os.environ.get("ARK_API_KEY"),
+            "timeout": config["TIMEOUT"],
+            "max_retries": config["MAX_RETRIES"],
+        }
+
+    def get_client(self, key):
+        """
+        获取接入点对应的同步客户端
+
+        :param key: 接入点标识，见 endpoint_key
+        """
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                config = upstream_config(key)
+                transport = _TrackedTransport(
+                    self._get_stats(key), **self._transport_kwargs(config)
+                )
+                http_client = httpx.Client(
+                    transport=transport, timeout=config["TIMEOUT"]
+                )
+                client = OpenAI(http_client=http_client, **self._client_kwargs(config))
+                self._transports.setdefault(key, []).append((transport, False))
+                self._http_clients[key] = http_client
+                self._clients[key] = client
+        return client
+
+    def get_async_client(self, key):
+        """
+        获取接入点对应的异步客户端，必须在事件循环中调用
+
+        :param key: 接入点标识，见 endpoint_key
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            new_loop = loop not in self._async_clients
+            clients = self._async_clients.setdefault(loop, {})
+            http_clients = self._async_http_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                config = upstream_config(key)
+                transport = _AsyncTrackedTransport(
+                    self._get_stats(key), **self._transport_kwargs(config)
+                )
+                http_client = httpx.AsyncClient(
+                    transport=transport, timeout=config["TIMEOUT"]
+                )
+                client = AsyncOpenAI(
+                    http_client=http_client, **self._client_kwargs(config)
+                )
+                self._prune_transports(key)
+                self._transports[key].append((weakref.ref(transport), True))
+                http_clients[key] = http_client
+                clients[key] = client
+            warmup_keys = self._warmup_keys if new_loop else ()
+        if warmup_keys:
+            # 异步客户端属于事件循环，无法在启动时预热：在服务请求的事件循环
+            # 首次使用时于后台预热，不阻塞当前请求
+            task = loop.create_task(self.awarmup(warmup_keys))
+            self._warmup_tasks.add(task)
+            task.add_done_callback(self._warmup_tasks.discard)
+        return client
+
+    def _prune_transports(self, key):
+        """
+        移除已随事件循环释放的异步传输层，调用时需持有 _lock
+        """
+        self._transports[key] = [
+            (transport, is_async)
+            for transport, is_async in self._transports.get(key, [])
+            if not is_async or transport() is not None
+        ]
+
+    def warmup(self, keys):
+        """
+        预热同步客户端的连接池：并发发起轻量请求，使 TCP/TLS 连接进入长连接池
+
+        异步客户端按事件循环创建，这里只记录接入点，由 get_async_client 在事件循环
+        首次使用时调用 awarmup
+
+        :param keys: 需要预热的接入点标识列表
+        """
+        self._warmup_keys = tuple(keys)
+        api_key = os.environ.get("ARK_API_KEY")
+        for key in keys:
+            config = upstream_config(key)
+            self.get_client(key)
+            http_client = self._http_clients[key]
+            count = min(config["WARMUP_CONNECTIONS"], config["MAX_CONNECTIONS"])
+            if count <= 0:
+                continue
+
+            def ping(_):
+                try:
+                    # 只需要建立连接，响应状态无关紧要
+                    http_client.get(
+                        f"{config['BASE_URL']}/models",
+                        headers={"Authorization": f"Bearer {api_key}"},
+                    ).close()
+                except httpx.HTTPError:
+                    pass
+
+            with ThreadPoolExecutor(max_workers=count) as executor:
+                list(executor.map(ping, range(count)))
+
+    async def awarmup(self, keys):
+        """
+        在当前事件循环中预热异步客户端的连接池
+
+        :param keys: 需要预热的接入点标识列表
+        """
+        api_key = os.environ.get("ARK_API_KEY")
+
+        async def ping(http_client, url):
+            try:
+                # 只需要建立连接，响应状态无关紧要
+                response = await http_client.get(
+                    url, headers={"Authorization": f"Bearer {api_key}"}
+                )
+                await response.aclose()
+            except httpx.HTTPError:
+                pass
+
+        pings = []
+        for key in keys:
+            config = upstream_config(key)
+            self.get_async_client(key)
+            http_client = self._async_http_clients[asyncio.get_running_loop()][key]
+            count = min(config["WARMUP_CONNECTIONS"], config["MAX_CONNECTIONS"])
+            pings.extend(
+                ping(http_client, f"{config['BASE_URL']}/models") for _ in range(count)
+            )
+        await asyncio.gather(*pings)
+
+    def stats(self):
+        """
+        获取各接入点连接池的占用与等待统计
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            transports = {key: list(items) for key, items in self._transports.items()}
+        data = {}
+        for key, pool_stats in stats.items():
+            max_connections = upstream_config(key)["MAX_CONNECTIONS"]
+            item = pool_stats.to_dict()
+            item["pools"] = []
+            for transport, is_async in transports.get(key, []):
+                if is_async:
+                    # 异步传输层随事件循环释放，使用弱引用
+                    transport = transport()
+                    if transport is None:
+                        continue
+                pool = _pool_occupancy(transport, max_connections)
+                pool["async"] = is_async
+                item["pools"].append(pool)
+            data[key] = item
+        return data
+
+
+upstream_clients = UpstreamClientRegistry()
+metrics.register_stats("upstream", upstream_clients.stats)
+
+
+def warmup_upstream_clients():
+    """
+    预热所有启用模型的上游连接，在工作进程启动时由 ChatConfig 在后台线程中调用
+    """
+    from chat.models import ChatModel
+
+    keys = {
+        key
+        for chat_model in ChatModel.objects.filter(is_active=True)
+        for key, _ in endpoint_pool(chat_model)
+    }
+    upstream_clients.warmup(keys)
@@ -0,0 +1,173 @@
+import zlib
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 默认的 SSE 压缩配置，可在 settings.CHAT_SSE_COMPRESSION 中覆盖
+DEFAULT_SSE_COMPRESSION = {
+    # 是否压缩流式响应
+    "ENABLED": True,
+    # 服务端支持的编码，按优先级排列；br 需要安装 brotli
+    "ENCODINGS": ["br", "gzip", "deflate"],
+    # gzip / deflate 的压缩级别
+    "ZLIB_LEVEL": 6,
+    # brotli 的压缩质量，流式场景下较低的质量延迟更小
+    "BROTLI_QUALITY": 5,
+}
+
+
+def compression_config():
+    """
+    获取 SSE 压缩配置
+    """
+    return {
+        **DEFAULT_SSE_COMPRESSION,
+        **getattr(settings, "CHAT_SSE_COMPRESSION", {}),
+    }
+
+
+def available_encodings():
+    """
+    当前环境可用的编码，按配置的优先级排列
+    """
+    encodings = []
+    for encoding in compression_config()["ENCODINGS"]:
+        if encoding == "br" and brotli is None:
+            continue
+        if encoding in ("br", "gzip", "deflate"):
+            encodings.append(encoding)
+    return encodings
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    按 Accept-Encoding 选择压缩编码
+
+    :param accept_encoding: 请求的 Accept-Encoding 头
+    :return: 选中的编码，不压缩时返回 None
+    """
+    if not accept_encoding or not compression_config()["ENABLED"]:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """
+    单个流的压缩上下文
+
+    整个流共用一个压缩器，以便利用前文的字典；每一帧压缩后立即 sync flush，
+    客户端收到后即可解压出完整的帧，不会因为压缩而增加延迟
+    """
+
+    def __init__(self, encoding):
+        """
+        :param encoding: br / gzip / deflate
+        """
+        config = compression_config()
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(
+                mode=brotli.MODE_TEXT, quality=config["BROTLI_QUALITY"]
+            )
+        else:
+            # gzip 使用 gzip 封装，deflate 按 HTTP 规范使用 zlib 封装
+            wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+            self._compressor = zlib.compressobj(
+                config["ZLIB_LEVEL"], zlib.DEFLATED, wbits
+            )
+
+    def compress(self, frame):
+        """
+        压缩一帧并 flush，返回可以立即发送的字节
+        """
+        if isinstance(frame, str):
+            frame = frame.encode()
+        if self.encoding == "br":
+            return self._compressor.process(frame) + self._compressor.flush()
+        return self._compressor.compress(frame) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self):
+        """
+        结束压缩流
+        """
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def compress_frames(frames, encoding):
+    """
+    逐帧压缩同步的 SSE 帧迭代器，关闭时同时关闭原迭代器
+    """
+    compressor = StreamCompressor(encoding)
+    iterator = iter(frames)
+    try:
+        for frame in iterator:
+            data = compressor.compress(frame)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+async def acompress_frames(frames, encoding):
+    """
+    compress_frames 的异步版本
+    """
+    compressor = StreamCompressor(encoding)
+    iterator = frames.__aiter__()
+    try:
+        async for frame in iterator:
+            data = compressor.compress(frame)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def event_stream_response(request, frames):
+    """
+    创建 SSE 流式响应，按请求的 Accept-Encoding 逐帧压缩
+
+    :param request: 当前请求
+    :param frames: 产生 SSE 帧的同步或异步迭代器
+    """
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is not None:
+        if hasattr(frames, "__aiter__"):
+            frames = acompress_frames(frames, encoding)
+        else:
+            frames = compress_frames(frames, encoding)
+    response = StreamingHttpResponse(frames, content_type="text/event-stream")
+    if encoding is not None:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
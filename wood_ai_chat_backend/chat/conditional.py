@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import secrets
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django_redis import get_redis_connection
+
+from chat.models import ChatMessage, ChatSession
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认的条件请求配置，可在 settings.CHAT_CONDITIONAL_GET 中覆盖
+DEFAULT_CONDITIONAL_GET = {
+    # 是否为会话列表与消息历史返回 ETag / Last-Modified 并处理条件请求
+    "ENABLED": True,
+    # 校验信息在 Redis 中的过期时间，单位秒，过期后从数据库重新生成
+    "TTL": 86400,
+}
+
+# 用户会话列表的校验信息
+SESSIONS_KEY = "chat:validators:sessions:{user_id}"
+# 会话消息历史的校验信息
+HISTORY_KEY = "chat:validators:history:{session_id}"
+
+
+def conditional_config():
+    """
+    获取条件请求配置
+    """
+    return {
+        **DEFAULT_CONDITIONAL_GET,
+        **getattr(settings, "CHAT_CONDITIONAL_GET", {}),
+    }
+
+
+def _touch(key, **fields):
+    """
+    数据变更后递增版本号并更新最后修改时间
+    """
+    try:
+        pipeline = get_redis_connection("default").pipeline()
+        pipeline.hincrby(key, "version", 1)
+        pipeline.hset(key, mapping={"last_modified": time.time(), **fields})
+        pipeline.expire(key, conditional_config()["TTL"])
+        pipeline.execute()
+    except Exception:
+        # 校验信息无法更新时删除，下次读取从数据库重新生成
+        logger.exception("更新校验信息失败: %s", key)
+        try:
+            get_redis_connection("default").delete(key)
+        except Exception:
+            pass
+
+
+def touch_sessions(user_id):
+    """
+    用户的会话列表发生变更，在事务提交后执行
+    """
+    transaction.on_commit(lambda: _touch(SESSIONS_KEY.format(user_id=user_id)))
+
+
+def touch_history(session_id, last_message_id=None):
+    """
+    会话的消息历史发生变更，在事务提交后执行
+
+    :param last_message_id: 新建消息的ID
+    """
+    fields = {} if last_message_id is None else {"last_message_id": last_message_id}
+    transaction.on_commit(
+        lambda: _touch(HISTORY_KEY.format(session_id=session_id), **fields)
+    )
+
+
+def session_changed(instance, **kwargs):
+    """
+    会话保存或删除后更新会话列表与消息历史（消息中包含会话数据）的校验信息，
+    作为 ChatSession 的信号处理函数
+    """
+    touch_sessions(instance.user_id)
+    touch_history(instance.id)
+
+
+def message_saved(instance, created, **kwargs):
+    """
+    消息保存后更新所属会话消息历史的校验信息，作为 ChatMessage 的信号处理函数
+
+    AI回复的检查点通过 QuerySet.update 写入，由 ReplyAccumulator 直接调用 touch_history
+    """
+    touch_history(instance.session_id, instance.id if created else None)
+
+
+def _read(key, seed, required=("epoch",)):
+    """
+    读取校验信息，不存在时通过 seed 从数据库生成
+
+    新生成的校验信息带有随机的 epoch，过期重建后不会与之前的 ETag 相同；
+    生成期间的并发变更优先（HSETNX 不覆盖已有字段）
+
+    :param seed: 返回 {"last_modified": 时间戳, ...} 的函数，返回 None 时不生成
+    :param required: 缺少其中任一字段时通过 seed 补充
+    :return: {"epoch", "version", "last_modified", ...}，seed 返回 None 时为 None
+    """
+    connection = get_redis_connection("default")
+    values = connection.hgetall(key)
+    if any(name.encode() not in values for name in required):
+        fields = seed()
+        if fields is None:
+            return None
+        metrics.incr("chat.conditional.seed")
+        pipeline = connection.pipeline()
+        pipeline.hsetnx(key, "epoch", secrets.token_hex(4))
+        pipeline.hsetnx(key, "version", 0)
+        for name, value in fields.items():
+            pipeline.hsetnx(key, name, value)
+        pipeline.expire(key, conditional_config()["TTL"])
+        pipeline.hgetall(key)
+        values = pipeline.execute()[-1]
+    return {name.decode(): value.decode() for name, value in values.items()}
+
+
+def session_list_validators(user_id):
+    """
+    用户会话列表的校验信息，初始的最后修改时间为会话的最大 updated_at
+    """
+
+    def seed():
+        updated_at = ChatSession.objects.filter(user_id=user_id).aggregate(
+            latest=Max("updated_at")
+        )["latest"]
+        return {"last_modified": updated_at.timestamp() if updated_at else 0}
+
+    return _read(SESSIONS_KEY.format(user_id=user_id), seed)
+
+
+def history_validators(session_id, user_id):
+    """
+    会话消息历史的校验信息，初始值来自会话最新的消息
+
+    校验信息中记录会话的所属用户，会话不存在或不属于 user_id 时返回 None，
+    不读取也不生成其他用户会话的校验信息
+    """
+
+    def seed():
+        if not ChatSession.objects.filter(pk=session_id, user_id=user_id).exists():
+            return None
+        latest = (
+            ChatMessage.objects.filter(session_id=session_id)
+            .order_by("-created_at", "-id")
+            .values_list("id", "created_at")
+            .first()
+        )
+        if latest is None:
+            return {"user_id": user_id, "last_message_id": 0, "last_modified": 0}
+        return {
+            "user_id": user_id,
+            "last_message_id": latest[0],
+            "last_modified": latest[1].timestamp(),
+        }
+
+    validators = _read(
+        HISTORY_KEY.format(session_id=session_id), seed, required=("epoch", "user_id")
+    )
+    if validators is None or validators["user_id"] != str(user_id):
+        return None
+    return validators
+
+
+class ConditionalListMixin:
+    """
+    列表接口的条件请求：在查询与序列化之前比较 If-None-Match / If-Modified-Since，
+    未变更时直接返回 304
+
+    视图实现 get_list_validators 返回校验信息，返回 None 时不处理条件请求
+    """
+
+    def get_list_validators(self, request):
+        raise NotImplementedError
+
+    def get_list_etag(self, request, validators):
+        """
+        弱 ETag：校验信息加上用户与查询参数（分页、字段集等会改变响应内容）
+        """
+        variant = hashlib.md5(
+            f"{request.user.pk}?{request.GET.urlencode()}".encode()
+        ).hexdigest()[:8]
+        parts = [
+            validators["epoch"],
+            validators["version"],
+            validators.get("last_message_id", ""),
+            variant,
+        ]
+        return f'W/"{"-".join(str(part) for part in parts if part != "")}"'
+
+    def list(self, request, *args, **kwargs):
+        validators = None
+        if conditional_config()["ENABLED"]:
+            try:
+                validators = self.get_list_validators(request)
+            except Exception:
+                logger.exception("读取校验信息失败")
+        if validators is None:
+            return super().list(request, *args, **kwargs)
+
+        etag = self.get_list_etag(request, validators)
+        last_modified = int(float(validators["last_modified"])) or None
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:
+            metrics.incr("chat.conditional.not_modified")
+        else:
+            response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
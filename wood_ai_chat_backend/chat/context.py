@@ -0,0 +1,183 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from chat.models import ChatMessage
+from chat.tokens import estimate_tokens, message_tokens, truncate_tokens
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认的上下文组装配置，可在 settings.CHAT_CONTEXT 中覆盖
+DEFAULT_CONTEXT = {
+    # 模型未配置 context_budget 时的上下文token预算
+    "DEFAULT_BUDGET": 8000,
+    # 上游保存响应的时间，单位秒；上一轮回复超过该时间后不再使用 previous_response_id
+    "RESPONSE_TTL": 72 * 3600,
+    # 保留推理内容的最近AI回复数，为 0 时上下文不包含推理内容
+    "REASONING_TURNS": 0,
+    # 每条推理内容最多保留的token数，超出部分从开头截断
+    "REASONING_MAX_TOKENS": 512,
+    # 每次从数据库读取的历史消息数，读满预算后不再继续读取
+    "BATCH_SIZE": 50,
+}
+
+# 推理内容作为普通的AI回复发送时的前缀；上游要求 reasoning 类型的 input 项带有
+# 原响应中的 ID，而组装上下文时原响应已不可用
+REASONING_PREFIX = "（推理过程）\n"
+
+# 多轮上下文的来源
+PREVIOUS_RESPONSE = "previous_response"
+ASSEMBLED = "assembled"
+# 命中回复缓存，不请求上游
+CACHED = "cache"
+
+
+def context_config():
+    """
+    获取上下文组装配置
+    """
+    return {**DEFAULT_CONTEXT, **getattr(settings, "CHAT_CONTEXT", {})}
+
+
+def context_budget(chat_model):
+    return chat_model.context_budget or context_config()["DEFAULT_BUDGET"]
+
+
+def usable_previous_response_id(user_message):
+    """
+    获取上游仍然保存的上一轮响应ID：上一轮回复需要完整生成且未超过 RESPONSE_TTL
+    """
+    parent = user_message.parent_message
+    if parent is None or not parent.message_resp_id or parent.status != "complete":
+        return None
+    ttl = timedelta(seconds=context_config()["RESPONSE_TTL"])
+    if datetime.now() - parent.created_at > ttl:
+        return None
+    return parent.message_resp_id
+
+
+def iter_branch(user_message, batch_size):
+    """
+    从父消息开始沿分支向根消息逐条返回历史消息，按批读取
+    """
+    ids = user_message.ancestor_ids()
+    while ids:
+        batch, ids = ids[-batch_size:], ids[:-batch_size]
+        messages = ChatMessage.objects.filter(id__in=batch).only(
+            "id", "role", "content", "content_tokens", "reasoning_content", "status"
+        )
+        yield from sorted(messages, key=lambda message: message.id, reverse=True)
+
+
+def build_context(user_message, chat_model):
+    """
+    沿分支从新到旧将历史消息装入模型的token预算，组装 Response API 的 input
+
+    当前用户消息总是发送；装不下的更早消息被丢弃，上下文总是从用户消息开始
+
+    :return: {"input", "messages", "input_tokens", "truncated"}
+    """
+    config = context_config()
+    budget = context_budget(chat_model)
+    tokens = message_tokens(user_message)
+    # 从新到旧的 (消息对应的 input 项, token数)
+    turns = [([{"role": "user", "content": user_message.content}], tokens)]
+    truncated = False
+    reasoning_turns = config["REASONING_TURNS"]
+
+    for message in iter_branch(user_message, config["BATCH_SIZE"]):
+        if not message.content:
+            continue
+        items = [{"role": message.role, "content": message.content}]
+        cost = message_tokens(message)
+        if (
+            message.role == "assistant"
+            and reasoning_turns > 0
+            and message.reasoning_content
+        ):
+            reasoning = truncate_tokens(
+                message.reasoning_content, config["REASONING_MAX_TOKENS"]
+            )
+            items.insert(
+                0, {"role": "assistant", "content": REASONING_PREFIX + reasoning}
+            )
+            cost += estimate_tokens(REASONING_PREFIX + reasoning)
+            reasoning_turns -= 1
+        if tokens + cost > budget:
+            truncated = True
+            break
+        tokens += cost
+        turns.append((items, cost))
+
+    # 上下文不以AI回复开头
+    while len(turns) > 1 and turns[-1][0][-1]["role"] != "user":
+        tokens -= turns.pop()[1]
+        truncated = True
+
+    return {
+        "input": [item for items, _ in reversed(turns) for item in items],
+        "messages": len(turns),
+        "input_tokens": tokens,
+        "truncated": truncated,
+    }
+
+
+def prepare_input(user_message, chat_model, previous_response_id):
+    """
+    组装本次请求的 input：有可用的 previous_response_id 时只发送当前消息，
+    否则在服务端组装上下文，并记录组装耗时与估算的输入token数
+
+    :return: (input, 上下文报告)
+    """
+    started = time.perf_counter()
+    if previous_response_id:
+        context = {
+            "input": [{"role": "user", "content": user_message.content}],
+            "messages": 1,
+            "input_tokens": message_tokens(user_message),
+            "truncated": False,
+        }
+        mode = PREVIOUS_RESPONSE
+    else:
+        context = build_context(user_message, chat_model)
+        mode = ASSEMBLED
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "mode": mode,
+        "messages": context["messages"],
+        "input_tokens": context["input_tokens"],
+        "truncated": context["truncated"],
+        "build_ms": round(elapsed * 1000, 3),
+    }
+    model_id = chat_model.model_id
+    metrics.incr(f"context.{mode}.{model_id}")
+    metrics.incr(f"context.input_tokens.{model_id}", context["input_tokens"])
+    metrics.incr(f"context.build_us.{model_id}", int(elapsed * 1_000_000))
+    logger.info(
+        "上下文组装 消息ID=%s 模型=%s 方式=%s 消息数=%d 估算token=%d 耗时=%.3fms",
+        user_message.id,
+        model_id,
+        mode,
+        report["messages"],
+        report["input_tokens"],
+        report["build_ms"],
+    )
+    return context["input"], report
+
+
+def cached_report(user_message, chat_model):
+    """
+    回复缓存命中时的上下文报告：只有当前用户消息，不组装上下文
+    """
+    metrics.incr(f"context.{CACHED}.{chat_model.model_id}")
+    return {
+        "mode": CACHED,
+        "messages": 1,
+        "input_tokens": message_tokens(user_message),
+        "truncated": False,
+        "build_ms": 0,
+    }
@@ -0,0 +1,156 @@
+import json
+import time
+from json.encoder import encode_basestring_ascii
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 流式输出格式：默认为 OpenAI 风格的数据块，compact 为精简的增量帧
+OPENAI_FORMAT = "openai"
+COMPACT_FORMAT = "compact"
+STREAM_FORMATS = (OPENAI_FORMAT, COMPACT_FORMAT)
+
+
+def json_backend():
+    """
+    获取 SSE 帧使用的 JSON 序列化方式
+
+    CHAT_SSE_JSON 为 "json"（默认）时与 json.dumps 的输出逐字节一致；
+    为 "orjson" 且已安装 orjson 时非 ASCII 字符不再转义，输出为 UTF-8
+    """
+    if getattr(settings, "CHAT_SSE_JSON", "json") == "orjson" and orjson is not None:
+        return "orjson"
+    return "json"
+
+
+def _orjson_string(value):
+    return orjson.dumps(value).decode()
+
+
+def dumps(data, backend=None):
+    """
+    按配置的 JSON 序列化方式序列化一条数据（紧凑格式）
+
+    :param backend: 指定 "json" 或 "orjson"，默认按配置
+    """
+    if (backend or json_backend()) == "orjson":
+        return orjson.dumps(data).decode()
+    return json.dumps(data, separators=(",", ":"))
+
+
+class Delta:
+    """
+    一个待发送的增量：只保存增量文本，发送时由 ChunkEncoder 拼接成完整的帧
+    """
+
+    __slots__ = ("encoder", "id", "content", "reasoning_content")
+
+    def __init__(self, encoder, id, content="", reasoning_content=""):
+        self.encoder = encoder
+        self.id = id
+        self.content = content
+        self.reasoning_content = reasoning_content
+
+    def encode(self):
+        return self.encoder.encode(self.id, self.content, self.reasoning_content)
+
+
+class ChunkEncoder:
+    """
+    单个流的增量帧编码器
+
+    帧中固定不变的部分（created、model、object、role 等）在流开始时序列化一次，
+    每个增量只转义增量文本并拼接，默认格式的输出与 Choice + create_chat_chunk +
+    json.dumps 逐字节一致：
+    data: {"id":...,"choices":[{"index":0,"delta":{"role":"assistant","content":...}}],
+    "created":...,"model":...,"object":"response"}
+
+    compact 格式只发送增量文本，消息信息已在 message_start 中发送：
+    data: {"c":"..."} / data: {"r":"..."} / data: {"c":"...","r":"..."}
+    """
+
+    def __init__(
+        self,
+        model,
+        created=None,
+        object_type="response",
+        role="assistant",
+        backend=None,
+        stream_format=OPENAI_FORMAT,
+    ):
+        """
+        :param model: 模型名称
+        :param created: 创建时间戳，默认为流开始的时间
+        :param object_type: 对象类型
+        :param role: 增量的角色
+        :param backend: JSON 序列化方式，默认按 CHAT_SSE_JSON 配置
+        :param stream_format: 流式输出格式，openai（默认）或 compact
+        """
+        self.model = model
+        self.created = int(time.time()) if created is None else created
+        self.object_type = object_type
+        self.backend = backend or json_backend()
+        self.compact = stream_format == COMPACT_FORMAT
+        if self.backend == "orjson":
+            self.escape = _orjson_string
+        else:
+            # json.dumps 内部使用的 C 实现，转义结果与之一致
+            self.escape = encode_basestring_ascii
+        self._role = dumps(role, self.backend)
+        created = dumps(self.created, self.backend)
+        model = dumps(model, self.backend)
+        object_type = dumps(object_type, self.backend)
+        self._suffix = (
+            f'}}}}],"created":{created},"model":{model},"object":{object_type}}}\n\n'
+        )
+        # 增量ID -> 帧前缀，同一个输出项的增量共用
+        self._prefixes = {}
+
+    def _prefix(self, id):
+        prefix = self._prefixes.get(id)
+        if prefix is None:
+            prefix = (
+                f'data: {{"id":{dumps(id, self.backend)},"choices":[{{"index":0,'
+                f'"delta":{{"role":{self._role},"content":'
+            )
+            self._prefixes[id] = prefix
+        return prefix
+
+    def delta(self, id, content="", reasoning_content=""):
+        """
+        创建一个增量，供 SSEGenerator 发送或 ChunkCoalescer 合并
+        """
+        return Delta(self, id, content, reasoning_content)
+
+    def encode(self, id, content="", reasoning_content=""):
+        """
+        将一个增量编码为 SSE 帧（不带事件ID）
+        """
+        if self.compact:
+            return self._encode_compact(content, reasoning_content)
+        if reasoning_content:
+            return (
+                self._prefix(id)
+                + self.escape(content)
+                + ',"reasoning_content":'
+                + self.escape(reasoning_content)
+                + self._suffix
+            )
+        return self._prefix(id) + self.escape(content) + self._suffix
+
+    def _encode_compact(self, content, reasoning_content):
+        if not reasoning_content:
+            return 'data: {"c":' + self.escape(content) + "}\n\n"
+        if not content:
+            return 'data: {"r":' + self.escape(reasoning_content) + "}\n\n"
+        return (
+            'data: {"c":'
+            + self.escape(content)
+            + ',"r":'
+            + self.escape(reasoning_content)
+            + "}\n\n"
+        )
@@ -0,0 +1,475 @@
+import openai
+from asgiref.sync import sync_to_async
+
+from chat.accumulator import ReplyAccumulator
+from chat.cancellation import record_cancellation, record_completion
+from chat.catalog import model_catalog
+from chat.balancer import endpoint_balancer
+from chat.clients import upstream_clients
+from chat.context import (
+    CACHED,
+    cached_report,
+    prepare_input,
+    usable_previous_response_id,
+)
+from chat.encoder import OPENAI_FORMAT, ChunkEncoder
+from chat.response_cache import ResponseCache
+from chat.serializers import ChatSessionSerializer
+from chat.sse import SSEGenerator
+from chat.throttling import debit_tokens
+from utils import metrics
+
+# 深度思考模式，按请求中的 think_type 取值
+THINK_TYPES = ("disabled", "enabled", "auto")
+
+
+def get_previous_response_id(user_message):
+    """
+    获取上一轮AI回复的响应ID，用于多轮对话；上游已不再保存时返回 None，
+    由服务端组装上下文
+    """
+    return usable_previous_response_id(user_message)
+
+
+def build_response_config(
+    input_items, chat_model, think_type, previous_response_id, model=None
+):
+    """
+    创建 Response API 的配置
+
+    :param model: 请求上游时使用的模型名，默认为模型ID
+    """
+    response_config = {
+        "model": model or chat_model.model_id,
+        "input": input_items,
+        "stream": True,
+        "extra_body": {
+            "thinking": {"type": THINK_TYPES[think_type]},
+        },
+    }
+    if previous_response_id:
+        response_config["previous_response_id"] = previous_response_id
+    return response_config
+
+
+def is_expired_response_error(error):
+    """
+    判断上游是否因为 previous_response_id 已失效而拒绝请求
+    """
+    return isinstance(
+        error, (openai.NotFoundError, openai.BadRequestError)
+    ) and "previous_response" in str(error)
+
+
+def create_response(
+    client, user_message, chat_model, think_type, previous_response_id, model=None
+):
+    """
+    请求上游；previous_response_id 已失效时改为服务端组装上下文重试一次，
+    可缓存的首轮消息命中回复缓存时回放缓存，不请求上游
+
+    :return: (上游流式响应, 上下文报告, 回复记录器)，记录器为 None 时不写入缓存
+    """
+    cache = ResponseCache.for_request(
+        user_message, chat_model, think_type, previous_response_id
+    )
+    if cache is not None:
+        entry = cache.get()
+        if entry is not None:
+            return cache.replay(entry), cached_report(user_message, chat_model), None
+    input_items, context = prepare_input(user_message, chat_model, previous_response_id)
+    try:
+        res = client.responses.create(
+            **build_response_config(
+                input_items, chat_model, think_type, previous_response_id, model
+            )
+        )
+    except openai.APIStatusError as e:
+        if not previous_response_id or not is_expired_response_error(e):
+            raise
+        input_items, context = prepare_input(user_message, chat_model, None)
+        res = client.responses.create(
+            **build_response_config(input_items, chat_model, think_type, None, model)
+        )
+    return res, context, cache and cache.recorder()
+
+
+async def acreate_response(
+    client, user_message, chat_model, think_type, previous_response_id, model=None
+):
+    """
+    create_response 的异步版本
+    """
+    cache = ResponseCache.for_request(
+        user_message, chat_model, think_type, previous_response_id
+    )
+    if cache is not None:
+        entry = await sync_to_async(cache.get)()
+        if entry is not None:
+            report = await sync_to_async(cached_report)(user_message, chat_model)
+            return cache.replay(entry, use_async=True), report, None
+    input_items, context = await sync_to_async(prepare_input)(
+        user_message, chat_model, previous_response_id
+    )
+    try:
+        res = await client.responses.create(
+            **build_response_config(
+                input_items, chat_model, think_type, previous_response_id, model
+            )
+        )
+    except openai.APIStatusError as e:
+        if not previous_response_id or not is_expired_response_error(e):
+            raise
+        input_items, context = await sync_to_async(prepare_input)(
+            user_message, chat_model, None
+        )
+        res = await client.responses.create(
+            **build_response_config(input_items, chat_model, think_type, None, model)
+        )
+    return res, context, cache and cache.recorder()
+
+
+def open_response(user_message, chat_model, think_type, previous_response_id):
+    """
+    选择推理接入点并请求上游，接入点连接失败、限流或服务端错误时换一个接入点重试
+
+    :return: (上游流式响应, 上下文报告, 回复记录器, 选中的接入点)
+    """
+    tried = set()
+    while True:
+        route = endpoint_balancer.route(chat_model, exclude=tried)
+        try:
+            res, context, recorder = create_response(
+                upstream_clients.get_client(route.key),
+                user_message,
+                chat_model,
+                think_type,
+                previous_response_id,
+                route.model,
+            )
+        except BaseException as e:
+            route.finish(e)
+            tried.add(route.key)
+            if not endpoint_balancer.can_failover(chat_model, e, tried):
+                raise
+            metrics.incr("balancer.failover")
+            continue
+        if context["mode"] == CACHED:
+            route.release()
+        return res, context, recorder, route
+
+
+async def aopen_response(user_message, chat_model, think_type, previous_response_id):
+    """
+    open_response 的异步版本
+    """
+    tried = set()
+    while True:
+        route = endpoint_balancer.route(chat_model, exclude=tried)
+        try:
+            res, context, recorder = await acreate_response(
+                upstream_clients.get_async_client(route.key),
+                user_message,
+                chat_model,
+                think_type,
+                previous_response_id,
+                route.model,
+            )
+        except BaseException as e:
+            route.finish(e)
+            tried.add(route.key)
+            if not endpoint_balancer.can_failover(chat_model, e, tried):
+                raise
+            metrics.incr("balancer.failover")
+            continue
+        if context["mode"] == CACHED:
+            route.release()
+        return res, context, recorder, route
+
+
+def build_queued(position):
+    """
+    构造 queued 事件：等待上游并发名额时的排队位置
+    """
+    return {"type": "queued", "data": {"position": position}}
+
+
+def build_message_start(user_message, chat_session, chat_model, ai_message):
+    """
+    构造 message_start 事件：完整的消息结构（除了reasoning_content、content和tokens）
+    """
+    message_data = {
+        "id": ai_message.id,
+        "role": "assistant",
+        "reasoning_content": "",  # 将逐步更新
+        "content": "",  # 将逐步更新
+        "created_at": ai_message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "tokens": 0,  # 将逐步更新
+        "message_resp_id": None,  # 将在保存后更新
+        "session": ChatSessionSerializer(chat_session).data,
+        "model": model_catalog.serialize(chat_model),
+        # "session": {
+        #     "id": chat_session.id,
+        #     "title": chat_session.title,
+        #     "user": chat_session.user.id,
+        #     "updated_at": (
+        #         chat_session.updated_at.strftime("%Y-%m-%d %H:%M:%S")
+        #         if chat_session.updated_at
+        #         else None
+        #     ),
+        #     "is_active": chat_session.is_active,
+        #     "created_at": (
+        #         chat_session.created_at.strftime("%Y-%m-%d %H:%M:%S")
+        #         if chat_session.created_at
+        #         else None
+        #     ),
+        # },
+        # "model": {
+        #     "id": chat_model.id,
+        #     "name": chat_model.name,
+        #     "model_id": chat_model.model_id,
+        #     "description": chat_model.description,
+        #     "is_active": chat_model.is_active,
+        #     "ep_id": chat_model.ep_id,
+        # },
+        "parent_message": user_message.id,
+    }
+    return {"type": "message_start", "data": message_data}
+
+
+def handle_response_chunk(chunk, accumulator, chat_model, encoder):
+    """
+    处理一个上游流式事件：收集AI回复消息，并返回需要发送给客户端的数据块
+
+    :param chunk: Response API 的流式事件
+    :param accumulator: AI回复消息收集器
+    :param chat_model: 使用的模型
+    :param encoder: 当前流的 ChunkEncoder
+    :return: 需要发送的增量或数据字典，无需发送时返回 None
+    """
+    if not hasattr(chunk, "type"):
+        return None
+    # 获取AI回复ID
+    if accumulator.response_id == "" and chunk.type == "response.created":
+        accumulator.response_id = chunk.response.id
+        return None
+    # 收集AI回复消息
+    if chunk.type == "response.reasoning_summary_text.delta":
+        accumulator.append_reasoning(chunk.delta)
+        return encoder.delta(chunk.item_id, reasoning_content=chunk.delta)
+    elif chunk.type == "response.output_text.delta":
+        accumulator.append_content(chunk.delta)
+        return encoder.delta(chunk.item_id, content=chunk.delta)
+    # 统计token
+    if chunk.type == "response.completed":
+        accumulator.tokens = chunk.response.usage.total_tokens
+        accumulator.usage = chunk.response.usage
+        if encoder.compact:
+            return {"u": chunk.response.usage.total_tokens}
+        return SSEGenerator.create_chat_chunk(
+            id=chunk.response.id,
+            choices=[],
+            created=encoder.created,
+            usage=chunk.response.usage.total_tokens,
+            model=chat_model.model_id,
+        )
+    return None
+
+
+def build_message_end(ai_message, context=None):
+    """
+    构造 message_end 事件：在流的最后发送完整的AI消息数据
+
+    :param context: 本次请求的上下文报告，附带上游统计的输入token数
+    """
+    data = {
+        "id": ai_message.id,
+        "created_at": ai_message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "message_resp_id": ai_message.message_resp_id,
+        "tokens": ai_message.tokens,
+        "status": ai_message.status,
+    }
+    if context is not None:
+        data["context"] = context
+    return {"type": "message_end", "data": data}
+
+
+def finish_generation(chat_model, accumulator, status, cancelled):
+    """
+    提交最终的AI回复，并记录完成或取消的统计
+    """
+    ai_message = accumulator.finish(status)
+    if cancelled:
+        record_cancellation(chat_model, accumulator)
+    elif status == "complete":
+        record_completion(chat_model, accumulator)
+    return ai_message
+
+
+# 获取 Response API 的响应数据
+def generate_response_response(
+    user_message,
+    chat_session,
+    chat_model,
+    think_type,
+    previous_response_id,
+    cancel_token=None,
+    stream_format=OPENAI_FORMAT,
+    ticket=None,
+):
+    if ticket is not None:
+        # 等待上游并发名额，排队期间发送排队位置
+        for position in ticket.wait(cancel_token):
+            yield build_queued(position)
+        if not ticket.admitted:
+            # 排队期间收到停止请求
+            return
+    try:
+        res, context, recorder, route = open_response(
+            user_message, chat_model, think_type, previous_response_id
+        )
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+    if ticket is not None and context["mode"] == CACHED:
+        # 回放缓存不占用上游名额
+        ticket.release()
+
+    # 收集AI回复消息，并创建状态为生成中的消息行
+    accumulator = ReplyAccumulator()
+    ai_message = accumulator.start(user_message, chat_session, chat_model)
+
+    # 增量帧的固定部分在流开始时序列化一次
+    encoder = ChunkEncoder(chat_model.model_id, stream_format=stream_format)
+    status = "aborted"
+    error = None
+    try:
+        # 发送初始消息结构；此时断开同样会关闭上游流并释放名额
+        yield build_message_start(user_message, chat_session, chat_model, ai_message)
+        for chunk in res:
+            # 收到停止请求，不再读取上游
+            if cancel_token is not None and cancel_token.cancelled:
+                break
+            if recorder is not None:
+                recorder.record(chunk)
+            data = handle_response_chunk(chunk, accumulator, chat_model, encoder)
+            if data is not None:
+                # 首token耗时用于选择接入点
+                route.first_token()
+                yield data
+            # 定期写回检查点，进程崩溃时不会丢失整条回复
+            if accumulator.should_checkpoint():
+                accumulator.checkpoint()
+        else:
+            status = "complete"
+    except Exception as e:
+        error = e
+    finally:
+        # 关闭上游流，客户端断开（GeneratorExit）或停止生成后不再为无人接收的token付费
+        res.close()
+        route.finish(error)
+        if ticket is not None:
+            ticket.release()
+        # 保存AI回复消息；生成器被关闭时只保存不发送
+        ai_message = finish_generation(
+            chat_model,
+            accumulator,
+            status,
+            cancelled=error is None and status == "aborted",
+        )
+
+    # 只缓存完整生成的回复
+    if recorder is not None and status == "complete":
+        recorder.store()
+    # 回放缓存没有消耗上游token，不计入用户的token预算
+    if context["mode"] != CACHED:
+        debit_tokens(chat_session.user_id, ai_message.tokens)
+    context["upstream_input_tokens"] = ai_message.input_tokens
+    yield build_message_end(ai_message, context)
+    # 先发送 message_end，再由 SSEGenerator 发送错误信息
+    if error is not None:
+        raise error
+
+
+# 获取 Response API 的响应数据（异步版本）
+async def agenerate_response_response(
+    user_message,
+    chat_session,
+    chat_model,
+    think_type,
+    previous_response_id,
+    cancel_token=None,
+    stream_format=OPENAI_FORMAT,
+    ticket=None,
+):
+    if ticket is not None:
+        async for position in ticket.await_admission(cancel_token):
+            yield build_queued(position)
+        if not ticket.admitted:
+            return
+    try:
+        res, context, recorder, route = await aopen_response(
+            user_message, chat_model, think_type, previous_response_id
+        )
+    except BaseException:
+        if ticket is not None:
+            await ticket.arelease()
+        raise
+    if ticket is not None and context["mode"] == CACHED:
+        await ticket.arelease()
+
+    # 收集AI回复消息，并创建状态为生成中的消息行
+    accumulator = ReplyAccumulator()
+    ai_message = await sync_to_async(accumulator.start)(
+        user_message, chat_session, chat_model
+    )
+
+    # 增量帧的固定部分在流开始时序列化一次
+    encoder = ChunkEncoder(chat_model.model_id, stream_format=stream_format)
+    status = "aborted"
+    error = None
+    try:
+        # 发送初始消息结构；此时断开同样会关闭上游流并释放名额
+        yield build_message_start(user_message, chat_session, chat_model, ai_message)
+        async for chunk in res:
+            # 收到停止请求，不再读取上游
+            if cancel_token is not None and cancel_token.cancelled:
+                break
+            if recorder is not None:
+                recorder.record(chunk)
+            data = handle_response_chunk(chunk, accumulator, chat_model, encoder)
+            if data is not None:
+                # 首token耗时用于选择接入点
+                route.first_token()
+                yield data
+            # 定期写回检查点，进程崩溃时不会丢失整条回复
+            if accumulator.should_checkpoint():
+                await sync_to_async(accumulator.checkpoint)()
+        else:
+            status = "complete"
+    except Exception as e:
+        error = e
+    finally:
+        # 关闭上游流；异步生成器在 finally 中不能 yield，
+        # 连接断开（GeneratorExit/CancelledError）时只保存不发送
+        await res.close()
+        route.finish(error)
+        if ticket is not None:
+            await ticket.arelease()
+        ai_message = await sync_to_async(finish_generation)(
+            chat_model,
+            accumulator,
+            status,
+            cancelled=error is None and status == "aborted",
+        )
+
+    if recorder is not None and status == "complete":
+        await sync_to_async(recorder.store)()
+    if context["mode"] != CACHED:
+        await sync_to_async(debit_tokens)(chat_session.user_id, ai_message.tokens)
+    context["upstream_input_tokens"] = ai_message.input_tokens
+    yield build_message_end(ai_message, context)
+    # 与同步版本一致：先发送 message_end，再由 AsyncSSEGenerator 发送错误信息
+    if error is not None:
+        raise error
@@ -0,0 +1,383 @@
+import json
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from chat.models import ChatModel
+from chat.serializers import ChatMessageSerializer, ChatSessionSerializer
+from utils import metrics
+from utils.response import StandardResponse
+
+logger = logging.getLogger(__name__)
+
+# 默认的消息历史缓存配置，可在 settings.CHAT_HISTORY_CACHE 中覆盖
+DEFAULT_HISTORY_CACHE = {
+    # 是否缓存会话的消息历史
+    "ENABLED": True,
+    # 单个会话最多缓存的消息数，超过后只缓存最新的消息
+    "MAX_MESSAGES": 200,
+    # 缓存的最大字节数，超过后只缓存放得下的最新消息
+    "MAX_BYTES": 512 * 1024,
+    # 过期时间，单位秒，每次命中时刷新；配合 Redis 的 volatile-lru 淘汰策略，
+    # 内存不足时优先淘汰最久未读取的会话
+    "TTL": 3600,
+    # 并发写入冲突时的重试次数
+    "WRITE_RETRIES": 3,
+}
+
+# 会话的消息历史：{"session": 会话数据, "messages": [消息数据], "complete": 是否包含全部消息}，
+# 消息中的 session / model 只保存ID，读取时再组装；超出容量时只保存最新的消息，
+# complete 为 False
+HISTORY_KEY = "chat:history:{session_id}"
+# 会话消息历史的写入代数，每次写入递增；读取未命中后回填时若代数已变化则放弃回填，
+# 避免覆盖期间提交的写入
+GENERATION_KEY = "chat:history:{session_id}:gen"
+
+
+def history_cache_config():
+    """
+    获取消息历史缓存配置
+    """
+    return {**DEFAULT_HISTORY_CACHE, **getattr(settings, "CHAT_HISTORY_CACHE", {})}
+
+
+def serialize_messages(messages):
+    """
+    序列化消息，session / model 只保存ID；_created_at 保存完整精度的创建时间，
+    用于排序与判断分页游标是否落在缓存范围内，返回前去掉
+    """
+    fields = set(ChatMessageSerializer().fields) - {"session", "model"}
+    serialized = ChatMessageSerializer(
+        messages, many=True, context={"fields": fields}
+    ).data
+    result = []
+    for message, data in zip(messages, serialized):
+        data = dict(data)
+        data["session"] = message.session_id
+        data["model"] = message.model_id
+        data["_created_at"] = message.created_at.isoformat()
+        result.append(data)
+    return result
+
+
+def _sort_key(data):
+    return datetime.fromisoformat(data["_created_at"]), data["id"]
+
+
+class HistoryCache:
+    """
+    会话消息历史的 Redis 读穿透缓存
+
+    缓存按会话保存最新的 MAX_MESSAGES 条消息，读取未命中时从数据库回填；
+    消息或会话保存后写穿透更新缓存，会话删除后删除缓存
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.key = HISTORY_KEY.format(session_id=session_id)
+        self.generation_key = GENERATION_KEY.format(session_id=session_id)
+        self.config = history_cache_config()
+        self.connection = get_redis_connection("default")
+
+    def generation(self):
+        return int(self.connection.get(self.generation_key) or 0)
+
+    @staticmethod
+    def _loads(raw):
+        entry = json.loads(raw)
+        # 没有 complete 的是之前版本写入的缓存，按未命中处理
+        return entry if "complete" in entry else None
+
+    def get(self):
+        """
+        :return: 缓存的 {"session", "messages", "complete"}，未命中时返回 None
+        """
+        raw = self.connection.get(self.key)
+        if raw is None:
+            return None
+        self.connection.expire(self.key, self.config["TTL"])
+        return self._loads(raw)
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def _dumps(self, entry):
+        """
+        :return: 序列化后的缓存，超出容量时只保留最新的消息；为 None 时返回 None
+        """
+        if entry is None:
+            return None
+        messages = entry["messages"]
+        if len(messages) > self.config["MAX_MESSAGES"]:
+            messages = messages[-self.config["MAX_MESSAGES"] :]
+            entry = {**entry, "messages": messages, "complete": False}
+        payload = self._encode(entry)
+        if len(payload.encode()) <= self.config["MAX_BYTES"]:
+            return payload
+        # 从最新的消息向前保留放得下的部分
+        budget = self.config["MAX_BYTES"] - len(
+            self._encode({**entry, "messages": []}).encode()
+        )
+        kept = 0
+        for message in reversed(messages):
+            # 加上分隔的逗号
+            budget -= len(self._encode(message).encode()) + 1
+            if budget < 0:
+                break
+            kept += 1
+        if not kept:
+            return None
+        return self._encode({**entry, "messages": messages[-kept:], "complete": False})
+
+    def fill(self, generation, entry):
+        """
+        回填缓存；读取数据库之后代数发生变化（期间有写入）时放弃
+
+        :param generation: 读取数据库之前的代数
+        """
+        payload = self._dumps(entry)
+        if payload is None:
+            return
+        try:
+            with self.connection.pipeline() as pipeline:
+                pipeline.watch(self.generation_key)
+                if int(pipeline.get(self.generation_key) or 0) != generation:
+                    return
+                pipeline.multi()
+                pipeline.set(self.key, payload, ex=self.config["TTL"])
+                pipeline.execute()
+        except WatchError:
+            pass
+
+    def update(self, change):
+        """
+        写穿透：在缓存上应用变更并递增代数，缓存不存在时只递增代数
+
+        :param change: 函数，接收缓存并返回修改后的缓存，返回 None 时删除缓存
+        """
+        ttl = self.config["TTL"]
+        for _ in range(self.config["WRITE_RETRIES"]):
+            try:
+                with self.connection.pipeline() as pipeline:
+                    pipeline.watch(self.key)
+                    raw = pipeline.get(self.key)
+                    payload = None
+                    entry = self._loads(raw) if raw is not None else None
+                    if entry is not None:
+                        payload = self._dumps(change(entry))
+                    pipeline.multi()
+                    pipeline.incr(self.generation_key)
+                    pipeline.expire(self.generation_key, ttl)
+                    if payload is None:
+                        pipeline.delete(self.key)
+                    else:
+                        pipeline.set(self.key, payload, ex=ttl)
+                    pipeline.execute()
+                    return
+            except WatchError:
+                continue
+        self.invalidate()
+
+    def invalidate(self):
+        pipeline = self.connection.pipeline()
+        pipeline.incr(self.generation_key)
+        pipeline.expire(self.generation_key, self.config["TTL"])
+        pipeline.delete(self.key)
+        pipeline.execute()
+
+
+def _on_commit(session_id, change):
+    """
+    事务提交后更新缓存，Redis 不可用时忽略（缓存会在过期后重建）
+    """
+
+    def apply():
+        if not history_cache_config()["ENABLED"]:
+            return
+        try:
+            HistoryCache(session_id).update(change)
+        except Exception:
+            logger.exception("更新消息历史缓存失败: %s", session_id)
+
+    transaction.on_commit(apply)
+
+
+def write_message(message):
+    """
+    消息保存后写入缓存，已存在时替换
+    """
+    (data,) = serialize_messages([message])
+
+    def change(entry):
+        messages = [item for item in entry["messages"] if item["id"] != data["id"]]
+        # 只缓存了最新的消息时，不插入缓存范围之前的消息
+        if (
+            len(messages) == len(entry["messages"])
+            and not entry["complete"]
+            and messages
+            and _sort_key(data) < _sort_key(messages[0])
+        ):
+            return entry
+        messages.append(data)
+        messages.sort(key=_sort_key)
+        entry["messages"] = messages
+        return entry
+
+    _on_commit(message.session_id, change)
+
+
+def message_saved(instance, **kwargs):
+    """
+    作为 ChatMessage 的 post_save 信号处理函数；AI回复通过 QuerySet.update 写入，
+    由 ReplyAccumulator 在生成结束时直接调用 write_message
+    """
+    write_message(instance)
+
+
+def session_saved(instance, **kwargs):
+    """
+    会话保存后更新缓存中的会话数据，作为 ChatSession 的 post_save 信号处理函数
+    """
+    data = dict(ChatSessionSerializer(instance).data)
+
+    def change(entry):
+        entry["session"] = data
+        return entry
+
+    _on_commit(instance.id, change)
+
+
+def session_deleted(instance, **kwargs):
+    """
+    会话删除后删除缓存，作为 ChatSession 的 post_delete 信号处理函数
+    """
+    _on_commit(instance.id, lambda entry: None)
+
+
+def _model_data(model_id):
+    from chat.catalog import model_catalog
+
+    try:
+        return model_catalog.data(model_id)
+    except ChatModel.DoesNotExist:
+        # 模型已删除，数据库中的外键已置空
+        return model_catalog.data(None)
+
+
+def expand_history(entry):
+    """
+    组装缓存的消息历史，与 ChatMessageSerializer 的完整输出一致
+    """
+    session = entry["session"]
+    models = {}
+    messages = []
+    for item in entry["messages"]:
+        data = dict(item)
+        data.pop("_created_at", None)
+        model_id = data["model"]
+        if model_id not in models:
+            models[model_id] = _model_data(model_id)
+        data["session"] = session
+        data["model"] = dict(models[model_id])
+        messages.append(data)
+    return messages
+
+
+class HistoryCacheMixin:
+    """
+    GET /chat/message/?session_id= 的读穿透缓存
+
+    处理不带其他查询参数的完整列表与按 cursor 读取的下一页：完整列表只在缓存包含
+    全部消息时命中，下一页只在游标落在缓存的最新消息范围内时命中；增量同步、
+    首页分页、字段集与精简模式仍查询数据库
+    """
+
+    def get_cached_session_id(self, request):
+        params = request.query_params
+        session_id = params.get("session_id", "")
+        if not session_id.isdigit():
+            return None
+        if set(params) == {"session_id"}:
+            return int(session_id)
+        # 只有下一页可以从缓存读取，首页需要数据库中的同步位置
+        if "cursor" in params and set(params) <= {"session_id", "cursor", "limit"}:
+            return int(session_id)
+        return None
+
+    def get_cached_window(self, request, entry):
+        """
+        从缓存中取出请求的消息
+
+        :return: 响应，缓存不包含请求的范围时返回 None
+        """
+        messages = entry["messages"]
+        cursor = request.query_params.get("cursor")
+        if cursor is None:
+            if not entry["complete"]:
+                return None
+            return StandardResponse(data=expand_history(entry))
+
+        paginator = self.paginator
+        mode, *key = paginator.decode_cursor(cursor)
+        if mode != "page":
+            return None
+        key = tuple(key)
+        # 缓存不完整时，游标之后的消息必须都在缓存中
+        if not entry["complete"] and (not messages or key < _sort_key(messages[0])):
+            return None
+        limit = paginator.get_limit(request)
+        rows = [item for item in messages if _sort_key(item) > key][: limit + 1]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = paginator.encode_cursor("page", *_sort_key(rows[-1]))
+        return StandardResponse(
+            data=expand_history({**entry, "messages": rows}),
+            next_cursor=next_cursor,
+            sync_cursor=None,
+        )
+
+    def list(self, request, *args, **kwargs):
+        session_id = None
+        if history_cache_config()["ENABLED"]:
+            session_id = self.get_cached_session_id(request)
+        if session_id is None:
+            return super().list(request, *args, **kwargs)
+
+        try:
+            cache = HistoryCache(session_id)
+            entry = cache.get()
+            generation = cache.generation() if entry is None else None
+        except Exception:
+            logger.exception("读取消息历史缓存失败: %s", session_id)
+            return super().list(request, *args, **kwargs)
+
+        if entry is not None and entry["session"]["user"] == request.user.pk:
+            response = self.get_cached_window(request, entry)
+            if response is not None:
+                metrics.incr("chat.history_cache.hit")
+                return response
+
+        metrics.incr("chat.history_cache.miss")
+        # 只有完整列表在未命中时回填，下一页直接查询数据库
+        if "cursor" in request.query_params:
+            return super().list(request, *args, **kwargs)
+        messages = list(self.filter_queryset(self.get_queryset()))
+        if not messages:
+            return StandardResponse(data=[])
+        entry = {
+            "session": dict(ChatSessionSerializer(messages[0].session).data),
+            "messages": serialize_messages(messages),
+            "complete": True,
+        }
+        if generation is not None:
+            try:
+                cache.fill(generation, entry)
+            except Exception:
+                logger.exception("回填消息历史缓存失败: %s", session_id)
+        return StandardResponse(data=expand_history(entry))
@@ -0,0 +1,243 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from chat.admission import AdmissionTicket
+from chat.cancellation import cancellation, clear_cancel
+from chat.catalog import model_catalog
+from chat.encoder import OPENAI_FORMAT
+from chat.generation import generate_response_response, get_previous_response_id
+from chat.models import ChatMessage, ChatModel
+from chat.singleflight import QUEUED, RUNNING, GenerationFlight
+from chat.sse import ChunkCoalescer, SSEGenerator
+from chat.stream_buffer import StreamBuffer, stream_buffer_config
+
+logger = logging.getLogger(__name__)
+
+# 待处理的生成任务队列
+JOBS_KEY = "chat:jobs"
+# 工作进程正在执行的任务列表，任务完成后移除；工作进程异常退出时重新入队
+PROCESSING_KEY = "chat:jobs:processing:{worker_id}"
+# 工作进程的心跳，过期后其正在执行的任务视为已中断
+WORKER_KEY = "chat:jobs:worker:{worker_id}"
+
+
+def use_generation_worker():
+    """
+    判断是否由后台工作进程生成AI回复
+
+    CHAT_GENERATION_MODE 为 "worker" 且启用了 SSE 帧缓冲时，HTTP 请求只负责转发，
+    否则在请求内生成（"inline"，默认）
+    """
+    return (
+        getattr(settings, "CHAT_GENERATION_MODE", "inline") == "worker"
+        and stream_buffer_config()["ENABLED"]
+    )
+
+
+def enqueue_generation(
+    user_message_id,
+    think_type,
+    coalesce_ms=None,
+    stream_format=OPENAI_FORMAT,
+    regenerate=False,
+):
+    """
+    将生成任务加入队列，同一条用户消息只会入队一次
+
+    :param user_message_id: 用户消息ID
+    :param think_type: 深度思考模式
+    :param coalesce_ms: 增量合并的时间窗口，不传时使用部署配置
+    :param stream_format: 流式输出格式，写入缓冲的帧使用该格式
+    :param regenerate: 是否重新生成已完成的回复
+    :return: 是否新入队，已在排队、生成中或已完成时返回 False
+    """
+    flight = GenerationFlight(user_message_id)
+    if not flight.claim(QUEUED, regenerate=regenerate):
+        return False
+    # 先清空已结束的生成留下的流，之后订阅的请求只会读到新的流
+    if flight.replaces_stream:
+        StreamBuffer(user_message_id).reset()
+    clear_cancel(user_message_id)
+    get_redis_connection("default").lpush(
+        JOBS_KEY,
+        json.dumps(
+            {
+                "user_message_id": user_message_id,
+                "think_type": think_type,
+                "coalesce_ms": coalesce_ms,
+                "stream_format": stream_format,
+                "flight": flight.token,
+                "enqueued_at": time.time(),
+            }
+        ),
+    )
+    return True
+
+
+def run_generation_job(job):
+    """
+    执行一个生成任务：驱动上游流式响应，并把每一帧写入 SSE 帧缓冲
+
+    AI回复由生成器自行保存，即使没有客户端在接收也会完整落库
+    """
+    user_message_id = job["user_message_id"]
+    flight = GenerationFlight(user_message_id, token=job.get("flight"))
+    try:
+        user_message = ChatMessage.objects.select_related(
+            "session", "parent_message"
+        ).get(id=user_message_id, role="user")
+    except ChatMessage.DoesNotExist:
+        logger.warning("生成任务的用户消息不存在: %s", user_message_id)
+        flight.release()
+        return
+
+    # 排队期间登记过期并被新的请求替换时，由新的任务生成
+    if not flight.start():
+        logger.info("生成任务的登记已被替换，跳过: %s", user_message_id)
+        return
+    buffer = StreamBuffer(user_message.id)
+    if flight.previous == RUNNING:
+        # 工作进程异常退出后重新入队的任务：之前的执行已中断，
+        # 清空其写入的帧，并将其未完成的AI回复标记为已中断
+        logger.warning("重新执行中断的生成任务: %s", user_message_id)
+        buffer.reset()
+        ChatMessage.objects.filter(
+            parent_message=user_message, role="assistant", status="streaming"
+        ).update(status="aborted", updated_at=timezone.now())
+
+    try:
+        chat_model = model_catalog.get(id=user_message.model_id)
+    except ChatModel.DoesNotExist:
+        # 模型已删除：写入错误帧并结束流，订阅的请求随之结束
+        logger.warning("生成任务的模型不存在: %s", user_message_id)
+        buffer.append(SSEGenerator.format_error("当前模型不存在"))
+        buffer.close()
+        flight.finish(failed=True)
+        return
+
+    # 排队期间收到的停止请求会使取消标记直接生效
+    cancel_token = cancellation.register(user_message.id)
+    sse_response = SSEGenerator(
+        generate_response_response(
+            user_message,
+            user_message.session,
+            chat_model,
+            job["think_type"],
+            get_previous_response_id(user_message),
+            cancel_token=cancel_token,
+            stream_format=job.get("stream_format", OPENAI_FORMAT),
+            ticket=AdmissionTicket.for_request(
+                user_message.session.user_id, chat_model
+            ),
+        ),
+        buffer=buffer,
+        cancel_token=cancel_token,
+        coalescer=ChunkCoalescer.from_request(job.get("coalesce_ms")),
+        flight=flight,
+    )
+    # 消费全部帧，帧由 SSEGenerator 写入缓冲，由订阅的 HTTP 请求转发
+    for _ in sse_response:
+        pass
+
+
+def _run_job_safely(conn, processing_key, item, slots):
+    try:
+        run_generation_job(json.loads(item))
+    except Exception:
+        logger.exception("生成任务执行失败: %s", item)
+    finally:
+        close_old_connections()
+        slots.release()
+        # 任务完成，从正在执行的列表中移除
+        try:
+            conn.lrem(processing_key, 1, item)
+        except Exception:
+            logger.exception("移除已完成的生成任务失败: %s", item)
+
+
+def requeue_stale_jobs(conn):
+    """
+    将心跳已过期的工作进程正在执行的任务重新入队，由工作进程启动时及之后定期调用
+
+    :return: 重新入队的任务数
+    """
+    requeued = 0
+    prefix = PROCESSING_KEY.format(worker_id="")
+    for key in conn.scan_iter(match=f"{prefix}*", count=100):
+        worker_id = key.decode()[len(prefix) :]
+        if conn.exists(WORKER_KEY.format(worker_id=worker_id)):
+            continue
+        # 从最新的任务开始放回队列的出队端，优先于新任务并保持原有顺序执行
+        while conn.lmove(key, JOBS_KEY, "LEFT", "RIGHT") is not None:
+            requeued += 1
+    if requeued:
+        logger.warning("重新入队 %s 个中断的生成任务", requeued)
+    return requeued
+
+
+def run_worker(concurrency=8, stop_event=None, block_timeout=5, reap_interval=None):
+    """
+    生成工作进程的主循环：从队列中取出任务，在线程池中并发执行
+
+    任务取出时原子地移入本进程的执行列表，完成后移除；进程异常退出或被回收时，
+    其心跳过期后由仍在运行的工作进程定期将执行列表中的任务重新入队
+
+    :param concurrency: 单个进程同时执行的生成任务数
+    :param stop_event: 设置后停止取新任务，并等待进行中的任务完成
+    :param block_timeout: 每次阻塞等待新任务的时间，单位秒
+    :param reap_interval: 检查中断任务的间隔，单位秒，默认为心跳的有效期
+    """
+    stop_event = stop_event or threading.Event()
+    conn = get_redis_connection("default")
+    worker_id = uuid.uuid4().hex
+    processing_key = PROCESSING_KEY.format(worker_id=worker_id)
+    worker_key = WORKER_KEY.format(worker_id=worker_id)
+    # 主循环至少每 block_timeout 秒刷新一次心跳
+    heartbeat_ttl = max(block_timeout * 3, 30)
+    if reap_interval is None:
+        # 异常退出的工作进程被立即重新拉起时，其心跳仍然有效，启动时不会重新入队；
+        # 按心跳的有效期定期检查，中断的任务最迟在心跳过期后一个间隔内重新执行
+        reap_interval = heartbeat_ttl
+    reap_at = 0
+    slots = threading.BoundedSemaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while not stop_event.is_set():
+            try:
+                conn.set(worker_key, 1, ex=heartbeat_ttl)
+            except Exception:
+                logger.exception("刷新工作进程心跳失败")
+            if time.monotonic() >= reap_at:
+                reap_at = time.monotonic() + reap_interval
+                try:
+                    requeue_stale_jobs(conn)
+                except Exception:
+                    logger.exception("重新入队中断的生成任务失败")
+            # 有空闲线程时才取任务，其余任务留在队列中由其他工作进程处理
+            if not slots.acquire(timeout=block_timeout):
+                continue
+            try:
+                item = conn.blmove(
+                    JOBS_KEY, processing_key, block_timeout, "RIGHT", "LEFT"
+                )
+            except Exception:
+                logger.exception("读取生成任务队列失败")
+                item = None
+                time.sleep(block_timeout)
+            if item is None:
+                slots.release()
+                continue
+            executor.submit(_run_job_safely, conn, processing_key, item, slots)
+    # 进行中的任务已全部完成
+    try:
+        conn.delete(worker_key)
+    except Exception:
+        logger.exception("删除工作进程心跳失败")
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    """
+    一项需要定期续期的登记
+    """
+
+    def __init__(self, renew, interval):
+        """
+        :param renew: 续期函数，在续期线程中调用
+        :param interval: 续期间隔，单位秒
+        """
+        self.renew = renew
+        self.interval = interval
+        self.due = time.monotonic() + interval
+
+
+class LeaseKeeper:
+    """
+    进程内的续期线程
+
+    生成期间在 Redis 中登记的状态（同一条用户消息的生成登记、上游并发名额）都带有
+    过期时间，进程异常退出后自动释放；生成期间由后台线程按固定间隔续期，
+    与是否收到上游数据无关，长时间没有输出的阶段也不会丢失登记
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._leases = set()
+        self._thread = None
+
+    def register(self, renew, interval):
+        """
+        登记续期，首次登记时启动后台线程
+
+        :return: Lease，生成结束后传给 unregister
+        """
+        lease = Lease(renew, interval)
+        with self._lock:
+            self._leases.add(lease)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-lease-keeper", daemon=True
+                )
+                self._thread.start()
+        self._wakeup.set()
+        return lease
+
+    def unregister(self, lease):
+        with self._lock:
+            self._leases.discard(lease)
+
+    def _due(self):
+        """
+        取出到期的续期，并返回距下一次到期的秒数
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [lease for lease in self._leases if lease.due <= now]
+            for lease in due:
+                lease.due = now + lease.interval
+            timeout = min((lease.due - now for lease in self._leases), default=None)
+        return due, timeout
+
+    def _run(self):
+        while True:
+            # 先清除唤醒标记，之后登记的续期一定会被本轮或下一轮看到
+            self._wakeup.clear()
+            due, timeout = self._due()
+            for lease in due:
+                try:
+                    lease.renew()
+                except Exception:
+                    logger.exception("续期失败")
+            self._wakeup.wait(timeout)
+
+
+lease_keeper = LeaseKeeper()
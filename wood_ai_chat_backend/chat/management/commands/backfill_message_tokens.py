@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatMessage
+from chat.tokens import count_tokens, get_encoding
+
+TOKEN_FIELDS = ["input_tokens", "output_tokens", "reasoning_tokens", "content_tokens"]
+
+
+class Command(BaseCommand):
+    help = (
+        "为尚未计算token数的历史消息补充 input / output / reasoning / content token数"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="每批处理的消息数"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=0, help="最多处理的消息数，为 0 时处理全部"
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        limit = options["limit"]
+        backend = "tiktoken" if get_encoding() is not None else "estimate"
+        self.stdout.write(f"分词方式：{backend}")
+
+        total = 0
+        last_id = 0
+        while not limit or total < limit:
+            size = min(batch_size, limit - total) if limit else batch_size
+            # 按主键分批，已处理的消息 content_tokens 不再为空
+            messages = list(
+                ChatMessage.objects.filter(content_tokens__isnull=True, id__gt=last_id)
+                .order_by("id")
+                .only("id", "role", "content", "reasoning_content", "tokens")[:size]
+            )
+            if not messages:
+                break
+            for message in messages:
+                self.count(message)
+            ChatMessage.objects.bulk_update(messages, TOKEN_FIELDS)
+            total += len(messages)
+            last_id = messages[-1].id
+            self.stdout.write(f"已处理 {total} 条消息")
+
+        self.stdout.write(self.style.SUCCESS(f"完成，共处理 {total} 条消息"))
+
+    @staticmethod
+    def count(message):
+        """
+        历史AI回复没有上游用量的拆分：输出token数取内容与推理内容之和，
+        输入token数取总用量减去输出
+        """
+        message.content_tokens = count_tokens(message.content)
+        message.reasoning_tokens = count_tokens(message.reasoning_content)
+        if message.role == "assistant":
+            message.output_tokens = message.content_tokens + message.reasoning_tokens
+            message.input_tokens = max(message.tokens - message.output_tokens, 0)
+        else:
+            message.input_tokens = message.content_tokens
+            message.output_tokens = 0
@@ -0,0 +1,152 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.compression import StreamCompressor, available_encodings
+from chat.encoder import COMPACT_FORMAT, ChunkEncoder, orjson
+from chat.sse import Choice, SSEGenerator
+from chat.stream_buffer import format_frame
+
+# 基准测试使用的增量文本，覆盖中文、ASCII 与需要转义的字符
+SAMPLE_DELTAS = ["你好", "，", "world", " the", "\n\n", '"quoted"', "😀", "模型"]
+
+
+def legacy_frame(item_id, model, created, content="", reasoning_content=""):
+    """
+    逐个增量构造 Choice 与数据字典再 json.dumps 的编码方式，作为对照
+    """
+    return SSEGenerator.format_event(
+        SSEGenerator.create_chat_chunk(
+            id=item_id,
+            choices=[
+                Choice(
+                    content=content,
+                    role="assistant",
+                    reasoning_content=reasoning_content,
+                ).to_dict()
+            ],
+            created=created,
+            model=model,
+        )
+    )
+
+
+class Command(BaseCommand):
+    help = "SSE 增量帧编码与压缩的微基准测试，输出单核每秒处理的帧数与压缩率"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--frames", type=int, default=200000, help="每种编码方式编码的帧数"
+        )
+        parser.add_argument(
+            "--compress-frames",
+            type=int,
+            default=20000,
+            help="压缩测试使用的帧数",
+        )
+        parser.add_argument(
+            "--model", default="doubao-seed-1-6-250615", help="帧中的模型名称"
+        )
+
+    def handle(self, *args, **options):
+        frames = options["frames"]
+        model = options["model"]
+        item_id = "msg_0217512345678901234567890abcdef"
+        created = int(time.time())
+        deltas = [SAMPLE_DELTAS[i % len(SAMPLE_DELTAS)] for i in range(frames)]
+
+        encoder = ChunkEncoder(model, created=created, backend="json")
+        # 默认编码方式必须与原有帧逐字节一致
+        for delta in SAMPLE_DELTAS:
+            for content, reasoning in ((delta, ""), ("", delta)):
+                expected = legacy_frame(item_id, model, created, content, reasoning)
+                actual = encoder.encode(item_id, content, reasoning)
+                if actual != expected:
+                    raise CommandError(f"编码结果不一致:\n{expected!r}\n{actual!r}")
+
+        cases = [
+            (
+                "legacy",
+                lambda text: legacy_frame(item_id, model, created, content=text),
+            ),
+            (
+                "encoder",
+                lambda text: SSEGenerator.format_event(
+                    encoder.delta(item_id, content=text)
+                ),
+            ),
+        ]
+        compact_encoder = ChunkEncoder(
+            model, created=created, backend="json", stream_format=COMPACT_FORMAT
+        )
+        cases.append(
+            (
+                "compact",
+                lambda text: SSEGenerator.format_event(
+                    compact_encoder.delta(item_id, content=text)
+                ),
+            )
+        )
+        if orjson is not None:
+            fast_encoder = ChunkEncoder(model, created=created, backend="orjson")
+            cases.append(
+                (
+                    "encoder (orjson)",
+                    lambda text: SSEGenerator.format_event(
+                        fast_encoder.delta(item_id, content=text)
+                    ),
+                )
+            )
+
+        baseline = None
+        for name, encode in cases:
+            size = 0
+            start = time.perf_counter()
+            for text in deltas:
+                size += len(encode(text))
+            elapsed = time.perf_counter() - start
+            rate = frames / elapsed
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{name:<18} {rate:>12,.0f} 帧/秒  "
+                f"{size / frames:>6.1f} 字符/帧  x{rate / baseline:.2f}"
+            )
+
+        self.stdout.write("")
+        self.compression_benchmark(
+            [
+                ("openai", encoder),
+                ("compact", compact_encoder),
+            ],
+            item_id,
+            deltas[: options["compress_frames"]],
+        )
+
+    def compression_benchmark(self, encoders, item_id, deltas):
+        """
+        逐帧 sync flush 压缩带事件ID的帧，对比压缩前后的字节数与每帧耗时
+        """
+        encodings = available_encodings()
+        if not encodings:
+            self.stdout.write("没有可用的压缩编码")
+            return
+        for format_name, encoder in encoders:
+            frames = [
+                format_frame(index, encoder.encode(item_id, content=text)).encode()
+                for index, text in enumerate(deltas, start=1)
+            ]
+            raw = sum(len(frame) for frame in frames)
+            for encoding in encodings:
+                compressor = StreamCompressor(encoding)
+                size = 0
+                start = time.perf_counter()
+                for frame in frames:
+                    size += len(compressor.compress(frame))
+                size += len(compressor.finish())
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f"{format_name:<8} {encoding:<8} "
+                    f"{raw / len(frames):>7.1f} -> {size / len(frames):>6.1f} 字节/帧  "
+                    f"节省 {1 - size / raw:>6.1%}  "
+                    f"{elapsed / len(frames) * 1e6:>6.2f} 微秒/帧"
+                )
@@ -0,0 +1,295 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from django.test import RequestFactory
+from django.test.utils import setup_databases, teardown_databases
+from rest_framework.request import Request
+
+from chat.models import ChatMessage, ChatModel, ChatSession, ChatTombstone
+from chat.views import ChatMessageView, ChatSessionView
+from users.models import User
+from utils.pagination import MessageKeysetPagination, SessionKeysetPagination
+
+
+def view_queryset(view_class, user, action, **query):
+    """
+    按视图的 get_queryset 构造查询集，与接口实际执行的查询保持一致
+    """
+    request = Request(RequestFactory().get("/", query))
+    request.user = user
+    view = view_class()
+    view.request = request
+    view.action = action
+    view.args = ()
+    view.kwargs = {}
+    view.format_kwarg = None
+    return view.get_queryset()
+
+
+def explain_mysql(sql, params):
+    """
+    :return: [(表名, 访问方式, 使用的索引, 问题)]
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN {sql}", params)
+        columns = [column[0].lower() for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    plan = []
+    for row in rows:
+        extra = row.get("extra") or ""
+        problems = []
+        # ALL 为全表扫描，index 为全索引扫描
+        if row.get("type") in ("ALL", "index"):
+            problems.append("full scan")
+        if "filesort" in extra or "temporary" in extra:
+            problems.append("filesort")
+        plan.append((row.get("table"), row.get("type"), row.get("key"), problems))
+    return plan
+
+
+def explain_sqlite(sql, params):
+    """
+    :return: [(表名, 访问方式, 使用的索引, 问题)]
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        rows = cursor.fetchall()
+    plan = []
+    for row in rows:
+        detail = row[-1]
+        problems = []
+        if detail.startswith("SCAN"):
+            problems.append("full scan")
+        if "TEMP B-TREE" in detail:
+            problems.append("filesort")
+        plan.append((None, detail, None, problems))
+    return plan
+
+
+EXPLAINERS = {
+    "mysql": explain_mysql,
+    "sqlite": explain_sqlite,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "在测试数据库中生成种子数据，对聊天接口的查询执行 EXPLAIN，"
+        "出现全表扫描或文件排序时失败"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="种子用户数")
+        parser.add_argument("--sessions", type=int, default=50, help="每个用户的会话数")
+        parser.add_argument("--messages", type=int, default=20, help="每个会话的消息数")
+        parser.add_argument(
+            "--keepdb", action="store_true", help="保留测试数据库，便于重复执行"
+        )
+
+    def handle(self, *args, **options):
+        explain = EXPLAINERS.get(connection.vendor)
+        if explain is None:
+            raise CommandError(f"不支持的数据库: {connection.vendor}")
+
+        verbosity = options["verbosity"]
+        old_config = setup_databases(
+            verbosity, interactive=False, keepdb=options["keepdb"], aliases={"default"}
+        )
+        try:
+            user, chat_session, user_message = self.seed(
+                options["users"], options["sessions"], options["messages"]
+            )
+            failures = self.check_queries(explain, user, chat_session, user_message)
+        finally:
+            teardown_databases(old_config, verbosity, keepdb=options["keepdb"])
+
+        if failures:
+            raise CommandError(f"{failures} 个查询出现全表扫描或文件排序")
+        self.stdout.write(self.style.SUCCESS("所有查询均使用索引"))
+
+    def seed(self, users, sessions, messages):
+        """
+        生成种子数据并更新表的统计信息
+
+        :return: 用于查询的 (用户, 会话, 用户消息)
+        """
+        ChatMessage.objects.all().delete()
+        ChatSession.objects.all().delete()
+        ChatTombstone.objects.all().delete()
+        chat_model, _ = ChatModel.objects.get_or_create(
+            model_id="explain-model", defaults={"name": "explain-model"}
+        )
+        # 使用 --keepdb 重复执行时用户已存在
+        User.objects.bulk_create(
+            (
+                User(
+                    username=f"explain-{index}",
+                    email=f"explain-{index}@example.com",
+                    name=f"explain-{index}",
+                )
+                for index in range(users)
+            ),
+            ignore_conflicts=True,
+        )
+        seeded_users = list(User.objects.filter(username__startswith="explain-"))
+        ChatSession.objects.bulk_create(
+            ChatSession(title=f"会话 {index}", user=user)
+            for user in seeded_users
+            for index in range(sessions)
+        )
+        chat_sessions = list(ChatSession.objects.all())
+        ChatMessage.objects.bulk_create(
+            (
+                ChatMessage(
+                    session=chat_session,
+                    role="user" if index % 2 == 0 else "assistant",
+                    content=f"消息 {index}",
+                    model=chat_model,
+                )
+                for chat_session in chat_sessions
+                for index in range(messages)
+            ),
+            batch_size=1000,
+        )
+
+        with connection.cursor() as cursor:
+            if connection.vendor == "mysql":
+                cursor.execute("ANALYZE TABLE chat_session, chat_message")
+                cursor.fetchall()
+            else:
+                cursor.execute("ANALYZE")
+
+        chat_session = chat_sessions[len(chat_sessions) // 2]
+        user_message = ChatMessage.objects.filter(
+            session=chat_session, role="user"
+        ).last()
+        self.stdout.write(
+            f"种子数据：{len(seeded_users)} 个用户，{len(chat_sessions)} 个会话，"
+            f"{len(chat_sessions) * messages} 条消息"
+        )
+        return chat_session.user, chat_session, user_message
+
+    def check_queries(self, explain, user, chat_session, user_message):
+        """
+        对每个接口的查询执行 EXPLAIN；get() / get_object() 会清除默认排序，
+        对应的查询同样去掉排序
+
+        :return: 出现问题的查询数
+        """
+        queries = [
+            (
+                "GET /chat/message/?session_id=",
+                view_queryset(
+                    ChatMessageView, user, "list", session_id=chat_session.id
+                ),
+            ),
+            (
+                "GET /chat/session/",
+                view_queryset(ChatSessionView, user, "list"),
+            ),
+            (
+                "GET /chat/message/?session_id=&cursor=",
+                view_queryset(ChatMessageView, user, "list", session_id=chat_session.id)
+                .order_by("created_at", "id")
+                .filter(
+                    MessageKeysetPagination.after(
+                        "created_at", (user_message.created_at, user_message.id), False
+                    )
+                ),
+            ),
+            (
+                "GET /chat/message/?session_id=&since=",
+                view_queryset(ChatMessageView, user, "list", session_id=chat_session.id)
+                .order_by("updated_at", "id")
+                .filter(
+                    MessageKeysetPagination.after(
+                        "updated_at", (user_message.updated_at, user_message.id), False
+                    )
+                ),
+            ),
+            (
+                "GET /chat/message/?session_id=&since= 已删除的消息",
+                ChatTombstone.objects.filter(
+                    user=user,
+                    kind="message",
+                    deleted_at__gt=user_message.updated_at,
+                    session_id=chat_session.id,
+                ).order_by("deleted_at"),
+            ),
+            (
+                "GET /chat/session/?cursor=",
+                view_queryset(ChatSessionView, user, "list")
+                .order_by("-updated_at", "-id")
+                .filter(
+                    SessionKeysetPagination.after(
+                        "updated_at", (chat_session.updated_at, chat_session.id), True
+                    )
+                ),
+            ),
+            (
+                "GET /chat/session/{id}/",
+                view_queryset(ChatSessionView, user, "retrieve")
+                .filter(pk=chat_session.id)
+                .order_by(),
+            ),
+            (
+                "POST /chat/message/ 会话校验",
+                ChatSession.objects.filter(id=chat_session.id, user=user).order_by(),
+            ),
+            (
+                "POST /chat/message/ai-response/ 用户消息",
+                ChatMessage.objects.filter(
+                    id=user_message.id, session__user=user, role="user"
+                ).order_by(),
+            ),
+            (
+                "GET /chat/message/{id}/branch/",
+                view_queryset(ChatMessageView, user, "branch")
+                .filter(id__in=[*user_message.ancestor_ids(), user_message.id])
+                .order_by(),
+            ),
+            (
+                "GET /chat/message/{id}/siblings/",
+                view_queryset(ChatMessageView, user, "siblings")
+                .filter(
+                    session_id=chat_session.id,
+                    parent_message_id=user_message.parent_message_id,
+                )
+                .order_by("created_at", "id"),
+            ),
+            (
+                "GET /chat/message/tips/?session_id=",
+                view_queryset(ChatMessageView, user, "tips", session_id=chat_session.id)
+                .filter(
+                    ~Exists(
+                        ChatMessage.objects.filter(parent_message_id=OuterRef("pk"))
+                    )
+                )
+                .order_by("created_at", "id"),
+            ),
+            (
+                "POST /chat/message/{id}/stop/",
+                view_queryset(ChatMessageView, user, "stop")
+                .filter(pk=user_message.id)
+                .order_by(),
+            ),
+        ]
+
+        failures = 0
+        for name, queryset in queries:
+            sql, params = queryset.query.sql_with_params()
+            plan = explain(sql, params)
+            problems = sorted({problem for *_, items in plan for problem in items})
+            if problems:
+                failures += 1
+                self.stdout.write(
+                    self.style.ERROR(f"FAIL {name}: {', '.join(problems)}")
+                )
+            else:
+                self.stdout.write(self.style.SUCCESS(f"OK   {name}"))
+            for table, access, key, _ in plan:
+                self.stdout.write(
+                    "       "
+                    + " ".join(str(part) for part in (table, access, key) if part)
+                )
+        return failures
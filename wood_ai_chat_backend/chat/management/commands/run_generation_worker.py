@@ -0,0 +1,81 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from chat.jobs import run_worker
+
+
+def _worker_process(concurrency):
+    """
+    子进程入口：收到 SIGTERM/SIGINT 后停止取新任务，完成进行中的生成后退出
+    """
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    run_worker(concurrency=concurrency, stop_event=stop_event)
+
+
+class Command(BaseCommand):
+    help = "启动AI回复生成工作进程，从 Redis 队列中取出生成任务并写入 SSE 帧缓冲"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes", type=int, default=1, help="工作进程数，默认 1"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="每个进程同时执行的生成任务数，默认 8",
+        )
+
+    def handle(self, *args, **options):
+        processes = options["processes"]
+        concurrency = options["concurrency"]
+        self.stdout.write(
+            f"生成工作进程启动：{processes} 个进程，每个进程并发 {concurrency}"
+        )
+
+        if processes <= 1:
+            _worker_process(concurrency)
+            return
+
+        # 子进程各自建立数据库连接
+        connections.close_all()
+        stopping = threading.Event()
+
+        def stop(*args):
+            stopping.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        workers = []
+        for _ in range(processes):
+            worker = multiprocessing.Process(
+                target=_worker_process, args=(concurrency,)
+            )
+            worker.start()
+            workers.append(worker)
+
+        # 监控子进程，异常退出时重新拉起
+        while not stopping.is_set():
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    self.stderr.write(f"工作进程 {worker.pid} 已退出，重新启动")
+                    worker = multiprocessing.Process(
+                        target=_worker_process, args=(concurrency,)
+                    )
+                    worker.start()
+                    workers[index] = worker
+            time.sleep(1)
+
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        self.stdout.write("生成工作进程已停止")
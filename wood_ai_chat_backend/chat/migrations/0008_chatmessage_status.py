@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0007_remove_chatmessage_show_thinking"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatmessage",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("streaming", "生成中"),
+                    ("complete", "已完成"),
+                    ("aborted", "已中断"),
+                ],
+                default="complete",
+                max_length=20,
+                verbose_name="消息状态",
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0008_chatmessage_status"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(
+                fields=["session", "created_at"], name="chat_msg_session_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="chatsession",
+            index=models.Index(
+                fields=["user", "updated_at"], name="chat_session_user_updated_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:56
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def backfill_tree_path(apps, schema_editor):
+    """
+    逐个会话按ID顺序为已有消息生成祖先路径，父消息总是先于子消息创建
+    """
+    ChatMessage = apps.get_model("chat", "ChatMessage")
+    session_id = None
+    paths = {}
+    batch = []
+    for message in (
+        ChatMessage.objects.order_by("session_id", "id")
+        .only("id", "session_id", "parent_message_id")
+        .iterator(chunk_size=BATCH_SIZE)
+    ):
+        # 父消息与子消息属于同一会话，只需保留当前会话的路径
+        if message.session_id != session_id:
+            session_id = message.session_id
+            paths = {}
+        parent_id = message.parent_message_id
+        if parent_id is None or parent_id not in paths:
+            message.tree_path, message.depth = "", 0
+        else:
+            parent_path, parent_depth = paths[parent_id]
+            message.tree_path = f"{parent_path}{parent_id}/"
+            message.depth = parent_depth + 1
+        paths[message.id] = (message.tree_path, message.depth)
+        if message.depth:
+            batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            ChatMessage.objects.bulk_update(batch, ["tree_path", "depth"])
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_update(batch, ["tree_path", "depth"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0009_chat_history_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatmessage",
+            name="depth",
+            field=models.PositiveIntegerField(default=0, verbose_name="层级"),
+        ),
+        migrations.AddField(
+            model_name="chatmessage",
+            name="tree_path",
+            field=models.TextField(blank=True, default="", verbose_name="祖先路径"),
+        ),
+        migrations.RunPython(backfill_tree_path, migrations.RunPython.noop),
+    ]
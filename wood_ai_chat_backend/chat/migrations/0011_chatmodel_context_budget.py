@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0010_chatmessage_tree_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatmodel",
+            name="context_budget",
+            field=models.PositiveIntegerField(
+                default=0,
+                help_text="服务端组装多轮上下文时的最大token数，为 0 时使用默认配置",
+                verbose_name="上下文token预算",
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0011_chatmodel_context_budget"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatmessage",
+            name="content_tokens",
+            field=models.PositiveIntegerField(
+                blank=True, null=True, verbose_name="内容token数"
+            ),
+        ),
+        migrations.AddField(
+            model_name="chatmessage",
+            name="input_tokens",
+            field=models.PositiveIntegerField(default=0, verbose_name="输入token数"),
+        ),
+        migrations.AddField(
+            model_name="chatmessage",
+            name="output_tokens",
+            field=models.PositiveIntegerField(default=0, verbose_name="输出token数"),
+        ),
+        migrations.AddField(
+            model_name="chatmessage",
+            name="reasoning_tokens",
+            field=models.PositiveIntegerField(default=0, verbose_name="推理token数"),
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_updated_at(apps, schema_editor):
+    """
+    已有消息的更新时间取创建时间
+    """
+    ChatMessage = apps.get_model("chat", "ChatMessage")
+    ChatMessage.objects.update(updated_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0012_chatmessage_token_counts"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChatTombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("session", "会话"), ("message", "消息")],
+                        max_length=20,
+                        verbose_name="类型",
+                    ),
+                ),
+                ("object_id", models.BigIntegerField(verbose_name="记录ID")),
+                ("session_id", models.BigIntegerField(verbose_name="会话ID")),
+                (
+                    "deleted_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="删除时间"),
+                ),
+            ],
+            options={
+                "verbose_name": "删除记录",
+                "verbose_name_plural": "删除记录",
+                "db_table": "chat_tombstone",
+            },
+        ),
+        migrations.AddField(
+            model_name="chatmessage",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, verbose_name="更新时间"),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(
+                fields=["session", "updated_at"], name="chat_msg_session_updated_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="chattombstone",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="用户",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="chattombstone",
+            index=models.Index(
+                fields=["user", "kind", "deleted_at"], name="chat_tombstone_sync_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="chattombstone",
+            index=models.Index(
+                fields=["deleted_at"], name="chat_tombstone_deleted_idx"
+            ),
+        ),
+    ]
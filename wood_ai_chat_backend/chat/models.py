@@ -1,4 +1,6 @@
 from django.db import models
+
+from chat.tokens import message_token_counts
 from users.models import User
 
 
@@ -16,6 +18,12 @@ class ChatSession(models.Model):
         verbose_name = "聊天会话"
         verbose_name_plural = "聊天会话"
         ordering = ["-updated_at"]
+        indexes = [
+            # 会话列表：按用户过滤并按更新时间排序
+            models.Index(
+                fields=["user", "updated_at"], name="chat_session_user_updated_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.title}"
@@ -31,6 +39,11 @@ class ChatModel(models.Model):
     ep_id = models.CharField(
         max_length=100, null=True, blank=True, unique=True, verbose_name="推理接入点ID"
     )
+    context_budget = models.PositiveIntegerField(
+        default=0,
+        verbose_name="上下文token预算",
+        help_text="服务端组装多轮上下文时的最大token数，为 0 时使用默认配置",
+    )
 
     class Meta:
         db_table = "chat_model"
@@ -50,6 +63,12 @@ class ChatMessage(models.Model):
         ("system", "系统"),
     )
 
+    STATUS_CHOICES = (
+        ("streaming", "生成中"),
+        ("complete", "已完成"),
+        ("aborted", "已中断"),
+    )
+
     session = models.ForeignKey(
         ChatSession, on_delete=models.CASCADE, verbose_name="聊天会话"
     )
@@ -68,7 +87,18 @@ class ChatMessage(models.Model):
         verbose_name="使用模型",
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    # AI回复的检查点通过 QuerySet.update 写入，需要同时更新 updated_at
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
     tokens = models.IntegerField(default=0, verbose_name="消耗token数")
+    # 以下token数在消息写入时计算一次，统计与组装上下文时直接求和
+    input_tokens = models.PositiveIntegerField(default=0, verbose_name="输入token数")
+    output_tokens = models.PositiveIntegerField(default=0, verbose_name="输出token数")
+    reasoning_tokens = models.PositiveIntegerField(
+        default=0, verbose_name="推理token数"
+    )
+    content_tokens = models.PositiveIntegerField(
+        null=True, blank=True, verbose_name="内容token数"
+    )
     parent_message = models.ForeignKey(
         "self",
         on_delete=models.SET_NULL,
@@ -84,16 +114,54 @@ class ChatMessage(models.Model):
         blank=True,
         verbose_name="消息的响应ID",
     )
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default="complete",
+        verbose_name="消息状态",
+    )
+    # 物化路径：从根消息到父消息的ID，每个ID后跟 "/"，根消息为空字符串
+    tree_path = models.TextField(default="", blank=True, verbose_name="祖先路径")
+    depth = models.PositiveIntegerField(default=0, verbose_name="层级")
 
     class Meta:
         db_table = "chat_message"
         verbose_name = "聊天消息"
         verbose_name_plural = "聊天消息"
         ordering = ["created_at"]
+        indexes = [
+            # 会话历史：按会话过滤并按创建时间排序
+            models.Index(
+                fields=["session", "created_at"], name="chat_msg_session_created_idx"
+            ),
+            # 增量同步：按会话过滤并按更新时间排序
+            models.Index(
+                fields=["session", "updated_at"], name="chat_msg_session_updated_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.session.title} - {self.role}: {self.content[:50]}..."
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # 新建时根据父消息生成祖先路径
+            if self.parent_message_id and not self.tree_path:
+                parent = self.parent_message
+                self.tree_path = f"{parent.tree_path}{parent.id}/"
+                self.depth = parent.depth + 1
+            # 新建时计算token数；AI回复在生成结束时按上游用量重新计算
+            if self.content_tokens is None:
+                for name, value in message_token_counts(self).items():
+                    setattr(self, name, value)
+        super().save(*args, **kwargs)
+
+    def ancestor_ids(self):
+        """
+        从根消息到父消息的ID列表
+        """
+        return [int(id) for id in self.tree_path.split("/") if id]
+
 
 class ChatSettings(models.Model):
     """聊天设置模型"""
@@ -114,3 +182,35 @@ class ChatSettings(models.Model):
 
     def __str__(self):
         return f"{self.user.username} 的设置"
+
+
+class ChatTombstone(models.Model):
+    """已删除记录的墓碑，增量同步时返回 since 之后删除的ID"""
+
+    KIND_CHOICES = (
+        ("session", "会话"),
+        ("message", "消息"),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="用户")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name="类型")
+    object_id = models.BigIntegerField(verbose_name="记录ID")
+    # 消息所属的会话，会话的墓碑为其自身ID
+    session_id = models.BigIntegerField(verbose_name="会话ID")
+    deleted_at = models.DateTimeField(auto_now_add=True, verbose_name="删除时间")
+
+    class Meta:
+        db_table = "chat_tombstone"
+        verbose_name = "删除记录"
+        verbose_name_plural = "删除记录"
+        indexes = [
+            # 增量同步：按用户与类型过滤并按删除时间排序
+            models.Index(
+                fields=["user", "kind", "deleted_at"], name="chat_tombstone_sync_idx"
+            ),
+            # 清理过期的墓碑
+            models.Index(fields=["deleted_at"], name="chat_tombstone_deleted_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}"
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from types import SimpleNamespace
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认的回复缓存配置，可在 settings.CHAT_RESPONSE_CACHE 中覆盖
+DEFAULT_RESPONSE_CACHE = {
+    # 是否缓存无上下文的首轮回复
+    "ENABLED": False,
+    # 缓存时间，单位秒；应短于上游保存响应的时间，回放的响应ID仍可用于后续轮次
+    "TTL": 24 * 3600,
+    # 可缓存的用户消息最大字符数
+    "MAX_PROMPT_CHARS": 2000,
+    # 单条缓存的最大字节数，超过后不缓存
+    "MAX_BYTES": 64 * 1024,
+    # 回放时相邻增量的间隔，单位毫秒，为 0 时全速回放
+    "PACING_MS": 0,
+}
+
+RESPONSE_CACHE_KEY = "chat:response_cache:{model_id}:{think_type}:{digest}"
+
+# 需要回放的增量事件与缓存中的简写
+DELTA_TYPES = {
+    "response.reasoning_summary_text.delta": "r",
+    "response.output_text.delta": "c",
+}
+DELTA_EVENTS = {code: type for type, code in DELTA_TYPES.items()}
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def response_cache_config():
+    """
+    获取回复缓存配置
+    """
+    return {
+        **DEFAULT_RESPONSE_CACHE,
+        **getattr(settings, "CHAT_RESPONSE_CACHE", {}),
+    }
+
+
+def normalize_content(content):
+    """
+    规范化用户消息：Unicode NFKC、去除首尾空白、连续空白合并为一个空格
+    """
+    return WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", content)).strip()
+
+
+class ResponseCache:
+    """
+    无上下文首轮回复的精确匹配缓存
+
+    按规范化后的用户消息、模型与深度思考模式缓存上游的完整增量序列，
+    命中时回放给生成流程，与实时生成一样保存AI回复并通过 SSEGenerator 输出
+    """
+
+    def __init__(self, user_message, chat_model, think_type):
+        self.config = response_cache_config()
+        self.model_id = chat_model.model_id
+        digest = hashlib.sha256(
+            normalize_content(user_message.content).encode()
+        ).hexdigest()
+        self.key = RESPONSE_CACHE_KEY.format(
+            model_id=self.model_id, think_type=think_type, digest=digest
+        )
+
+    @classmethod
+    def for_request(cls, user_message, chat_model, think_type, previous_response_id):
+        """
+        只缓存会话的首条消息：没有父消息，也没有 previous_response_id
+
+        :return: 不可缓存时返回 None
+        """
+        config = response_cache_config()
+        if (
+            not config["ENABLED"]
+            or previous_response_id
+            or user_message.parent_message_id is not None
+            or len(user_message.content) > config["MAX_PROMPT_CHARS"]
+        ):
+            return None
+        return cls(user_message, chat_model, think_type)
+
+    def get(self):
+        """
+        :return: 缓存的回复，未命中或 Redis 不可用时返回 None
+        """
+        try:
+            raw = get_redis_connection("default").get(self.key)
+        except Exception:
+            logger.exception("读取回复缓存失败")
+            return None
+        if raw is None:
+            metrics.incr(f"response_cache.miss.{self.model_id}")
+            return None
+        metrics.incr(f"response_cache.hit.{self.model_id}")
+        entry = json.loads(raw)
+        metrics.incr(
+            f"response_cache.tokens_saved.{self.model_id}",
+            entry["usage"]["total_tokens"],
+        )
+        return entry
+
+    def recorder(self):
+        return ResponseRecorder(self)
+
+    def replay(self, entry, use_async=False):
+        """
+        :return: 按配置的间隔回放缓存的流
+        """
+        stream_class = AsyncReplayStream if use_async else ReplayStream
+        return stream_class(entry, self.config["PACING_MS"])
+
+    def store(self, entry):
+        payload = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        if len(payload.encode()) > self.config["MAX_BYTES"]:
+            metrics.incr(f"response_cache.oversize.{self.model_id}")
+            return
+        try:
+            get_redis_connection("default").set(
+                self.key, payload, ex=self.config["TTL"], nx=True
+            )
+        except Exception:
+            logger.exception("写入回复缓存失败")
+
+
+class ResponseRecorder:
+    """
+    记录上游流式事件中需要回放的部分，生成完成后写入缓存
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.response_id = None
+        self.events = []
+        self.usage = None
+        self.size = 0
+        self.overflow = False
+
+    def record(self, chunk):
+        chunk_type = getattr(chunk, "type", None)
+        if chunk_type == "response.created":
+            self.response_id = chunk.response.id
+        elif chunk_type in DELTA_TYPES:
+            if self.overflow:
+                return
+            self.size += len(chunk.delta.encode())
+            if self.size > self.cache.config["MAX_BYTES"]:
+                self.overflow = True
+                self.events = []
+                return
+            self.events.append([DELTA_TYPES[chunk_type], chunk.item_id, chunk.delta])
+        elif chunk_type == "response.completed":
+            usage = chunk.response.usage
+            details = getattr(usage, "output_tokens_details", None)
+            self.usage = {
+                "total_tokens": usage.total_tokens,
+                "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+                "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+                "reasoning_tokens": getattr(details, "reasoning_tokens", 0) or 0,
+            }
+
+    def store(self):
+        """
+        只缓存完整生成的回复
+        """
+        if self.overflow or self.usage is None or not self.events:
+            return
+        self.cache.store(
+            {
+                "response_id": self.response_id,
+                "events": self.events,
+                "usage": self.usage,
+            }
+        )
+
+
+def replay_events(entry):
+    """
+    将缓存还原为上游流式事件
+    """
+    response_id = entry["response_id"]
+    usage = entry["usage"]
+    yield SimpleNamespace(
+        type="response.created", response=SimpleNamespace(id=response_id)
+    )
+    for code, item_id, delta in entry["events"]:
+        yield SimpleNamespace(type=DELTA_EVENTS[code], item_id=item_id, delta=delta)
+    yield SimpleNamespace(
+        type="response.completed",
+        response=SimpleNamespace(
+            id=response_id,
+            usage=SimpleNamespace(
+                total_tokens=usage["total_tokens"],
+                input_tokens=usage["input_tokens"],
+                output_tokens=usage["output_tokens"],
+                output_tokens_details=SimpleNamespace(
+                    reasoning_tokens=usage["reasoning_tokens"]
+                ),
+            ),
+        ),
+    )
+
+
+class ReplayStream:
+    """
+    回放缓存的同步流，接口与上游的流式响应一致
+    """
+
+    def __init__(self, entry, pacing_ms=0):
+        self.entry = entry
+        self.pacing = pacing_ms / 1000
+        self.closed = False
+
+    def __iter__(self):
+        for event in replay_events(self.entry):
+            if self.closed:
+                return
+            if self.pacing and hasattr(event, "delta"):
+                time.sleep(self.pacing)
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncReplayStream(ReplayStream):
+    """
+    回放缓存的异步流
+    """
+
+    async def __aiter__(self):
+        for event in replay_events(self.entry):
+            if self.closed:
+                return
+            if self.pacing and hasattr(event, "delta"):
+                await asyncio.sleep(self.pacing)
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+
+def response_cache_stats():
+    """
+    每个模型的命中、未命中次数与命中率
+    """
+    stats = {}
+    for name, value in metrics.counters().items():
+        if not name.startswith("response_cache."):
+            continue
+        _, kind, model_id = name.split(".", 2)
+        stats.setdefault(model_id, {"hit": 0, "miss": 0})[kind] = value
+    for item in stats.values():
+        lookups = item["hit"] + item["miss"]
+        item["hit_rate"] = round(item["hit"] / lookups, 4) if lookups else 0
+    return stats
+
+
+metrics.register_stats("response_cache", response_cache_stats)
@@ -2,9 +2,10 @@ from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
 from chat.models import ChatSession, ChatMessage, ChatModel
+from utils.fieldsets import SparseFieldsetSerializerMixin
 
 
-class ChatSessionSerializer(ModelSerializer):
+class ChatSessionSerializer(SparseFieldsetSerializerMixin, ModelSerializer):
     created_at = serializers.DateTimeField(read_only=True, format="%Y-%m-%d %H:%M:%S")
     updated_at = serializers.DateTimeField(read_only=True, format="%Y-%m-%d %H:%M:%S")
 
@@ -20,15 +21,64 @@ class ChatModelSerializer(ModelSerializer):
         fields = "__all__"
 
 
-class ChatMessageSerializer(ModelSerializer):
+class ChatMessageSerializer(SparseFieldsetSerializerMixin, ModelSerializer):
     created_at = serializers.DateTimeField(read_only=True, format="%Y-%m-%d %H:%M:%S")
+    updated_at = serializers.DateTimeField(read_only=True, format="%Y-%m-%d %H:%M:%S")
 
     class Meta:
         model = ChatMessage
-        fields = "__all__"
+        # 祖先路径只在服务端使用，通过 branch 接口获取分支
+        exclude = ["tree_path"]
+        read_only_fields = [
+            "depth",
+            "input_tokens",
+            "output_tokens",
+            "reasoning_tokens",
+            "content_tokens",
+        ]
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data["session"] = ChatSessionSerializer(instance.session).data
-        data["model"] = ChatModelSerializer(instance.model).data
+        # 稀疏字段集未选择的 session / model 不输出，其列也未从数据库读取
+        with_session = "session" in data
+        with_model = "model" in data
+        # 精简模式：session / model 只返回ID，完整数据放在响应的 included 中
+        included = self.context.get("included")
+        if included is not None:
+            if with_session and instance.session_id not in included["sessions"]:
+                included["sessions"][instance.session_id] = self.get_session_data(
+                    instance
+                )
+            if with_model and instance.model_id is not None:
+                included["models"].setdefault(
+                    instance.model_id, self.get_model_data(instance)
+                )
+            return data
+        if with_session:
+            data["session"] = self.get_session_data(instance)
+        if with_model:
+            data["model"] = self.get_model_data(instance)
+        return data
+
+    def get_session_data(self, instance):
+        """
+        同一次序列化中每个会话只序列化一次
+        """
+        sessions = self.context.setdefault("session_data", {})
+        data = sessions.get(instance.session_id)
+        if data is None:
+            data = ChatSessionSerializer(instance.session).data
+            sessions[instance.session_id] = data
         return data
+
+    @staticmethod
+    def get_model_data(instance):
+        """
+        从模型目录获取已序列化的模型数据，避免逐条查询与序列化
+        """
+        from chat.catalog import model_catalog
+
+        try:
+            return model_catalog.data(instance.model_id)
+        except ChatModel.DoesNotExist:
+            return ChatModelSerializer(instance.model).data
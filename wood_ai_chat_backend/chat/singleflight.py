@@ -0,0 +1,201 @@
+import logging
+import uuid
+
+from django_redis import get_redis_connection
+
+from chat.leases import lease_keeper
+from chat.stream_buffer import get_async_redis, stream_buffer_config
+
+logger = logging.getLogger(__name__)
+
+# 生成状态：排队中（后台工作进程模式）、生成中、已完成、未完成（出错、停止或断开）
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# 登记：不存在或未完成时直接登记，已完成时只有重新生成才替换；
+# 排队或生成中的登记由其持有者续期，不会被替换
+# 返回之前的状态（不存在时为空字符串），未登记时返回 nil
+CLAIM_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+local state = current and string.match(current, '^([^:]*)') or ''
+if state == '' or state == 'failed' or (state == 'done' and ARGV[3] == '1') then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return state
+end
+return false
+"""
+
+# 开始排队的生成：登记仍由自己持有或已过期时标记为生成中
+# 返回之前的状态（已过期时为空字符串），登记已被替换时返回 nil
+START_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and string.match(current, ':(.*)$') ~= ARGV[1] then
+    return false
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return current and string.match(current, '^([^:]*)') or ''
+"""
+
+# 只更新自己持有的登记：ARGV[2] 为新的值，为空字符串时只续期，为 '-' 时删除
+UPDATE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current or string.match(current, ':(.*)$') ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '-' then
+    redis.call('DEL', KEYS[1])
+elseif ARGV[2] == '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+
+def job_key(user_message_id):
+    """
+    生成状态的键，值为 "状态:登记ID"
+    """
+    return f"chat:job:{user_message_id}"
+
+
+class GenerationFlight:
+    """
+    同一条用户消息的AI回复同时只有一个生成
+
+    重复点击、网络重试、多个标签页对同一条用户消息发起的请求中，只有第一个
+    登记成功的请求请求上游并保存AI回复，其余请求从 SSE 帧缓冲转发同一个流；
+    生成结束后在帧缓冲的有效期内，重复的请求得到已保存的结果，未完成的生成
+    由之后的请求重新生成
+
+    登记带有随机的登记ID，只有持有者可以更新；生成期间由续期线程定期续期
+    """
+
+    def __init__(self, user_message_id, token=None):
+        """
+        :param token: 登记ID，后台工作进程使用入队时的登记ID
+        """
+        self.key = job_key(user_message_id)
+        self.token = token or uuid.uuid4().hex
+        self.ttl = stream_buffer_config()["TTL"]
+        # 登记前的状态，为 None 时之前没有登记
+        self.previous = None
+        self._lease = None
+
+    def _value(self, state):
+        return f"{state}:{self.token}"
+
+    def claim(self, state=RUNNING, regenerate=False):
+        """
+        登记一次生成
+
+        :param state: 登记的状态
+        :param regenerate: 是否重新生成；只能替换已完成的生成，排队或生成中的仍然复用
+        :return: 是否登记成功，失败时应转发进行中或已完成的生成
+        """
+        try:
+            script = get_redis_connection("default").register_script(CLAIM_SCRIPT)
+            previous = script(
+                keys=[self.key],
+                args=[self._value(state), self.ttl, int(regenerate)],
+            )
+        except Exception:
+            # Redis 不可用时不合并重复的请求，与未启用帧缓冲时一致
+            logger.exception("登记生成失败: %s", self.key)
+            return True
+        if previous is None:
+            return False
+        self.previous = previous.decode() or None
+        return True
+
+    @property
+    def replaces_stream(self):
+        """
+        是否替换了已结束的生成，此时帧缓冲中是之前的流，需要先清空；
+        之前没有登记时缓冲已随登记过期，进行中的生成则不会被替换
+        """
+        return self.previous in (DONE, FAILED)
+
+    def _update(self, value):
+        script = get_redis_connection("default").register_script(UPDATE_SCRIPT)
+        return bool(script(keys=[self.key], args=[self.token, value, self.ttl]))
+
+    async def _aupdate(self, value):
+        script = get_async_redis().register_script(UPDATE_SCRIPT)
+        return bool(await script(keys=[self.key], args=[self.token, value, self.ttl]))
+
+    def keep_alive(self):
+        """
+        生成开始后定期续期，直到 finish 或 release；由 SSEGenerator 在开始生成时调用
+        """
+        if self._lease is None:
+            self._lease = lease_keeper.register(self.renew, self.ttl / 3)
+
+    def _stop_keep_alive(self):
+        if self._lease is not None:
+            lease_keeper.unregister(self._lease)
+            self._lease = None
+
+    def renew(self):
+        """
+        续期，登记已被替换时不再续期
+        """
+        if not self._update(""):
+            self._stop_keep_alive()
+
+    def start(self):
+        """
+        排队的生成开始执行；排队期间登记已过期时重新登记
+
+        之前的状态记录在 previous 中，为 RUNNING 时同一个任务之前的执行已中断
+        （工作进程异常退出后任务重新入队）
+
+        :return: 是否仍持有登记，登记已被其他请求替换时应放弃本次生成
+        """
+        try:
+            script = get_redis_connection("default").register_script(START_SCRIPT)
+            previous = script(
+                keys=[self.key], args=[self.token, self._value(RUNNING), self.ttl]
+            )
+        except Exception:
+            logger.exception("更新生成状态失败: %s", self.key)
+            return True
+        if previous is None:
+            return False
+        self.previous = previous.decode() or None
+        return True
+
+    def finish(self, failed=False):
+        """
+        标记生成已结束，有效期内重复的请求转发已完成的流
+
+        :param failed: 生成以错误结束、被停止或客户端断开，之后的请求重新生成
+        """
+        self._stop_keep_alive()
+        try:
+            self._update(self._value(FAILED if failed else DONE))
+        except Exception:
+            logger.exception("更新生成状态失败: %s", self.key)
+
+    async def afinish(self, failed=False):
+        """
+        finish 的异步版本
+        """
+        self._stop_keep_alive()
+        try:
+            await self._aupdate(self._value(FAILED if failed else DONE))
+        except Exception:
+            logger.exception("更新生成状态失败: %s", self.key)
+
+    def release(self):
+        """
+        登记后未能开始生成时释放，之后的请求可以重新登记
+        """
+        self._stop_keep_alive()
+        try:
+            self._update("-")
+        except Exception:
+            logger.exception("释放生成状态失败: %s", self.key)
@@ -0,0 +1,582 @@
+import asyncio
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from djangorestframework_camel_case.render import CamelCaseJSONRenderer
+
+from chat.cancellation import cancellation
+from chat.encoder import Delta, dumps
+from chat.stream_buffer import format_frame
+
+# 默认的 SSE 数据块合并配置，可在 settings.CHAT_SSE_COALESCE 中覆盖
+DEFAULT_SSE_COALESCE = {
+    # 默认的合并时间窗口，单位毫秒，为 0 时不合并
+    "WINDOW_MS": 0,
+    # 客户端可请求的最大时间窗口，单位毫秒
+    "MAX_WINDOW_MS": 200,
+    # 单个合并块的增量文本字节上限
+    "MAX_BYTES": 2048,
+}
+
+
+def coalesce_config():
+    """
+    获取 SSE 数据块合并配置
+    """
+    return {**DEFAULT_SSE_COALESCE, **getattr(settings, "CHAT_SSE_COALESCE", {})}
+
+
+class EventStreamRenderer(CamelCaseJSONRenderer):
+    """
+    接受 Accept: text/event-stream 的请求，流式端点的错误响应仍以 JSON 输出
+    """
+
+    media_type = "text/event-stream"
+    format = "sse"
+
+
+class Choice:
+    def __init__(
+        self,
+        content="",
+        role="assistant",
+        index=0,
+        reasoning_content="",
+        finish_reason=None,
+    ):
+        self.content = content
+        self.role = role
+        self.index = index
+        self.reasoning_content = reasoning_content
+        self.finish_reason = finish_reason
+
+    def to_dict(self):
+        """
+        将 Choice 对象转换为字典格式
+        """
+        choice_dict = {
+            "index": self.index,
+            "delta": {
+                "role": self.role,
+                "content": self.content,
+            },
+        }
+
+        # 只有当 reasoning_content 不为空时才添加
+        if self.reasoning_content:
+            choice_dict["delta"]["reasoning_content"] = self.reasoning_content
+
+        # 只有当 finish_reason 不为空时才添加
+        if self.finish_reason:
+            choice_dict["finish_reason"] = self.finish_reason
+
+        return choice_dict
+
+
+class ChunkCoalescer:
+    """
+    SSE 数据块合并器
+
+    将连续的 content / reasoning_content 增量合并为一个数据块，直到达到时间窗口
+    或字节上限；message_start、message_end、usage 等其他数据块到达时立即发送
+    """
+
+    def __init__(self, window_ms, max_bytes):
+        """
+        :param window_ms: 合并的时间窗口，单位毫秒
+        :param max_bytes: 合并的增量文本字节上限
+        """
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self._pending = None
+        self._pending_id = None
+        self._content = []
+        self._reasoning = []
+        self._bytes = 0
+        self._deadline = None
+
+    @classmethod
+    def from_request(cls, window_ms=None):
+        """
+        按部署配置与客户端请求的窗口创建合并器，窗口为 0 时返回 None（不合并）
+
+        :param window_ms: 客户端请求的时间窗口，不超过 MAX_WINDOW_MS
+        """
+        config = coalesce_config()
+        if window_ms is None:
+            window_ms = config["WINDOW_MS"]
+        try:
+            window_ms = min(max(int(window_ms), 0), config["MAX_WINDOW_MS"])
+        except (TypeError, ValueError):
+            window_ms = config["WINDOW_MS"]
+        if not window_ms:
+            return None
+        return cls(window_ms, config["MAX_BYTES"])
+
+    @staticmethod
+    def is_mergeable(data_dict):
+        """
+        增量（Delta）以及只有单个 choice、无 usage、无 finish_reason 的数据块可以合并
+        """
+        if type(data_dict) is Delta:
+            return True
+        if not isinstance(data_dict, dict) or "usage" in data_dict:
+            return False
+        choices = data_dict.get("choices")
+        return (
+            isinstance(choices, list)
+            and len(choices) == 1
+            and "finish_reason" not in choices[0]
+        )
+
+    @staticmethod
+    def _split(data_dict):
+        """
+        获取数据块的 (ID, content, reasoning_content)
+        """
+        if type(data_dict) is Delta:
+            return data_dict.id, data_dict.content, data_dict.reasoning_content
+        delta = data_dict["choices"][0]["delta"]
+        return (
+            data_dict["id"],
+            delta.get("content"),
+            delta.get("reasoning_content"),
+        )
+
+    def time_left(self):
+        """
+        距离当前窗口结束的秒数，没有待发送的增量时返回 None
+        """
+        if self._pending is None:
+            return None
+        return max(self._deadline - time.monotonic(), 0)
+
+    def push(self, data_dict):
+        """
+        加入一个数据块
+
+        :return: 需要立即发送的数据块列表
+        """
+        if not self.is_mergeable(data_dict):
+            return self.flush() + [data_dict]
+
+        id, content, reasoning = self._split(data_dict)
+        ready = []
+        if self._pending is not None and (
+            self._pending_id != id or type(self._pending) is not type(data_dict)
+        ):
+            ready = self.flush()
+        if self._pending is None:
+            self._pending = data_dict
+            self._pending_id = id
+            self._deadline = time.monotonic() + self.window
+
+        if content:
+            self._content.append(content)
+            self._bytes += len(content.encode())
+        if reasoning:
+            self._reasoning.append(reasoning)
+            self._bytes += len(reasoning.encode())
+
+        if self._bytes >= self.max_bytes or time.monotonic() >= self._deadline:
+            ready += self.flush()
+        return ready
+
+    def flush(self):
+        """
+        发送已合并的增量
+
+        :return: 合并后的数据块列表（没有待发送的增量时为空）
+        """
+        if self._pending is None:
+            return []
+        pending = self._pending
+        if type(pending) is Delta:
+            merged = pending.encoder.delta(
+                self._pending_id, "".join(self._content), "".join(self._reasoning)
+            )
+        else:
+            choice = pending["choices"][0]
+            delta = {
+                "role": choice["delta"].get("role", "assistant"),
+                "content": "".join(self._content),
+            }
+            if self._reasoning:
+                delta["reasoning_content"] = "".join(self._reasoning)
+            merged = {
+                **pending,
+                "choices": [{**choice, "delta": delta}],
+            }
+        self._pending = None
+        self._pending_id = None
+        self._content = []
+        self._reasoning = []
+        self._bytes = 0
+        self._deadline = None
+        return [merged]
+
+
+class SSEGenerator:
+    def __init__(
+        self,
+        data_generator,
+        buffer=None,
+        cancel_token=None,
+        coalescer=None,
+        flight=None,
+    ):
+        """
+        初始化 SSEGenerator
+
+        :param data_generator: 一个生成器，产生要发送给客户端的数据字典
+        :param buffer: 可选的 StreamBuffer，每一帧都会写入其中以支持断线续传
+        :param cancel_token: 可选的 CancelToken，生成结束后注销
+        :param coalescer: 可选的 ChunkCoalescer，合并连续的增量后再发送
+        :param flight: 可选的 GenerationFlight，生成期间续期，结束后标记为已完成或未完成
+        """
+        self.data_generator = data_generator
+        self.buffer = buffer
+        self.cancel_token = cancel_token
+        self.coalescer = coalescer
+        self.flight = flight
+        self.event_id = 0
+        # 生成是否以错误结束
+        self.failed = False
+        # 生成是否完整结束（message_end 中的状态为 complete），停止或断开时为 False
+        self.completed = False
+
+    @staticmethod
+    def create_chat_chunk(
+        id,
+        choices,
+        model,
+        created=int(time.time()),
+        object_type="response",
+        usage=None,
+    ):
+        """
+        创建一个符合格式的聊天块
+
+        :param id: 响应ID
+        :param choices: 选择项列表
+        :param created: 创建时间戳
+        :param model: 模型名称
+        :param object_type: 对象类型
+        :param usage: 使用情况统计
+        :return: 格式化的字典
+        """
+        chunk = {
+            "id": id,
+            "choices": choices,
+            "created": created,
+            "model": model,
+            "object": object_type,
+        }
+
+        if usage:
+            chunk["usage"] = usage
+
+        return chunk
+
+    @staticmethod
+    def format_event(data_dict):
+        """
+        将一条数据格式化为 SSE 帧
+
+        :param data_dict: 要发送的数据字典
+        :return: SSE 格式的字符串
+        """
+        # 增量由其 ChunkEncoder 直接拼接成帧
+        if type(data_dict) is Delta:
+            return data_dict.encode()
+        # 确保数据是字典格式
+        if isinstance(data_dict, dict):
+            # 生成 SSE 格式的响应
+            return f"data: {dumps(data_dict)}\n\n"
+        # 如果不是字典，转换为字符串处理
+        return f"data: {str(data_dict)}\n\n"
+
+    @staticmethod
+    def format_error(e):
+        """
+        将异常格式化为 SSE 错误帧
+        """
+        error_data = {"error": str(e)}
+        return f"data: {json.dumps(error_data)}\n\n"
+
+    def emit(self, frame):
+        """
+        为帧分配单调递增的事件ID，启用缓冲时同时写入缓冲
+        """
+        if self.buffer is not None:
+            self.event_id = self.buffer.append(frame)
+        else:
+            self.event_id += 1
+        return format_frame(self.event_id, frame)
+
+    def coalesce(self):
+        """
+        按合并器的窗口合并数据块；同步生成器无法定时唤醒，窗口在下一个数据块到达时检查
+        """
+        if self.coalescer is None:
+            yield from self.data_generator
+            return
+        try:
+            for data_dict in self.data_generator:
+                yield from self.coalescer.push(data_dict)
+        except Exception:
+            # 先发送已合并的增量，再发送错误信息
+            yield from self.coalescer.flush()
+            raise
+        yield from self.coalescer.flush()
+
+    def start(self):
+        """
+        生成开始：期间定期续期登记，直到 finalize
+        """
+        if self.flight is not None:
+            self.flight.keep_alive()
+
+    def track(self, data_dict):
+        """
+        从 message_end 中记录生成是否完整结束
+        """
+        if type(data_dict) is dict and data_dict.get("type") == "message_end":
+            self.completed = data_dict["data"].get("status") == "complete"
+
+    def frames(self):
+        """
+        生成不带事件ID的 SSE 帧
+        """
+        self.start()
+        try:
+            for data_dict in self.coalesce():
+                self.track(data_dict)
+                yield self.format_event(data_dict)
+        except Exception as e:
+            # 发送错误信息给客户端
+            self.failed = True
+            yield self.format_error(e)
+
+    def finalize(self):
+        """
+        生成结束：写入缓冲结束标记，标记生成已完成或未完成并注销取消标记
+        """
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.flight is not None:
+            self.flight.finish(failed=self.failed or not self.completed)
+        if self.cancel_token is not None:
+            cancellation.unregister(self.cancel_token)
+
+    def should_cancel(self, disconnected_at):
+        """
+        客户端断开超过续传宽限期且没有客户端重连时，停止生成
+        """
+        if self.cancel_token is None or self.cancel_token.cancelled:
+            return False
+        if time.monotonic() - disconnected_at < self.buffer.config["RESUME_GRACE"]:
+            return False
+        return not self.buffer.has_readers()
+
+    def drain(self, frames, disconnected_at):
+        """
+        客户端断开后继续把剩余的帧写入缓冲，供重连的客户端续传
+        """
+        next_check = 0
+        try:
+            for frame in frames:
+                self.emit(frame)
+                # 每秒最多检查一次是否有客户端重连
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + 1
+                    if self.should_cancel(disconnected_at):
+                        self.cancel_token.cancel()
+        finally:
+            self.finalize()
+            close_old_connections()
+
+    def __iter__(self):
+        """
+        使对象可迭代，生成 SSE 格式的响应
+        """
+        frames = self.frames()
+        finished = False
+        try:
+            for frame in frames:
+                yield self.emit(frame)
+            finished = True
+        finally:
+            if finished:
+                self.finalize()
+            elif self.buffer is not None and self.buffer.config["RESUME_GRACE"] > 0:
+                # 客户端断开：在后台线程中继续生成，宽限期内重连可以续传
+                threading.Thread(
+                    target=self.drain,
+                    args=(frames, time.monotonic()),
+                    daemon=True,
+                ).start()
+            else:
+                # 客户端断开：立即关闭上游流，已生成的内容保存为已中断
+                frames.close()
+                self.data_generator.close()
+                self.finalize()
+
+
+class AsyncSSEGenerator(SSEGenerator):
+    """
+    SSEGenerator 的异步版本，包装异步生成器，在 ASGI 下由事件循环驱动
+    """
+
+    # 后台生成任务的引用，避免任务被垃圾回收
+    background_tasks = set()
+
+    # 不继承同步迭代：StreamingHttpResponse 优先按同步迭代器处理可迭代的对象，
+    # 只有不可同步迭代时才使用 __aiter__
+    __iter__ = None
+
+    async def aemit(self, frame):
+        """
+        emit 的异步版本
+        """
+        if self.buffer is not None:
+            self.event_id = await self.buffer.aappend(frame)
+        else:
+            self.event_id += 1
+        return format_frame(self.event_id, frame)
+
+    async def acoalesce(self):
+        """
+        coalesce 的异步版本，等待下一个数据块时窗口到期会立即发送已合并的增量
+        """
+        if self.coalescer is None:
+            async for data_dict in self.data_generator:
+                yield data_dict
+            return
+
+        iterator = self.data_generator.__aiter__()
+        next_item = None
+        try:
+            while True:
+                if next_item is None:
+                    next_item = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait(
+                    {next_item}, timeout=self.coalescer.time_left()
+                )
+                if not done:
+                    for data_dict in self.coalescer.flush():
+                        yield data_dict
+                    continue
+                item, next_item = next_item, None
+                try:
+                    data_dict = item.result()
+                except StopAsyncIteration:
+                    break
+                for data_dict in self.coalescer.push(data_dict):
+                    yield data_dict
+        except Exception:
+            # 先发送已合并的增量，再发送错误信息
+            for data_dict in self.coalescer.flush():
+                yield data_dict
+            raise
+        finally:
+            # 客户端断开时取消等待中的读取，生成器随之关闭上游流并保存
+            if next_item is not None and not next_item.done():
+                next_item.cancel()
+                await asyncio.gather(next_item, return_exceptions=True)
+        for data_dict in self.coalescer.flush():
+            yield data_dict
+
+    async def aframes(self):
+        """
+        生成不带事件ID的 SSE 帧
+        """
+        self.start()
+        data_dicts = self.acoalesce()
+        try:
+            async for data_dict in data_dicts:
+                self.track(data_dict)
+                yield self.format_event(data_dict)
+        except Exception as e:
+            # 发送错误信息给客户端
+            self.failed = True
+            yield self.format_error(e)
+        finally:
+            # 关闭合并器中等待上游的读取，之后才能关闭数据生成器
+            await data_dicts.aclose()
+
+    async def afinalize(self):
+        """
+        finalize 的异步版本
+        """
+        if self.buffer is not None:
+            await self.buffer.aclose()
+        if self.flight is not None:
+            await self.flight.afinish(failed=self.failed or not self.completed)
+        if self.cancel_token is not None:
+            cancellation.unregister(self.cancel_token)
+
+    async def ashould_cancel(self, disconnected_at):
+        """
+        should_cancel 的异步版本
+        """
+        if self.cancel_token is None or self.cancel_token.cancelled:
+            return False
+        if time.monotonic() - disconnected_at < self.buffer.config["RESUME_GRACE"]:
+            return False
+        return not await self.buffer.ahas_readers()
+
+    async def produce(self, queue, consumer):
+        """
+        在独立任务中驱动生成并写入缓冲，客户端断开（响应任务被取消）不会立即中断生成
+
+        :param queue: 发送给当前客户端的帧队列
+        :param consumer: 当前客户端的状态，客户端断开后不再入队
+        """
+        next_check = 0
+        try:
+            async for frame in self.aframes():
+                frame = await self.aemit(frame)
+                if consumer["disconnected_at"] is None:
+                    queue.put_nowait(frame)
+                elif time.monotonic() >= next_check:
+                    # 每秒最多检查一次是否有客户端重连
+                    next_check = time.monotonic() + 1
+                    if await self.ashould_cancel(consumer["disconnected_at"]):
+                        self.cancel_token.cancel()
+        finally:
+            await self.afinalize()
+            queue.put_nowait(None)
+
+    async def __aiter__(self):
+        """
+        使对象可异步迭代，生成与同步版本相同的 SSE 帧
+        """
+        if self.buffer is None or self.buffer.config["RESUME_GRACE"] <= 0:
+            frames = self.aframes()
+            try:
+                async for frame in frames:
+                    yield await self.aemit(frame)
+            finally:
+                # 客户端断开时立即关闭上游流，已生成的内容保存为已中断
+                await frames.aclose()
+                await self.data_generator.aclose()
+                await self.afinalize()
+            return
+
+        queue = asyncio.Queue()
+        consumer = {"disconnected_at": None}
+        task = asyncio.get_running_loop().create_task(self.produce(queue, consumer))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        try:
+            while True:
+                frame = await queue.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            consumer["disconnected_at"] = time.monotonic()
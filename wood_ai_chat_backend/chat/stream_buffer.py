@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import redis.asyncio
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# 默认的 SSE 帧缓冲配置，可在 settings.CHAT_STREAM_BUFFER 中覆盖
+DEFAULT_STREAM_BUFFER = {
+    # 是否启用帧缓冲（断线续传）
+    "ENABLED": True,
+    # 缓冲的过期时间，单位秒，每次写入时刷新
+    "TTL": 600,
+    # 单条消息最多缓冲的帧数
+    "MAXLEN": 20000,
+    # 续传时每次阻塞等待新帧的时间，单位毫秒
+    "BLOCK_MS": 5000,
+    # 续传时超过该时间没有新帧则认为生成已中断，单位秒
+    "IDLE_TIMEOUT": 120,
+    # 客户端断开后等待重连的宽限期，单位秒，超时无人重连则停止生成；
+    # 默认为 0，断开即停止生成，需要断线后继续生成以便重连时，再显式设置
+    "RESUME_GRACE": 0,
+}
+
+# 结束标记字段，写在最后一帧之后
+END_FIELD = b"end"
+FRAME_FIELD = b"f"
+
+_async_connections = weakref.WeakKeyDictionary()
+
+
+def stream_buffer_config():
+    """
+    获取 SSE 帧缓冲配置
+    """
+    return {**DEFAULT_STREAM_BUFFER, **getattr(settings, "CHAT_STREAM_BUFFER", {})}
+
+
+def get_async_redis():
+    """
+    获取当前事件循环的异步 Redis 连接，连接参数与 django_redis 的 default 连接相同
+    """
+    loop = asyncio.get_running_loop()
+    connection = _async_connections.get(loop)
+    if connection is None:
+        kwargs = get_redis_connection("default").connection_pool.connection_kwargs
+        connection = redis.asyncio.Redis(**kwargs)
+        _async_connections[loop] = connection
+    return connection
+
+
+def format_frame(event_id, frame):
+    """
+    为 SSE 帧加上事件ID
+    """
+    return f"id: {event_id}\n{frame}"
+
+
+class StreamBuffer:
+    """
+    单条消息的 SSE 帧缓冲
+
+    每一帧以单调递增的事件ID写入 Redis Stream（ID 为 0-N），断线的客户端
+    携带 Last-Event-ID 重连时，先补发错过的帧，再继续跟随正在进行的生成，
+    生成可以运行在其他工作进程上
+    """
+
+    def __init__(self, message_id):
+        """
+        :param message_id: 用户消息ID，同一条用户消息的AI回复共用一个缓冲
+        """
+        self.key = f"chat:sse:{message_id}"
+        self.config = stream_buffer_config()
+        self.last_id = 0
+        # Redis 写入失败后不再尝试，仍保证事件ID递增
+        self.broken = False
+
+    def _next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def append(self, frame):
+        """
+        写入一帧
+
+        :param frame: 不带事件ID的 SSE 帧
+        :return: 该帧的事件ID
+        """
+        event_id = self._next_id()
+        if self.broken:
+            return event_id
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            pipe.xadd(
+                self.key,
+                {FRAME_FIELD: frame},
+                id=f"0-{event_id}",
+                maxlen=self.config["MAXLEN"],
+                approximate=True,
+            )
+            pipe.expire(self.key, self.config["TTL"])
+            pipe.execute()
+        except Exception:
+            logger.exception("写入 SSE 帧缓冲失败: %s", self.key)
+            self.broken = True
+        return event_id
+
+    async def aappend(self, frame):
+        """
+        append 的异步版本
+        """
+        event_id = self._next_id()
+        if self.broken:
+            return event_id
+        try:
+            pipe = get_async_redis().pipeline(transaction=False)
+            pipe.xadd(
+                self.key,
+                {FRAME_FIELD: frame},
+                id=f"0-{event_id}",
+                maxlen=self.config["MAXLEN"],
+                approximate=True,
+            )
+            pipe.expire(self.key, self.config["TTL"])
+            await pipe.execute()
+        except Exception:
+            logger.exception("写入 SSE 帧缓冲失败: %s", self.key)
+            self.broken = True
+        return event_id
+
+    def _end_fields(self):
+        return {END_FIELD: b"1"}
+
+    def close(self):
+        """
+        写入结束标记，续传的客户端读到后结束
+        """
+        if self.broken:
+            return
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            pipe.xadd(self.key, self._end_fields(), id=f"0-{self.last_id + 1}")
+            pipe.expire(self.key, self.config["TTL"])
+            pipe.execute()
+        except Exception:
+            logger.exception("写入 SSE 结束标记失败: %s", self.key)
+
+    async def aclose(self):
+        """
+        close 的异步版本
+        """
+        if self.broken:
+            return
+        try:
+            pipe = get_async_redis().pipeline(transaction=False)
+            pipe.xadd(self.key, self._end_fields(), id=f"0-{self.last_id + 1}")
+            pipe.expire(self.key, self.config["TTL"])
+            await pipe.execute()
+        except Exception:
+            logger.exception("写入 SSE 结束标记失败: %s", self.key)
+
+    def reset(self):
+        """
+        清空缓冲，同一条用户消息重新生成前调用
+        """
+        try:
+            get_redis_connection("default").delete(self.key)
+        except Exception:
+            logger.exception("清空 SSE 帧缓冲失败: %s", self.key)
+            self.broken = True
+
+    def _readers_key(self):
+        return f"{self.key}:readers"
+
+    def _readers_ttl(self):
+        # 续传循环每次阻塞后刷新，留出余量
+        return self.config["BLOCK_MS"] // 1000 + 5
+
+    def has_readers(self):
+        """
+        判断是否有重连的客户端正在续传
+        """
+        try:
+            return bool(get_redis_connection("default").exists(self._readers_key()))
+        except Exception:
+            return True
+
+    async def ahas_readers(self):
+        """
+        has_readers 的异步版本
+        """
+        try:
+            return bool(await get_async_redis().exists(self._readers_key()))
+        except Exception:
+            return True
+
+    def exists(self):
+        """
+        判断缓冲是否存在（生成中或刚结束）
+        """
+        try:
+            return bool(get_redis_connection("default").exists(self.key))
+        except Exception:
+            return False
+
+    @staticmethod
+    def _parse_last_event_id(last_event_id):
+        try:
+            return max(int(last_event_id), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _handle_entries(self, entries):
+        """
+        解析读取到的帧
+
+        :return: (带事件ID的帧列表, 最后的 Stream ID, 是否已结束)
+        """
+        frames = []
+        last = None
+        for entry_id, fields in entries:
+            last = entry_id
+            if END_FIELD in fields:
+                return frames, last, True
+            event_id = int(entry_id.split(b"-")[1])
+            frames.append(format_frame(event_id, fields[FRAME_FIELD].decode()))
+        return frames, last, False
+
+    def replay(self, last_event_id):
+        """
+        从 Last-Event-ID 之后补发并跟随生成，产生带事件ID的 SSE 帧
+
+        :param last_event_id: 客户端最后收到的事件ID
+        """
+        conn = get_redis_connection("default")
+        last = f"0-{self._parse_last_event_id(last_event_id)}"
+        idle_since = time.monotonic()
+        # 缓冲可能尚未创建（生成任务还在排队），读到帧之前不因缓冲不存在而结束
+        started = False
+        while True:
+            conn.set(self._readers_key(), 1, ex=self._readers_ttl())
+            result = conn.xread({self.key: last}, block=self.config["BLOCK_MS"])
+            if not result:
+                # 生成进程异常退出时不会写结束标记，空闲超时或缓冲过期后结束
+                idle = time.monotonic() - idle_since
+                if idle >= self.config["IDLE_TIMEOUT"]:
+                    return
+                if started and not conn.exists(self.key):
+                    return
+                continue
+            started = True
+            idle_since = time.monotonic()
+            frames, last, ended = self._handle_entries(result[0][1])
+            yield from frames
+            if ended:
+                return
+
+    async def areplay(self, last_event_id):
+        """
+        replay 的异步版本
+        """
+        conn = get_async_redis()
+        last = f"0-{self._parse_last_event_id(last_event_id)}"
+        idle_since = time.monotonic()
+        started = False
+        while True:
+            await conn.set(self._readers_key(), 1, ex=self._readers_ttl())
+            result = await conn.xread({self.key: last}, block=self.config["BLOCK_MS"])
+            if not result:
+                idle = time.monotonic() - idle_since
+                if idle >= self.config["IDLE_TIMEOUT"]:
+                    return
+                if started and not await conn.exists(self.key):
+                    return
+                continue
+            started = True
+            idle_since = time.monotonic()
+            frames, last, ended = self._handle_entries(result[0][1])
+            for frame in frames:
+                yield frame
+            if ended:
+                return
@@ -1,3 +1,1788 @@
-from django.test import TestCase
+import asyncio
+import gc
+import inspect
+import io
+import json
+import os
+import threading
+import weakref
+import zlib
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import fakeredis.aioredis
+import httpx
+import openai
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.admission import AdmissionTicket, QueueFull, active_key
+from chat.balancer import EndpointBalancer
+from chat.catalog import CATALOG_CHANNEL, model_catalog
+from chat.clients import UpstreamClientRegistry
+from chat.accumulator import ReplyAccumulator
+from chat.compression import negotiate_encoding
+from chat.context import (
+    ASSEMBLED,
+    PREVIOUS_RESPONSE,
+    REASONING_PREFIX,
+    build_context,
+    prepare_input,
+)
+from chat.encoder import ChunkEncoder
+from chat.generation import handle_response_chunk
+from chat.history_cache import HistoryCache
+from chat.jobs import (
+    JOBS_KEY,
+    PROCESSING_KEY,
+    WORKER_KEY,
+    enqueue_generation,
+    requeue_stale_jobs,
+    run_generation_job,
+    run_worker,
+)
+from chat.leases import lease_keeper
+from chat.models import ChatMessage, ChatModel, ChatSession
+from chat.singleflight import GenerationFlight, job_key
+from chat.sse import Choice, ChunkCoalescer, SSEGenerator
+from chat.tokens import count_tokens, estimate_tokens, message_tokens
+from users.models import User
+from utils import metrics
+from utils.pagination import KeysetPagination
+
+
+class ChatApiTestCase(TestCase):
+    """
+    3 个会话、每个会话 10 条消息的测试数据
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(
+            username="query-count", email="query-count@example.com", name="query"
+        )
+        cls.chat_model = ChatModel.objects.create(name="query", model_id="query")
+        cls.sessions = [
+            ChatSession.objects.create(title=f"会话 {index}", user=cls.user)
+            for index in range(3)
+        ]
+        ChatMessage.objects.bulk_create(
+            ChatMessage(
+                session=chat_session,
+                role="user" if index % 2 == 0 else "assistant",
+                content=f"消息 {index}",
+                model=cls.chat_model,
+            )
+            for chat_session in cls.sessions
+            for index in range(10)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # 模型目录在进程内缓存，预先加载，避免计入接口的查询数
+        model_catalog.invalidate()
+        model_catalog.get(id=self.chat_model.id)
+
+
+# 通过 django_redis.get_redis_connection 访问 Redis 的模块
+REDIS_MODULES = (
+    "chat.admission",
+    "chat.cancellation",
+    "chat.catalog",
+    "chat.conditional",
+    "chat.history_cache",
+    "chat.jobs",
+    "chat.response_cache",
+    "chat.singleflight",
+    "chat.stream_buffer",
+    "utils.metrics",
+    "utils.throttling",
+)
+
+
+class FakeRedisMixin:
+    """
+    每个测试使用独立的 fakeredis 服务器替换 Redis 连接，Lua 脚本由 lupa 执行
+    """
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        patches = [
+            mock.patch(f"{module}.get_redis_connection", return_value=self.redis)
+            for module in REDIS_MODULES
+        ]
+        # 异步连接按事件循环创建，同样连接到这个服务器
+        patches += [
+            mock.patch(
+                "chat.stream_buffer._async_connections", weakref.WeakKeyDictionary()
+            ),
+            mock.patch(
+                "chat.stream_buffer.redis.asyncio.Redis",
+                side_effect=lambda **kwargs: fakeredis.aioredis.FakeRedis(
+                    server=server
+                ),
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+
+class UpstreamStream:
+    """
+    上游流式响应的替身，按顺序产生事件；事件为函数时调用它，用于在生成中途执行操作
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        for event in self.events:
+            if self.closed:
+                return
+            if callable(event):
+                event()
+                continue
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncUpstreamStream(UpstreamStream):
+    """
+    异步上游流式响应的替身；事件函数返回协程时等待它
+    """
+
+    async def __aiter__(self):
+        for event in self.events:
+            if self.closed:
+                return
+            if callable(event):
+                result = event()
+                if inspect.isawaitable(result):
+                    await result
+                continue
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+
+def upstream_events(*deltas, reasoning=(), response_id="resp_1", total_tokens=10):
+    """
+    构造 Response API 的流式事件：推理增量、内容增量与完成事件
+    """
+    events = [
+        SimpleNamespace(
+            type="response.created", response=SimpleNamespace(id=response_id)
+        )
+    ]
+    events += [
+        SimpleNamespace(
+            type="response.reasoning_summary_text.delta", delta=delta, item_id="rs_1"
+        )
+        for delta in reasoning
+    ]
+    events += [
+        SimpleNamespace(type="response.output_text.delta", delta=delta, item_id="msg_1")
+        for delta in deltas
+    ]
+    events.append(
+        SimpleNamespace(
+            type="response.completed",
+            response=SimpleNamespace(
+                id=response_id,
+                usage=SimpleNamespace(
+                    total_tokens=total_tokens,
+                    input_tokens=total_tokens // 2,
+                    output_tokens=total_tokens - total_tokens // 2,
+                    output_tokens_details=SimpleNamespace(reasoning_tokens=0),
+                ),
+            ),
+        )
+    )
+    return events
+
+
+class ChatStreamTestCase(FakeRedisMixin, ChatApiTestCase):
+    """
+    ai-response 流式接口的测试基类：Redis 为 fakeredis，上游为按顺序产生事件的替身
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user_message = ChatMessage.objects.create(
+            session=self.sessions[0],
+            role="user",
+            content="你好",
+            model=self.chat_model,
+        )
+        # 每次请求上游时返回的事件，可在测试中替换
+        self.events = upstream_events("你", "好", "！")
+        self.upstream_requests = []
+        self.upstream_streams = []
+        client = SimpleNamespace(responses=SimpleNamespace(create=self.create_response))
+        async_client = SimpleNamespace(
+            responses=SimpleNamespace(create=self.acreate_response)
+        )
+        # 接入点统计保存在进程内，每个测试重新开始
+        self.balancer = EndpointBalancer()
+        patches = [
+            mock.patch(
+                "chat.generation.upstream_clients.get_client", return_value=client
+            ),
+            mock.patch(
+                "chat.generation.upstream_clients.get_async_client",
+                return_value=async_client,
+            ),
+            mock.patch("chat.generation.endpoint_balancer", self.balancer),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def create_response(self, **config):
+        self.upstream_requests.append(config)
+        stream = UpstreamStream(self.events)
+        self.upstream_streams.append(stream)
+        return stream
+
+    async def acreate_response(self, **config):
+        self.upstream_requests.append(config)
+        stream = AsyncUpstreamStream(self.events)
+        self.upstream_streams.append(stream)
+        return stream
+
+    def ai_response(self, headers=None, **data):
+        data.setdefault("user_message_id", self.user_message.id)
+        return self.client.post(
+            "/chat/message/ai-response/", data, format="json", headers=headers
+        )
+
+    @staticmethod
+    def parse_frame(raw):
+        """
+        :return: {"id": 事件ID, "data": 数据}
+        """
+        frame = {"id": None, "data": None}
+        for line in raw.split("\n"):
+            name, _, value = line.partition(": ")
+            if name == "id":
+                frame["id"] = int(value)
+            elif name == "data":
+                frame["data"] = json.loads(value)
+        return frame
+
+    def read_frames(self, response):
+        """
+        读取整个流
+        """
+        content = b"".join(response.streaming_content).decode()
+        return [self.parse_frame(raw) for raw in content.split("\n\n") if raw]
+
+    def iter_frames(self, response):
+        """
+        逐帧读取流，可以在读取过程中发起其他请求
+        """
+        pending = ""
+        for chunk in response.streaming_content:
+            pending += chunk.decode() if isinstance(chunk, bytes) else chunk
+            *frames, pending = pending.split("\n\n")
+            for raw in frames:
+                yield self.parse_frame(raw)
+
+    @staticmethod
+    def typed(frames, type):
+        return [frame["data"] for frame in frames if frame["data"].get("type") == type]
+
+    @staticmethod
+    def content(frames):
+        """
+        拼接流中的内容增量
+        """
+        return "".join(
+            choice["delta"]["content"]
+            for frame in frames
+            for choice in frame["data"].get("choices", ())
+        )
+
+
+class ChatQueryCountTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    列表接口的查询数不随消息数增长（N+1 回归测试）
+    """
+
+    def test_message_list(self):
+        # 会话归属校验与首次生成校验信息各一次查询，消息列表一次查询
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                "/chat/message/", {"session_id": self.sessions[0].id}
+            )
+        self.assertEqual(len(response.data["data"]), 10)
+        self.assertEqual(response.data["data"][0]["session"]["id"], self.sessions[0].id)
+        self.assertEqual(response.data["data"][0]["model"]["id"], self.chat_model.id)
+
+    def test_message_list_all_sessions(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/chat/message/")
+        self.assertEqual(len(response.data["data"]), 30)
+
+    def test_message_list_slim(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/chat/message/", {"slim": "1"})
+        self.assertEqual(response.data["data"][0]["session"], self.sessions[0].id)
+        self.assertEqual(len(response.data["included"]["sessions"]), 3)
+        self.assertEqual(len(response.data["included"]["models"]), 1)
+
+    def test_message_list_paginated(self):
+        # 同步位置与当前页各一次查询，没有 COUNT(*)
+        with self.assertNumQueries(2):
+            response = self.client.get("/chat/message/", {"limit": 5})
+        self.assertEqual(len(response.data["data"]), 5)
+        self.assertIsNotNone(response.data["next_cursor"])
+
+    def test_session_list(self):
+        # 首次生成校验信息一次查询，会话列表一次查询
+        with self.assertNumQueries(2):
+            response = self.client.get("/chat/session/")
+        self.assertEqual(len(response.data["data"]), 3)
+
+
+class ChatSparseFieldsetTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    fields / exclude 同时裁剪输出字段与查询的列
+    """
+
+    def test_message_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/chat/message/", {"fields": "content,role"})
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]["sql"]
+        self.assertNotIn("reasoning_content", sql)
+        self.assertNotIn('"chat_session"."title"', sql)
+        self.assertEqual(set(response.data["data"][0]), {"id", "content", "role"})
+
+    def test_message_exclude(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/chat/message/", {"exclude": "reasoning_content", "limit": 5}
+            )
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn("reasoning_content", queries[1]["sql"])
+        self.assertNotIn("reasoning_content", response.data["data"][0])
+        self.assertEqual(response.data["data"][0]["session"]["id"], self.sessions[0].id)
+
+    def test_unknown_field(self):
+        response = self.client.get("/chat/message/", {"fields": "content,secret"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_session_fields(self):
+        # 首次生成校验信息一次查询，会话列表一次查询
+        with self.assertNumQueries(2):
+            response = self.client.get("/chat/session/", {"fields": "title"})
+        self.assertEqual(set(response.data["data"][0]), {"id", "title"})
+
+    def test_reasoning(self):
+        message = ChatMessage.objects.filter(session=self.sessions[0]).last()
+        message.reasoning_content = "推理过程"
+        message.save(update_fields=["reasoning_content"])
+        response = self.client.get(f"/chat/message/{message.id}/reasoning/")
+        self.assertEqual(response.data["data"]["reasoning_content"], "推理过程")
+
+        other = User.objects.create(
+            username="other", email="other@example.com", name="other"
+        )
+        self.client.force_authenticate(other)
+        response = self.client.get(f"/chat/message/{message.id}/reasoning/")
+        self.assertEqual(response.status_code, 404)
+
+
+class ChatTreeTests(ChatApiTestCase):
+    """
+    对话树的分支、兄弟与末端查询
+    """
+
+    def setUp(self):
+        super().setUp()
+        chat_session = self.sessions[0]
+
+        def create(role, parent=None):
+            return ChatMessage.objects.create(
+                session=chat_session,
+                role=role,
+                content=role,
+                model=self.chat_model,
+                parent_message=parent,
+            )
+
+        # user1 -> (assistant1, assistant1 重新生成) ; assistant1 -> user2 -> assistant2
+        self.user1 = create("user")
+        self.assistant1 = create("assistant", self.user1)
+        self.regenerated = create("assistant", self.user1)
+        self.user2 = create("user", self.assistant1)
+        self.assistant2 = create("assistant", self.user2)
+
+    def test_tree_path(self):
+        self.assertEqual(self.assistant2.depth, 3)
+        self.assertEqual(
+            self.assistant2.ancestor_ids(),
+            [self.user1.id, self.assistant1.id, self.user2.id],
+        )
+
+    def test_branch(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/chat/message/{self.assistant2.id}/branch/")
+        self.assertEqual(
+            [message["id"] for message in response.data["data"]],
+            [self.user1.id, self.assistant1.id, self.user2.id, self.assistant2.id],
+        )
+
+    def test_siblings(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/chat/message/{self.assistant1.id}/siblings/")
+        self.assertEqual(
+            [message["id"] for message in response.data["data"]],
+            [self.assistant1.id, self.regenerated.id],
+        )
+
+    def test_tips(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                "/chat/message/tips/", {"session_id": self.sessions[0].id}
+            )
+        ids = [message["id"] for message in response.data["data"]]
+        self.assertIn(self.regenerated.id, ids)
+        self.assertIn(self.assistant2.id, ids)
+        self.assertNotIn(self.user2.id, ids)
+
+
+class ChunkEncoderTests(SimpleTestCase):
+    """
+    ChunkEncoder 的默认输出与 Choice + create_chat_chunk + json.dumps 逐字节一致
+    """
+
+    model = "doubao-seed-1-6-250615"
+    item_id = "msg_0217512345678901234567890abcdef"
+    created = 1750000000
+    # 覆盖中文、emoji、需要转义的引号、反斜杠、换行与控制字符
+    deltas = ["hello", "你好，世界", "😀", '"quoted"', "a\\b", "\n\t", "\x00\x1f", ""]
+
+    def setUp(self):
+        self.encoder = ChunkEncoder(self.model, created=self.created, backend="json")
+
+    def legacy_frame(self, chunk):
+        return f"data: {json.dumps(chunk, separators=(',', ':'))}\n\n"
+
+    def legacy_delta(self, content="", reasoning_content=""):
+        return self.legacy_frame(
+            SSEGenerator.create_chat_chunk(
+                id=self.item_id,
+                choices=[
+                    Choice(
+                        content=content, reasoning_content=reasoning_content
+                    ).to_dict()
+                ],
+                created=self.created,
+                model=self.model,
+            )
+        )
+
+    def assertDeltaEqual(self, content="", reasoning_content=""):
+        delta = self.encoder.delta(self.item_id, content, reasoning_content)
+        self.assertEqual(
+            SSEGenerator.format_event(delta),
+            self.legacy_delta(content, reasoning_content),
+        )
+
+    def test_content(self):
+        for text in self.deltas:
+            with self.subTest(text=text):
+                self.assertDeltaEqual(content=text)
+
+    def test_reasoning(self):
+        for text in self.deltas:
+            with self.subTest(text=text):
+                self.assertDeltaEqual(reasoning_content=text)
+                self.assertDeltaEqual(content=text, reasoning_content="推理")
+
+    def test_item_ids(self):
+        # 帧前缀按输出项缓存，不同输出项交替编码时互不影响
+        other = self.encoder.encode("msg_other", content="a")
+        self.assertIn('"id":"msg_other"', other)
+        self.assertDeltaEqual(content="b")
+
+    def test_usage(self):
+        chunk = SimpleNamespace(
+            type="response.completed",
+            response=SimpleNamespace(
+                id="resp_1", usage=SimpleNamespace(total_tokens=42)
+            ),
+        )
+        accumulator = SimpleNamespace(response_id="resp_1")
+        chat_model = SimpleNamespace(model_id=self.model)
+        data = handle_response_chunk(chunk, accumulator, chat_model, self.encoder)
+        expected = SSEGenerator.create_chat_chunk(
+            id="resp_1",
+            choices=[],
+            created=self.created,
+            model=self.model,
+            usage=42,
+        )
+        self.assertEqual(SSEGenerator.format_event(data), self.legacy_frame(expected))
+
+    def test_coalesced(self):
+        coalescer = ChunkCoalescer(window_ms=1000, max_bytes=1 << 20)
+        for text in self.deltas:
+            coalescer.push(self.encoder.delta(self.item_id, content=text))
+        (merged,) = coalescer.flush()
+        self.assertEqual(
+            SSEGenerator.format_event(merged),
+            self.legacy_delta(content="".join(self.deltas)),
+        )
+
+
+class ChatResumeTests(ChatStreamTestCase):
+    """
+    携带 Last-Event-ID 重连时从帧缓冲补发，不再请求上游
+    """
+
+    def test_resume(self):
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(
+            [frame["id"] for frame in frames], list(range(1, len(frames) + 1))
+        )
+        self.assertEqual(self.content(frames), "你好！")
+
+        response = self.ai_response(headers={"Last-Event-ID": "2"})
+        self.assertEqual(self.read_frames(response), frames[2:])
+        self.assertEqual(len(self.upstream_requests), 1)
+
+    def test_resume_without_buffer(self):
+        # 缓冲不存在（已过期）时按新的请求生成
+        frames = self.read_frames(self.ai_response(headers={"Last-Event-ID": "5"}))
+        self.assertEqual(frames[0]["id"], 1)
+        self.assertEqual(len(self.upstream_requests), 1)
+
+
+class ChatCancellationTests(ChatStreamTestCase):
+    """
+    停止生成与客户端断开时关闭上游流，已生成的内容保存为已中断
+    """
+
+    def assertAborted(self):
+        ai_message = ChatMessage.objects.get(
+            parent_message=self.user_message, role="assistant"
+        )
+        self.assertEqual(ai_message.status, "aborted")
+        self.assertTrue(self.upstream_streams[0].closed)
+        return ai_message
+
+    def test_stop(self):
+        frames = []
+        for frame in self.iter_frames(self.ai_response()):
+            frames.append(frame)
+            if frame["data"].get("type") == "message_start":
+                response = self.client.post(
+                    f"/chat/message/{self.user_message.id}/stop/"
+                )
+                self.assertEqual(response.status_code, 200)
+        (message_end,) = self.typed(frames, "message_end")
+        self.assertEqual(message_end["data"]["status"], "aborted")
+        self.assertEqual(self.content(frames), "")
+        self.assertAborted()
+
+    def test_stop_during_generation(self):
+        def stop():
+            self.client.post(f"/chat/message/{self.user_message.id}/stop/")
+
+        # 第一个增量之后停止，之后的增量不再读取
+        self.events = upstream_events("你", "好")
+        self.events.insert(2, stop)
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.content(frames), "你")
+        self.assertEqual(self.assertAborted().content, "你")
+
+    def test_disconnect(self):
+        response = self.ai_response()
+        frames = self.iter_frames(response)
+        self.assertEqual(next(frames)["data"]["type"], "message_start")
+        self.assertEqual(next(frames)["data"]["choices"][0]["delta"]["content"], "你")
+        response.close()
+        self.assertEqual(self.assertAborted().content, "你")
+
+        # 未完成的生成由之后的请求重新生成
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(len(self.upstream_requests), 2)
+
+
+class ChatCoalesceTests(ChatStreamTestCase):
+    """
+    时间窗口与字节上限内的连续增量合并为一帧
+    """
+
+    def content_frames(self, frames):
+        return [frame for frame in frames if "choices" in frame["data"]]
+
+    def test_window(self):
+        frames = self.read_frames(self.ai_response(coalesce_ms=200))
+        merged, usage = self.content_frames(frames)
+        self.assertEqual(merged["data"]["choices"][0]["delta"]["content"], "你好！")
+        self.assertEqual(usage["data"]["choices"], [])
+        self.assertEqual(usage["data"]["usage"], 10)
+
+    def test_disabled(self):
+        frames = self.read_frames(self.ai_response(coalesce_ms=0))
+        self.assertEqual(len(self.content_frames(frames)), 4)
+        self.assertEqual(self.content(frames), "你好！")
+
+    def test_max_bytes(self):
+        with self.settings(CHAT_SSE_COALESCE={"MAX_BYTES": 6}):
+            frames = self.read_frames(self.ai_response(coalesce_ms=200))
+        contents = [
+            frame["data"]["choices"][0]["delta"]["content"]
+            for frame in self.content_frames(frames)[:-1]
+        ]
+        self.assertEqual(contents, ["你好", "！"])
+
+    def test_window_expired(self):
+        encoder = ChunkEncoder("query", created=0)
+        with mock.patch("chat.sse.time.monotonic", return_value=100):
+            coalescer = ChunkCoalescer(window_ms=50, max_bytes=2048)
+            self.assertEqual(coalescer.push(encoder.delta("msg_1", "a")), [])
+            self.assertEqual(coalescer.push(encoder.delta("msg_1", "b")), [])
+        # 窗口结束后到达的增量与之前的一起发送
+        with mock.patch("chat.sse.time.monotonic", return_value=100.05):
+            (merged,) = coalescer.push(encoder.delta("msg_1", "c"))
+        self.assertEqual(merged.content, "abc")
+        self.assertEqual(coalescer.flush(), [])
+
+    def test_item_change(self):
+        # 输出项变化时先发送之前合并的增量
+        encoder = ChunkEncoder("query", created=0)
+        coalescer = ChunkCoalescer(window_ms=1000, max_bytes=2048)
+        coalescer.push(encoder.delta("rs_1", reasoning_content="想"))
+        (reasoning,) = coalescer.push(encoder.delta("msg_1", "答"))
+        self.assertEqual(reasoning.reasoning_content, "想")
+        (content,) = coalescer.flush()
+        self.assertEqual((content.id, content.content), ("msg_1", "答"))
+
+
+class ChatStreamFormatTests(ChatStreamTestCase):
+    """
+    compact 格式通过查询参数或 Accept 参数协商，只发送增量文本
+    """
+
+    def assertCompact(self, response):
+        self.assertEqual(response["X-Stream-Format"], "compact")
+        frames = [frame["data"] for frame in self.read_frames(response)]
+        self.assertEqual(frames[0]["type"], "message_start")
+        self.assertEqual(frames[1:4], [{"c": "你"}, {"c": "好"}, {"c": "！"}])
+        self.assertEqual(frames[4], {"u": 10})
+        self.assertEqual(frames[5]["type"], "message_end")
+
+    def test_default(self):
+        response = self.ai_response()
+        self.assertEqual(response["X-Stream-Format"], "openai")
+        self.assertEqual(self.content(self.read_frames(response)), "你好！")
+
+    def test_accept(self):
+        self.assertCompact(
+            self.ai_response(
+                headers={
+                    "Accept": "application/json, text/event-stream; format=compact"
+                }
+            )
+        )
+
+    def test_query_param(self):
+        self.assertCompact(
+            self.client.post(
+                "/chat/message/ai-response/?stream_format=compact",
+                {"user_message_id": self.user_message.id},
+                format="json",
+            )
+        )
+
+    def test_reasoning(self):
+        self.events = upstream_events("答", reasoning=["想"])
+        response = self.ai_response(
+            headers={"Accept": "text/event-stream; format=compact"}
+        )
+        frames = [frame["data"] for frame in self.read_frames(response)]
+        self.assertEqual(frames[1:3], [{"r": "想"}, {"c": "答"}])
+
+
+class ChatCompressionTests(ChatStreamTestCase):
+    """
+    流式响应按 Accept-Encoding 压缩，每一帧压缩后立即 flush
+    """
+
+    def test_gzip_flush(self):
+        with self.settings(CHAT_SSE_COMPRESSION={"ENCODINGS": ["gzip", "deflate"]}):
+            response = self.ai_response(headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = list(response.streaming_content)
+        # 除最后结束压缩流的数据外，每个数据块都能单独解压出一个完整的帧
+        frames = []
+        for chunk in chunks[:-1]:
+            text = decompressor.decompress(chunk).decode()
+            self.assertTrue(text.endswith("\n\n"))
+            self.assertEqual(text.count("\n\n"), 1)
+            frames.append(self.parse_frame(text.rstrip("\n")))
+        self.assertEqual(decompressor.decompress(chunks[-1]), b"")
+        self.assertTrue(decompressor.eof)
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(frames[-1]["data"]["type"], "message_end")
+
+    def test_negotiate(self):
+        with self.settings(CHAT_SSE_COMPRESSION={"ENCODINGS": ["gzip", "deflate"]}):
+            self.assertEqual(negotiate_encoding("gzip, deflate"), "gzip")
+            self.assertEqual(negotiate_encoding("gzip;q=0, deflate"), "deflate")
+            self.assertEqual(negotiate_encoding("*;q=0.5"), "gzip")
+            self.assertIsNone(negotiate_encoding("identity"))
+            self.assertIsNone(negotiate_encoding(None))
+        with self.settings(CHAT_SSE_COMPRESSION={"ENABLED": False}):
+            self.assertIsNone(negotiate_encoding("gzip"))
+
+    def test_uncompressed(self):
+        response = self.ai_response()
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(self.content(self.read_frames(response)), "你好！")
+
+
+class ChatCatalogTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    模型变更后本进程立即失效，事务提交后广播给其他工作进程
+    """
+
+    def test_invalidate_on_save(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CATALOG_CHANNEL)
+        _, etag = model_catalog.listing()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.chat_model.name = "renamed"
+            self.chat_model.save()
+            # 提交前本进程已失效，广播在提交后发送
+            self.assertFalse(model_catalog.stats()["loaded"])
+            self.assertIsNone(pubsub.get_message(timeout=0.1))
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(pubsub.get_message(timeout=1)["data"], b"1")
+
+        self.assertEqual(model_catalog.get(id=self.chat_model.id).name, "renamed")
+        self.assertNotEqual(model_catalog.listing()[1], etag)
+
+    def test_not_modified(self):
+        response = self.client.get("/chat/model/")
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/chat/model/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatModel.objects.create(name="new", model_id="new")
+        response = self.client.get("/chat/model/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(len(response.data["data"]), 2)
+
+    def test_listener(self):
+        # 其他工作进程的广播使本进程失效；订阅断开后重新订阅
+        model_catalog.listing()
+        self.assertTrue(model_catalog.stats()["loaded"])
+        pubsub = mock.MagicMock()
+        pubsub.listen.side_effect = [iter([{"data": b"1"}]), ConnectionError()]
+        with (
+            mock.patch.object(self.redis, "pubsub", return_value=pubsub),
+            mock.patch("chat.catalog.time.sleep", side_effect=StopIteration),
+            self.assertLogs("chat.catalog", "ERROR"),
+            self.assertRaises(StopIteration),
+        ):
+            model_catalog._listen()
+        pubsub.subscribe.assert_called_with(CATALOG_CHANNEL)
+        self.assertFalse(model_catalog.stats()["loaded"])
+
+
+class ChatPaginationTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    游标分页与增量同步：同步按 updated_at 返回新建与修改的消息，并返回删除的ID
+    """
+
+    def messages(self, **params):
+        response = self.client.get("/chat/message/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def sync_cursor(self, session):
+        return self.messages(session_id=session.id, limit=1)["sync_cursor"]
+
+    def test_cursor(self):
+        session = self.sessions[0]
+        ids = []
+        data = self.messages(session_id=session.id, limit=4)
+        while True:
+            ids += [message["id"] for message in data["data"]]
+            if data["next_cursor"] is None:
+                break
+            data = self.messages(
+                session_id=session.id, limit=4, cursor=data["next_cursor"]
+            )
+        expected = ChatMessage.objects.filter(session=session).order_by(
+            "created_at", "id"
+        )
+        self.assertEqual(ids, [message.id for message in expected])
+
+    def test_since(self):
+        session = self.sessions[0]
+        since = self.sync_cursor(session)
+        edited = ChatMessage.objects.filter(session=session).first()
+        edited.content = "已修改"
+        edited.save()
+        created = ChatMessage.objects.create(
+            session=session, role="user", content="新消息", model=self.chat_model
+        )
+        data = self.messages(session_id=session.id, since=since)
+        self.assertEqual(
+            [message["id"] for message in data["data"]], [edited.id, created.id]
+        )
+        self.assertEqual(data["data"][0]["content"], "已修改")
+        self.assertEqual(data["deleted"], [])
+
+        data = self.messages(session_id=session.id, since=data["sync_cursor"])
+        self.assertEqual(data["data"], [])
+
+    def test_since_streaming_reply(self):
+        # 生成中同步到的AI回复，在生成结束后的同步中返回最终内容
+        session = self.sessions[0]
+        user_message = ChatMessage.objects.filter(session=session, role="user").last()
+        accumulator = ReplyAccumulator()
+        accumulator.start(user_message, session, self.chat_model)
+        accumulator.append_content("生成")
+        accumulator.checkpoint()
+        since = self.sync_cursor(session)
+        data = self.messages(session_id=session.id, since=since)
+        self.assertEqual(data["data"], [])
+
+        accumulator.append_content("完成")
+        accumulator.finish()
+        data = self.messages(session_id=session.id, since=since)
+        (message,) = data["data"]
+        self.assertEqual(message["id"], accumulator.message.id)
+        self.assertEqual(message["content"], "生成完成")
+        self.assertEqual(message["status"], "complete")
+
+    def test_since_deleted(self):
+        session = self.sessions[1]
+        message_since = self.sync_cursor(session)
+        session_since = self.client.get("/chat/session/", {"limit": 1}).data[
+            "sync_cursor"
+        ]
+        message_ids = list(
+            ChatMessage.objects.filter(session=session).values_list("id", flat=True)
+        )
+        response = self.client.delete(f"/chat/session/{session.id}/")
+        self.assertIn(response.status_code, (200, 204))
+
+        data = self.messages(session_id=session.id, since=message_since)
+        self.assertEqual(data["data"], [])
+        self.assertEqual(sorted(data["deleted"]), sorted(message_ids))
+        # 其他会话的同步不包含该会话删除的消息
+        other = self.messages(
+            session_id=self.sessions[0].id, since=self.sync_cursor(self.sessions[0])
+        )
+        self.assertEqual(other["deleted"], [])
+
+        response = self.client.get("/chat/session/", {"since": session_since})
+        self.assertEqual(response.data["deleted"], [session.id])
+
+    def test_since_expired(self):
+        since = KeysetPagination.encode_cursor("sync", datetime(2000, 1, 1), 1)
+        response = self.client.get(
+            "/chat/message/", {"session_id": self.sessions[0].id, "since": since}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ChatConditionalTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    会话列表与消息历史的条件请求：未变更时不查询数据库，直接返回 304
+    """
+
+    def assertNotModified(self, path, params, **headers):
+        with self.assertNumQueries(0):
+            response = self.client.get(path, params, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        return response
+
+    def test_session_list(self):
+        response = self.client.get("/chat/session/")
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+        self.assertNotModified("/chat/session/", {}, if_none_match=etag)
+        self.assertNotModified(
+            "/chat/session/", {}, if_modified_since=response["Last-Modified"]
+        )
+        # 查询参数不同的响应使用不同的 ETag
+        response = self.client.get(
+            "/chat/session/", {"limit": 1}, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatSession.objects.create(title="新会话", user=self.user)
+        response = self.client.get("/chat/session/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["data"]), 4)
+
+    def test_message_history(self):
+        session = self.sessions[0]
+        params = {"session_id": session.id}
+        etag = self.client.get("/chat/message/", params)["ETag"]
+        self.assertNotModified("/chat/message/", params, if_none_match=etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatMessage.objects.create(
+                session=session, role="user", content="新消息", model=self.chat_model
+            )
+        response = self.client.get(
+            "/chat/message/", params, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["data"]), 11)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_other_user(self):
+        # 其他用户的会话不返回校验信息，也不生成
+        other = User.objects.create(
+            username="other", email="other@example.com", name="other"
+        )
+        self.client.force_authenticate(other)
+        response = self.client.get(
+            "/chat/message/", {"session_id": self.sessions[0].id}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["data"], [])
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(self.redis.keys("chat:validators:history:*"), [])
+
+
+class ChatHistoryCacheTests(FakeRedisMixin, ChatApiTestCase):
+    """
+    消息历史的读穿透缓存：未命中时回填，命中时不查询数据库
+    """
+
+    def messages(self, **params):
+        response = self.client.get("/chat/message/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def cached(self, session):
+        return HistoryCache(session.id).get()
+
+    def test_fill_and_hit(self):
+        session = self.sessions[0]
+        missed = self.messages(session_id=session.id)
+        self.assertTrue(self.cached(session)["complete"])
+        with self.assertNumQueries(0):
+            hit = self.messages(session_id=session.id)
+        self.assertEqual(hit["data"], missed["data"])
+        self.assertEqual(
+            metrics.values("chat.history_cache.hit", "chat.history_cache.miss"),
+            [1, 1],
+        )
+
+        # 写穿透：提交后的新消息直接出现在缓存中
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatMessage.objects.create(
+                session=session, role="user", content="新消息", model=self.chat_model
+            )
+        with self.assertNumQueries(0):
+            data = self.messages(session_id=session.id)["data"]
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[-1]["content"], "新消息")
+
+    def test_fill_race(self):
+        # 读取数据库期间有写入提交（代数变化）时放弃回填
+        fill = HistoryCache.fill
+
+        def racing_fill(cache, generation, entry):
+            self.redis.incr(cache.generation_key)
+            fill(cache, generation, entry)
+
+        session = self.sessions[0]
+        with mock.patch.object(HistoryCache, "fill", autospec=True) as patched:
+            patched.side_effect = racing_fill
+            self.messages(session_id=session.id)
+        self.assertIsNone(self.cached(session))
+
+    @override_settings(CHAT_HISTORY_CACHE={"MAX_MESSAGES": 4})
+    def test_truncated(self):
+        session = self.sessions[0]
+        expected = list(
+            ChatMessage.objects.filter(session=session)
+            .order_by("created_at", "id")
+            .values_list("id", flat=True)
+        )
+        self.assertEqual(len(self.messages(session_id=session.id)["data"]), 10)
+        entry = self.cached(session)
+        self.assertFalse(entry["complete"])
+        self.assertEqual([item["id"] for item in entry["messages"]], expected[-4:])
+        # 不完整的缓存不能返回完整列表
+        self.assertEqual(len(self.messages(session_id=session.id)["data"]), 10)
+
+        # 游标落在缓存范围内的下一页从缓存读取
+        cursor = self.messages(session_id=session.id, limit=7)["next_cursor"]
+        with self.assertNumQueries(0):
+            data = self.messages(session_id=session.id, limit=7, cursor=cursor)
+        self.assertEqual([item["id"] for item in data["data"]], expected[7:])
+        self.assertIsNone(data["next_cursor"])
+
+        # 游标早于缓存的消息时查询数据库
+        cursor = self.messages(session_id=session.id, limit=2)["next_cursor"]
+        data = self.messages(session_id=session.id, limit=6, cursor=cursor)
+        self.assertEqual([item["id"] for item in data["data"]], expected[2:8])
+
+    def test_other_user(self):
+        session = self.sessions[0]
+        self.messages(session_id=session.id)
+        other = User.objects.create(
+            username="other", email="other@example.com", name="other"
+        )
+        self.client.force_authenticate(other)
+        self.assertEqual(self.messages(session_id=session.id)["data"], [])
+
+
+class ChatTokenCountTests(ChatStreamTestCase):
+    """
+    消息写入时保存各项token数：用户消息按内容计算，AI回复使用上游统计的用量
+    """
+
+    def reply(self):
+        return ChatMessage.objects.get(
+            parent_message=self.user_message, role="assistant"
+        )
+
+    def test_estimate(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        # 中日韩字符每个 1 个token，其他字符每 4 个 1 个token
+        self.assertEqual(estimate_tokens("你好，world!"), 3 + 2)
+
+    def test_user_message(self):
+        self.user_message.refresh_from_db()
+        self.assertEqual(self.user_message.content_tokens, count_tokens("你好"))
+        self.assertEqual(self.user_message.input_tokens, count_tokens("你好"))
+        self.assertEqual(self.user_message.output_tokens, 0)
+
+    def test_reply_usage(self):
+        self.events = upstream_events("你", "好", "！", reasoning=["想"])
+        self.events[-1].response.usage.output_tokens_details.reasoning_tokens = 3
+        self.read_frames(self.ai_response())
+        reply = self.reply()
+        self.assertEqual(reply.status, "complete")
+        self.assertEqual(reply.tokens, 10)
+        self.assertEqual(
+            (reply.input_tokens, reply.output_tokens, reply.reasoning_tokens),
+            (5, 5, 3),
+        )
+        self.assertEqual(reply.content_tokens, count_tokens("你好！"))
+
+    def test_reply_without_usage(self):
+        # 没有完成事件（上游中断）时按本地分词计算输出token数
+        self.events = upstream_events("你", "好", reasoning=["想"])[:-1]
+        self.read_frames(self.ai_response())
+        reply = self.reply()
+        self.assertEqual(reply.input_tokens, 0)
+        self.assertEqual(reply.output_tokens, count_tokens("你好") + count_tokens("想"))
+        self.assertEqual(reply.content_tokens, count_tokens("你好"))
+
+
+@override_settings(CHAT_RESPONSE_CACHE={"ENABLED": True})
+class ChatResponseCacheTests(ChatStreamTestCase):
+    """
+    无上下文首轮回复的缓存：相同的首条消息回放缓存的流，不再请求上游
+    """
+
+    def first_message(self, content, **fields):
+        chat_session = ChatSession.objects.create(title="新会话", user=self.user)
+        return ChatMessage.objects.create(
+            session=chat_session,
+            role="user",
+            content=content,
+            model=self.chat_model,
+            **fields,
+        )
+
+    def test_replay(self):
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(len(self.upstream_requests), 1)
+
+        # 规范化后相同的消息命中缓存
+        user_message = self.first_message(" 你好　")
+        replayed = self.read_frames(self.ai_response(user_message_id=user_message.id))
+        self.assertEqual(len(self.upstream_requests), 1)
+        self.assertEqual(self.content(replayed), self.content(frames))
+        reply = ChatMessage.objects.get(parent_message=user_message, role="assistant")
+        self.assertEqual(
+            (reply.content, reply.status, reply.tokens, reply.message_resp_id),
+            ("你好！", "complete", 10, "resp_1"),
+        )
+        self.assertEqual(
+            metrics.values("response_cache.hit.query", "response_cache.miss.query"),
+            [1, 1],
+        )
+
+    def test_not_cacheable(self):
+        self.read_frames(self.ai_response())
+        # 有父消息的不是首轮消息
+        user_message = self.first_message("你好", parent_message=self.user_message)
+        self.read_frames(self.ai_response(user_message_id=user_message.id))
+        self.assertEqual(len(self.upstream_requests), 2)
+
+    def test_incomplete_not_stored(self):
+        # 没有完成事件的生成不写入缓存
+        self.events = upstream_events("你", "好")[:-1]
+        self.read_frames(self.ai_response())
+        self.assertEqual(self.redis.keys("chat:response_cache:*"), [])
+
+
+class ChatSingleFlightTests(ChatStreamTestCase):
+    """
+    同一条用户消息同时只有一个生成，重复的请求转发同一个流
+    """
+
+    def replies(self):
+        return ChatMessage.objects.filter(
+            parent_message=self.user_message, role="assistant"
+        )
+
+    def test_duplicate_during_generation(self):
+        duplicates = []
+        self.events.insert(2, lambda: duplicates.append(self.ai_response()))
+        frames = self.read_frames(self.ai_response())
+        # 生成结束后读取重复的请求，得到从头开始的同一个流
+        self.assertEqual(self.read_frames(duplicates[0]), frames)
+        self.assertEqual(len(self.upstream_requests), 1)
+        self.assertEqual(self.replies().count(), 1)
+        self.assertEqual(metrics.values("generation.coalesced"), [1])
+
+    def test_duplicate_after_done(self):
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.read_frames(self.ai_response()), frames)
+        self.assertEqual(len(self.upstream_requests), 1)
+        self.assertEqual(self.replies().count(), 1)
+
+    def test_regenerate(self):
+        self.read_frames(self.ai_response())
+        self.events = upstream_events("再", "见", response_id="resp_2")
+        frames = self.read_frames(self.ai_response(regenerate=True))
+        self.assertEqual(self.content(frames), "再见")
+        self.assertEqual(len(self.upstream_requests), 2)
+
+    def test_failed_regenerates(self):
+        # 出错结束的生成由之后的请求重新生成
+        def fail():
+            raise RuntimeError("upstream failed")
+
+        events, self.events = self.events, self.events[:2] + [fail]
+        self.read_frames(self.ai_response())
+        self.assertTrue(
+            self.redis.get(job_key(self.user_message.id)).startswith(b"failed:")
+        )
+
+        self.events = events
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(len(self.upstream_requests), 2)
+
+
+@override_settings(
+    CHAT_ADMISSION={"USER_LIMIT": 1, "USER_QUEUE_LIMIT": 1, "POLL_MS": 0}
+)
+class ChatAdmissionTests(ChatStreamTestCase):
+    """
+    上游并发名额：超过名额的请求在流中排队，排队已满时返回 429
+    """
+
+    def admitted_ticket(self, user_id=None, chat_model=None):
+        ticket = AdmissionTicket(user_id or self.user.pk, chat_model or self.chat_model)
+        ticket.enqueue()
+        self.assertEqual(list(ticket.wait()), [])
+        self.assertTrue(ticket.admitted)
+        self.addCleanup(ticket.release)
+        return ticket
+
+    def active(self, scope):
+        return self.redis.zcard(active_key(scope))
+
+    def test_wait_and_release(self):
+        holder = self.admitted_ticket()
+        self.assertEqual(self.active(f"user:{self.user.pk}"), 1)
+
+        waiting = AdmissionTicket(self.user.pk, self.chat_model)
+        waiting.enqueue()
+        positions = waiting.wait()
+        self.assertEqual(next(positions), 1)
+        # 其他用户不受该用户名额的限制
+        self.admitted_ticket(user_id=self.user.pk + 1)
+
+        holder.release()
+        self.assertEqual(list(positions), [])
+        self.assertTrue(waiting.admitted)
+        waiting.release()
+        self.assertEqual(self.active("global"), 1)
+
+    @override_settings(
+        CHAT_ADMISSION={
+            "GLOBAL_LIMIT": 4,
+            "MODEL_LIMIT": 1,
+            "USER_LIMIT": 10,
+            "USER_QUEUE_LIMIT": 10,
+            "POLL_MS": 0,
+        }
+    )
+    def test_models_share_global_limit(self):
+        # 排队的请求都在等待已满的模型，不阻塞有空闲名额的另一个模型
+        holder = self.admitted_ticket(user_id=100)
+        waiting = []
+        for index in range(5):
+            ticket = AdmissionTicket(101 + index, self.chat_model)
+            ticket.enqueue()
+            positions = ticket.wait()
+            self.assertEqual(next(positions), index + 1)
+            self.addCleanup(ticket.release)
+            waiting.append(positions)
+
+        other_model = ChatModel.objects.create(name="other", model_id="other")
+        self.admitted_ticket(user_id=200, chat_model=other_model)
+        self.assertEqual(self.active("global"), 2)
+        self.assertEqual(self.active("model:other"), 1)
+
+        # 释放后由排在最前面的请求获得模型的名额
+        holder.release()
+        self.assertEqual(list(waiting[0]), [])
+        self.assertEqual(self.active("model:query"), 1)
+
+    def test_queue_full(self):
+        self.admitted_ticket()
+        AdmissionTicket(self.user.pk, self.chat_model).enqueue()
+        with self.assertRaises(QueueFull):
+            AdmissionTicket(self.user.pk, self.chat_model).enqueue()
+
+        response = self.ai_response()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertEqual(self.upstream_requests, [])
+        # 未开始的生成释放登记，之后的请求可以重新生成
+        self.assertIsNone(self.redis.get(job_key(self.user_message.id)))
+
+    def test_queued_events(self):
+        holder = self.admitted_ticket()
+        # 排队轮询时释放占用的名额
+        with mock.patch(
+            "chat.admission.time.sleep", side_effect=lambda seconds: holder.release()
+        ):
+            frames = self.read_frames(self.ai_response())
+        self.assertEqual(
+            self.typed(frames, "queued"), [{"type": "queued", "data": {"position": 1}}]
+        )
+        self.assertEqual(self.content(frames), "你好！")
+        # 生成结束后释放名额
+        self.assertEqual(self.active(f"user:{self.user.pk}"), 0)
+
+
+class ChatThrottleTests(ChatStreamTestCase):
+    """
+    发送消息、创建会话的限速与每分钟的token预算
+    """
+
+    def setUp(self):
+        super().setUp()
+        rates = mock.patch.dict(
+            SimpleRateThrottle.THROTTLE_RATES,
+            {
+                "chat_message_create": "3/min",
+                "chat_session_create": "2/min",
+                "chat_llm_tokens": "10/min",
+            },
+        )
+        rates.start()
+        self.addCleanup(rates.stop)
+
+    def send(self, **data):
+        return self.client.post(
+            "/chat/message/",
+            {"content": "你好", "model_id": "query", **data},
+            format="json",
+        )
+
+    def test_message_create(self):
+        self.assertEqual(self.send().status_code, 201)
+        self.assertEqual(self.send().status_code, 201)
+        # 第 3 次创建会话超出会话的限速
+        response = self.send()
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response["Retry-After"]) > 0)
+        # 在已有会话中发送的消息不计入创建会话的限速，但计入发送消息的限速
+        response = self.send(session_id=self.sessions[0].id)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(
+            metrics.values(
+                "throttle.rejected.chat_session_create",
+                "throttle.rejected.chat_message_create",
+            ),
+            [1, 1],
+        )
+
+    def test_token_budget(self):
+        # 生成结束后按实际用量扣除预算，预算用完后拒绝新的生成
+        self.read_frames(self.ai_response())
+        self.assertEqual(metrics.values("throttle.tokens_debited"), [10])
+        response = self.ai_response(regenerate=True)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(self.upstream_requests), 1)
+
+
+@override_settings(CHAT_UPSTREAM={"POOLS": {"query": ["ep-a", "ep-b"]}})
+class ChatBalancerTests(ChatStreamTestCase):
+    """
+    模型的多个接入点之间的负载均衡：失败时换接入点重试，连续失败后暂时摘除
+    """
+
+    @staticmethod
+    def connection_error():
+        return openai.APIConnectionError(
+            request=httpx.Request("POST", "https://upstream.invalid/responses")
+        )
+
+    def test_failover(self):
+        # ep-a 的首token耗时更短，先选中 ep-a，连接失败后换到 ep-b
+        self.balancer.record_ttft("ep-a", 10)
+        self.balancer.record_ttft("ep-b", 1000)
+        failing = SimpleNamespace(
+            responses=SimpleNamespace(
+                create=mock.Mock(side_effect=self.connection_error())
+            )
+        )
+        working = SimpleNamespace(
+            responses=SimpleNamespace(create=self.create_response)
+        )
+        clients = {"ep-a": failing, "ep-b": working}
+        with mock.patch(
+            "chat.generation.upstream_clients.get_client", side_effect=clients.get
+        ):
+            frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(failing.responses.create.call_count, 1)
+        self.assertEqual(
+            [config["model"] for config in self.upstream_requests], ["ep-b"]
+        )
+        stats = self.balancer.stats()
+        self.assertEqual(stats["ep-a"]["failures"], 1)
+        self.assertEqual(stats["ep-b"]["outstanding"], 0)
+        self.assertEqual(metrics.values("balancer.failover"), [1])
+
+    def test_ejection(self):
+        with self.assertLogs("chat.balancer", "WARNING"):
+            for _ in range(3):
+                self.balancer.route(self.chat_model, exclude={"ep-b"}).finish(
+                    self.connection_error()
+                )
+        self.assertTrue(self.balancer.stats()["ep-a"]["ejected"])
+        routes = [self.balancer.route(self.chat_model) for _ in range(5)]
+        self.assertEqual({route.key for route in routes}, {"ep-b"})
+        # 可选的接入点都被摘除时仍然选择它，成功后清零连续失败次数
+        self.balancer.route(self.chat_model, exclude={"ep-b"}).finish()
+        self.assertEqual(self.balancer.stats()["ep-a"]["failures"], 0)
+
+    def test_prior(self):
+        # 没有样本的接入点按平均耗时参与比较，进行中的请求使其不再被优先选择
+        self.balancer.record_ttft("ep-a", 100)
+        self.balancer.route(self.chat_model, exclude={"ep-a"})
+        self.assertEqual(self.balancer.route(self.chat_model).key, "ep-a")
+
+
+@override_settings(CHAT_GENERATION_MODE="worker")
+class ChatGenerationWorkerTests(ChatStreamTestCase):
+    """
+    后台工作进程生成：请求只入队并转发帧缓冲，中断的任务重新入队
+    """
+
+    def dequeue(self):
+        return json.loads(self.redis.rpop(JOBS_KEY))
+
+    def test_enqueue_and_run(self):
+        self.assertTrue(enqueue_generation(self.user_message.id, 1))
+        # 排队中的重复请求不会再次入队
+        self.assertFalse(enqueue_generation(self.user_message.id, 1))
+        self.assertEqual(self.redis.llen(JOBS_KEY), 1)
+
+        run_generation_job(self.dequeue())
+        reply = ChatMessage.objects.get(
+            parent_message=self.user_message, role="assistant"
+        )
+        self.assertEqual((reply.content, reply.status), ("你好！", "complete"))
+
+        # 生成完成后的请求转发帧缓冲中的流，不再入队
+        frames = self.read_frames(self.ai_response())
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(self.redis.llen(JOBS_KEY), 0)
+        self.assertEqual(len(self.upstream_requests), 1)
+
+    def test_requeue_stale_jobs(self):
+        enqueue_generation(self.user_message.id, 1)
+        item = self.redis.rpop(JOBS_KEY)
+        # 心跳已过期的工作进程正在执行的任务重新入队，仍在运行的不受影响
+        self.redis.lpush(PROCESSING_KEY.format(worker_id="dead"), item)
+        self.redis.lpush(PROCESSING_KEY.format(worker_id="alive"), b"{}")
+        self.redis.set(WORKER_KEY.format(worker_id="alive"), 1)
+        with self.assertLogs("chat.jobs", "WARNING"):
+            self.assertEqual(requeue_stale_jobs(self.redis), 1)
+        self.assertEqual(self.redis.llen(PROCESSING_KEY.format(worker_id="alive")), 1)
+
+        # 重新执行时之前的执行已中断：未完成的AI回复标记为已中断后重新生成
+        interrupted = ChatMessage.objects.create(
+            session=self.sessions[0],
+            role="assistant",
+            content="你",
+            model=self.chat_model,
+            parent_message=self.user_message,
+            status="streaming",
+        )
+        job = self.dequeue()
+        # 中断的执行已将登记标记为生成中
+        GenerationFlight(self.user_message.id, token=job["flight"]).start()
+        with self.assertLogs("chat.jobs", "WARNING"):
+            run_generation_job(job)
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.status, "aborted")
+        self.assertTrue(
+            ChatMessage.objects.filter(
+                parent_message=self.user_message, status="complete"
+            ).exists()
+        )
+
+    def test_reap_periodically(self):
+        # 工作进程在主循环中定期检查中断的任务，而不只是在启动时
+        stop_event = threading.Event()
+        calls = []
+
+        def reap(conn):
+            calls.append(conn)
+            if len(calls) == 3:
+                stop_event.set()
+            return 0
+
+        with mock.patch("chat.jobs.requeue_stale_jobs", side_effect=reap):
+            run_worker(
+                concurrency=1,
+                stop_event=stop_event,
+                block_timeout=0.01,
+                reap_interval=0,
+            )
+        self.assertEqual(len(calls), 3)
+
+
+class ChatContextTests(ChatStreamTestCase):
+    """
+    服务端组装多轮上下文：按token预算装入分支上最近的消息
+    """
+
+    def setUp(self):
+        super().setUp()
+        # 分支：你好 -> 你好！ -> 再见 -> 再见！ -> 还在吗
+        self.history = [self.user_message]
+        for role, content in [
+            ("assistant", "你好！"),
+            ("user", "再见"),
+            ("assistant", "再见！"),
+            ("user", "还在吗"),
+        ]:
+            self.history.append(
+                ChatMessage.objects.create(
+                    session=self.sessions[0],
+                    role=role,
+                    content=content,
+                    model=self.chat_model,
+                    parent_message=self.history[-1],
+                    reasoning_content="想一想" if role == "assistant" else "",
+                    message_resp_id=f"resp_{len(self.history)}",
+                    status="complete",
+                )
+            )
+        self.current = ChatMessage.objects.select_related("parent_message").get(
+            pk=self.history[-1].pk
+        )
+
+    def test_build_context(self):
+        context = build_context(self.current, self.chat_model)
+        self.assertEqual(
+            context["input"],
+            [
+                {"role": message.role, "content": message.content}
+                for message in self.history
+            ],
+        )
+        self.assertEqual(context["messages"], 5)
+        self.assertFalse(context["truncated"])
+
+    @override_settings(CHAT_CONTEXT={"REASONING_TURNS": 1})
+    def test_reasoning(self):
+        # 只保留最近一条AI回复的推理内容，作为普通的AI回复发送
+        items = build_context(self.current, self.chat_model)["input"]
+        self.assertEqual(
+            items[3:5],
+            [
+                {"role": "assistant", "content": REASONING_PREFIX + "想一想"},
+                {"role": "assistant", "content": "再见！"},
+            ],
+        )
+        self.assertEqual(len(items), 6)
+        self.assertTrue(all("role" in item for item in items))
+
+    def test_budget(self):
+        # 预算只够最近两条消息时丢弃更早的消息，上下文不以AI回复开头
+        self.chat_model.context_budget = (
+            message_tokens(self.current) + message_tokens(self.history[-2]) + 1
+        )
+        context = build_context(self.current, self.chat_model)
+        self.assertEqual(context["input"], [{"role": "user", "content": "还在吗"}])
+        self.assertTrue(context["truncated"])
+        self.assertEqual(context["input_tokens"], message_tokens(self.current))
+
+    def test_prepare_input(self):
+        items, report = prepare_input(self.current, self.chat_model, "resp_3")
+        self.assertEqual(items, [{"role": "user", "content": "还在吗"}])
+        self.assertEqual(report["mode"], PREVIOUS_RESPONSE)
+
+        items, report = prepare_input(self.current, self.chat_model, None)
+        self.assertEqual(len(items), 5)
+        self.assertEqual((report["mode"], report["messages"]), (ASSEMBLED, 5))
+
+    def test_expired_previous_response(self):
+        # 上游已不再保存上一轮响应时，改为服务端组装上下文重试一次
+        def create(**config):
+            self.upstream_requests.append(config)
+            if len(self.upstream_requests) == 1:
+                raise openai.BadRequestError(
+                    "previous_response_id not found",
+                    response=httpx.Response(
+                        400, request=httpx.Request("POST", "https://upstream.invalid")
+                    ),
+                    body=None,
+                )
+            return UpstreamStream(self.events)
+
+        client = SimpleNamespace(responses=SimpleNamespace(create=create))
+        with mock.patch(
+            "chat.generation.upstream_clients.get_client", return_value=client
+        ):
+            frames = self.read_frames(self.ai_response(user_message_id=self.current.id))
+        self.assertEqual(self.content(frames), "你好！")
+        first, retry = self.upstream_requests
+        self.assertEqual(first["previous_response_id"], "resp_3")
+        self.assertEqual(len(first["input"]), 1)
+        self.assertNotIn("previous_response_id", retry)
+        self.assertEqual(len(retry["input"]), 5)
+        end = self.typed(frames, "message_end")[0]
+        self.assertEqual(end["data"]["context"]["mode"], ASSEMBLED)
+
+
+class ChatAsyncStreamTests(ChatStreamTestCase):
+    """
+    ASGI 下的异步流式响应：帧与同步版本一致，客户端断开时关闭上游流并释放名额
+    """
+
+    def setUp(self):
+        super().setUp()
+        token = AccessToken.for_user(self.user)
+        self.auth = {"Authorization": f"Bearer {token}"}
+
+    async def apost(self, **data):
+        data.setdefault("user_message_id", self.user_message.id)
+        return await self.async_client.post(
+            "/chat/message/ai-response/",
+            data,
+            content_type="application/json",
+            headers=self.auth,
+        )
+
+    async def test_stream(self):
+        response = await self.apost()
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        frames = [
+            self.parse_frame(raw) for raw in content.decode().split("\n\n") if raw
+        ]
+        self.assertEqual(
+            [frame["id"] for frame in frames], list(range(1, len(frames) + 1))
+        )
+        self.assertEqual(self.content(frames), "你好！")
+        self.assertEqual(
+            self.typed(frames, "message_end")[0]["data"]["status"], "complete"
+        )
+        reply = await ChatMessage.objects.aget(
+            parent_message=self.user_message, role="assistant"
+        )
+        self.assertEqual((reply.content, reply.status), ("你好！", "complete"))
+        self.assertTrue(self.upstream_streams[0].closed)
+
+    async def test_disconnect(self):
+        # 第一个增量之后上游不再产生数据，客户端在等待上游期间断开
+        waiting = asyncio.Event()
+
+        async def stall():
+            waiting.set()
+            await asyncio.Event().wait()
+
+        self.events = self.events[:2] + [stall]
+        leases = set(lease_keeper._leases)
+        response = await self.apost()
+
+        async def consume():
+            async for chunk in response.streaming_content:
+                pass
+
+        # ASGI 服务器在客户端断开时取消发送响应的任务
+        task = asyncio.ensure_future(consume())
+        await asyncio.wait_for(waiting.wait(), timeout=5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        self.assertTrue(self.upstream_streams[0].closed)
+        reply = await ChatMessage.objects.aget(
+            parent_message=self.user_message, role="assistant"
+        )
+        self.assertEqual((reply.content, reply.status), ("你", "aborted"))
+        # 接入点的进行中请求、上游并发名额与续期都已释放
+        self.assertEqual(self.balancer.stats()["query"]["outstanding"], 0)
+        self.assertEqual(self.redis.zcard(active_key("global")), 0)
+        self.assertEqual(set(lease_keeper._leases), leases)
+
+
+class UpstreamClientRegistryTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.dict(os.environ, {"ARK_API_KEY": "test"})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.registry = UpstreamClientRegistry()
+
+    def test_client_per_key(self):
+        client = self.registry.get_client("ep-a")
+        self.assertIs(self.registry.get_client("ep-a"), client)
+        self.assertIsNot(self.registry.get_client("ep-b"), client)
+        self.assertEqual(len(self.registry._transports["ep-a"]), 1)
+
+    def test_async_client_per_loop(self):
+        async def fetch():
+            client = self.registry.get_async_client("ep-a")
+            self.assertIs(self.registry.get_async_client("ep-a"), client)
+            return client
+
+        self.assertIsNot(asyncio.run(fetch()), asyncio.run(fetch()))
+
+    def test_prune_transports(self):
+        async def fetch():
+            self.registry.get_async_client("ep-a")
+
+        asyncio.run(fetch())
+        gc.collect()
+        # 事件循环释放后异步客户端随之释放，只剩失效的弱引用
+        ((transport, is_async),) = self.registry._transports["ep-a"]
+        self.assertTrue(is_async)
+        self.assertIsNone(transport())
+        self.assertEqual(self.registry.stats()["ep-a"]["pools"], [])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(fetch())
+        ((transport, is_async),) = self.registry._transports["ep-a"]
+        self.assertIsNotNone(transport())
+        self.assertEqual(len(self.registry.stats()["ep-a"]["pools"]), 1)
+
+    def test_stats(self):
+        def handle_request(request):
+            # 模拟 httpcore：新建连接后发送请求头
+            trace = request.extensions["trace"]
+            trace("connection.connect_tcp.started", {})
+            trace("http11.send_request_headers.started", {})
+            return httpx.Response(200, stream=httpx.ByteStream(b"{}"))
+
+        self.registry.get_client("ep-a")
+        http_client = self.registry._http_clients["ep-a"]
+        with mock.patch.object(
+            httpx.HTTPTransport, "handle_request", side_effect=handle_request
+        ):
+            response = http_client.send(
+                http_client.build_request("GET", "https://upstream.test/models"),
+                stream=True,
+            )
+        stats = self.registry.stats()["ep-a"]
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(stats["in_flight"], 1)
+        self.assertEqual(stats["new_connections"], 1)
+        self.assertGreaterEqual(stats["wait_ms_max"], stats["wait_ms_avg"])
+        self.assertEqual(len(stats["pools"]), 1)
+        self.assertFalse(stats["pools"][0]["async"])
+
+        # 响应关闭后请求不再计入进行中
+        response.close()
+        self.assertEqual(self.registry.stats()["ep-a"]["in_flight"], 0)
+
+
+class ChatMetricsTests(ChatApiTestCase):
+    def test_admin_only(self):
+        response = self.client.get("/chat/metrics/")
+        self.assertEqual(response.status_code, 403)
+
+
+@mock.patch("chat.management.commands.explain_chat_queries.teardown_databases")
+@mock.patch("chat.management.commands.explain_chat_queries.setup_databases")
+class ExplainChatQueriesTests(TestCase):
+    """
+    测试本身已运行在测试数据库中，不再由命令创建
+    """
+
+    def test_sqlite(self, setup_databases, teardown_databases):
+        stdout = io.StringIO()
+        call_command(
+            "explain_chat_queries",
+            users=2,
+            sessions=3,
+            messages=4,
+            stdout=stdout,
+            no_color=True,
+        )
+        output = stdout.getvalue()
+        self.assertIn("种子数据：2 个用户，6 个会话，24 条消息", output)
+        # 每个查询输出结果及至少一行执行计划
+        lines = output.splitlines()
+        results = [
+            index for index, line in enumerate(lines) if line[:4] in ("OK  ", "FAIL")
+        ]
+        self.assertEqual(len(results), 13)
+        for index in results:
+            self.assertTrue(lines[index + 1].startswith("       "))
+        self.assertIn("所有查询均使用索引", output)
+        setup_databases.assert_called_once()
+        teardown_databases.assert_called_once()
+
+    def test_unsupported_vendor(self, setup_databases, teardown_databases):
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            with self.assertRaises(CommandError):
+                call_command("explain_chat_queries", stdout=io.StringIO())
+        setup_databases.assert_not_called()
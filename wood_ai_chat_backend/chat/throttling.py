@@ -0,0 +1,64 @@
+import logging
+
+from rest_framework.throttling import UserRateThrottle
+
+from utils import metrics
+from utils.throttling import RedisRateThrottleMixin, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageCreateThrottle(RedisRateThrottleMixin, UserRateThrottle):
+    """
+    发送用户消息的限速
+    """
+
+    scope = "chat_message_create"
+
+
+class ChatSessionCreateThrottle(RedisRateThrottleMixin, UserRateThrottle):
+    """
+    创建会话的限速；会话在发送首条消息时创建，不带 session_id 的请求才计入
+    """
+
+    scope = "chat_session_create"
+
+    def allow_request(self, request, view):
+        if request.data.get("session_id"):
+            return True
+        return super().allow_request(request, view)
+
+
+class ChatTokenRateThrottle(RedisRateThrottleMixin, UserRateThrottle):
+    """
+    每个用户每分钟的大模型token预算
+
+    请求生成时只检查预算是否已用完，不预先扣除；生成结束后按上游统计的实际用量
+    扣除（debit_tokens），超出的部分记为欠额，之后的请求等待预算恢复
+    """
+
+    scope = "chat_llm_tokens"
+    cost = 0
+    required = 1
+
+
+def debit_tokens(user_id, tokens):
+    """
+    从用户的token预算中扣除一次生成的实际用量，Redis 不可用时忽略
+    """
+    if not tokens:
+        return
+    rate = ChatTokenRateThrottle.THROTTLE_RATES.get(ChatTokenRateThrottle.scope)
+    if rate is None:
+        return
+    num_tokens, duration = ChatTokenRateThrottle().parse_rate(rate)
+    key = ChatTokenRateThrottle.cache_format % {
+        "scope": ChatTokenRateThrottle.scope,
+        "ident": user_id,
+    }
+    try:
+        TokenBucket(num_tokens, duration).debit(key, tokens)
+    except Exception:
+        logger.exception("扣除token预算失败: %s", key)
+        return
+    metrics.incr("throttle.tokens_debited", tokens)
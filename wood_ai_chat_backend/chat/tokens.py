@@ -0,0 +1,137 @@
+import logging
+import re
+import threading
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 默认的分词配置，可在 settings.CHAT_TOKENIZER 中覆盖
+DEFAULT_TOKENIZER = {
+    # "tiktoken" 使用 tiktoken 分词（需要安装 tiktoken），"estimate" 按字符估算；
+    # tiktoken 不可用时回退为估算
+    "BACKEND": "tiktoken",
+    # tiktoken 的编码，与上游模型的分词器不完全一致，作为近似值
+    "ENCODING": "o200k_base",
+}
+
+# 中日韩字符（含全角标点），大多数分词器中每个字符约为 1 个token
+CJK_PATTERN = re.compile(
+    r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]"
+)
+# 其他字符平均每个token对应的字符数
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数：中日韩字符每个 1 个token，其他字符每 4 个 1 个token
+    """
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + -(-(len(text) - cjk) // CHARS_PER_TOKEN)
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def tokenizer_config():
+    """
+    获取分词配置
+    """
+    return {**DEFAULT_TOKENIZER, **getattr(settings, "CHAT_TOKENIZER", {})}
+
+
+def get_encoding():
+    """
+    获取 tiktoken 编码，不可用时返回 None；首次加载失败后不再重试
+    """
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                config = tokenizer_config()
+                _encoding = False
+                if config["BACKEND"] == "tiktoken" and tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.get_encoding(config["ENCODING"])
+                    except Exception:
+                        logger.exception("加载 tiktoken 编码失败，改为按字符估算")
+    return _encoding or None
+
+
+def count_tokens(text):
+    """
+    计算文本的token数，优先使用分词器
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_token_counts(message, usage=None):
+    """
+    计算消息各项token数，在消息写入时调用一次
+
+    用户消息的输入token数为内容的token数；AI回复优先使用上游统计的用量
+
+    :param usage: 上游的 usage，包含 input_tokens / output_tokens / output_tokens_details
+    :return: 可直接写入消息的字段
+    """
+    content_tokens = count_tokens(message.content)
+    reasoning_tokens = count_tokens(message.reasoning_content)
+    counts = {
+        "content_tokens": content_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "input_tokens": 0,
+        "output_tokens": 0,
+    }
+    if message.role != "assistant":
+        counts["input_tokens"] = content_tokens
+    elif usage is not None:
+        details = getattr(usage, "output_tokens_details", None)
+        counts["input_tokens"] = getattr(usage, "input_tokens", 0) or 0
+        counts["output_tokens"] = getattr(usage, "output_tokens", 0) or 0
+        counts["reasoning_tokens"] = (
+            getattr(details, "reasoning_tokens", 0) or reasoning_tokens
+        )
+    else:
+        counts["output_tokens"] = content_tokens + reasoning_tokens
+    return counts
+
+
+def message_tokens(message, reasoning=False):
+    """
+    消息作为上下文时的token数，优先使用写入时保存的值
+
+    :param reasoning: 是否计入推理内容
+    """
+    tokens = message.content_tokens
+    if tokens is None:
+        tokens = count_tokens(message.content)
+    if reasoning:
+        tokens += count_tokens(message.reasoning_content)
+    return tokens
+
+
+def truncate_tokens(text, max_tokens):
+    """
+    保留文本末尾不超过 max_tokens 个token的部分
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 先按非 CJK 字符的比例截取，仍然超出时逐步减少
+    start = max(len(text) - max_tokens * CHARS_PER_TOKEN, 0)
+    while (excess := estimate_tokens(text[start:]) - max_tokens) > 0:
+        start += excess
+    return "…" + text[start:]
@@ -0,0 +1,81 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from chat.models import ChatMessage, ChatSession, ChatTombstone
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def retention():
+    """
+    墓碑的保留时间，早于保留期限的同步位置需要重新加载完整列表
+    """
+    return timedelta(days=getattr(settings, "CHAT_TOMBSTONE_RETENTION_DAYS", 30))
+
+
+def _deleted_with_session(origin):
+    """
+    删除是否由会话发起；删除用户时其墓碑随之删除，不需要记录
+    """
+    if isinstance(origin, QuerySet):
+        return issubclass(origin.model, ChatSession)
+    return isinstance(origin, ChatSession)
+
+
+def session_deleting(instance, origin=None, **kwargs):
+    """
+    会话删除前记录会话及其消息的墓碑，作为 ChatSession 的 pre_delete 信号处理函数
+
+    消息只随会话级联删除，在这里一次读取其ID，不需要监听消息的删除信号
+    """
+    if not _deleted_with_session(origin):
+        return
+    message_ids = ChatMessage.objects.filter(session_id=instance.pk).values_list(
+        "id", flat=True
+    )
+    tombstones = [
+        ChatTombstone(
+            user_id=instance.user_id,
+            kind="message",
+            object_id=message_id,
+            session_id=instance.pk,
+        )
+        for message_id in message_ids.iterator(chunk_size=BATCH_SIZE)
+    ]
+    tombstones.append(
+        ChatTombstone(
+            user_id=instance.user_id,
+            kind="session",
+            object_id=instance.pk,
+            session_id=instance.pk,
+        )
+    )
+    ChatTombstone.objects.bulk_create(tombstones, batch_size=BATCH_SIZE)
+    # 顺带清理过期的墓碑
+    ChatTombstone.objects.filter(deleted_at__lt=timezone.now() - retention()).delete()
+
+
+def deleted_ids(user_id, kind, since, session_id=None):
+    """
+    增量同步时 since 之后删除的记录ID
+
+    :param kind: session 或 message
+    :param since: 同步位置的时间
+    :param session_id: 只返回该会话中删除的消息
+    :raises ValidationError: 同步位置早于墓碑的保留期限
+    """
+    if since < timezone.now() - retention():
+        raise ValidationError({"since": ["同步位置已过期，请重新加载"]})
+    tombstones = ChatTombstone.objects.filter(
+        user_id=user_id, kind=kind, deleted_at__gt=since
+    )
+    if session_id is not None:
+        tombstones = tombstones.filter(session_id=session_id)
+    return list(tombstones.order_by("deleted_at").values_list("object_id", flat=True))
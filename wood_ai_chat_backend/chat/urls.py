@@ -1,15 +1,22 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from chat.views import ChatSessionView, ChatMessageView
+from chat.views import (
+    ChatSessionView,
+    ChatMessageView,
+    ChatModelView,
+    ChatMetricsView,
+)
 
 
 router = DefaultRouter()
 router.register(r"message", ChatMessageView, basename="chat-message")
 router.register(r"session", ChatSessionView, basename="chat-session")
+router.register(r"model", ChatModelView, basename="chat-model")
 
 urlpatterns = [
     # path("session/", ChatSessionView.as_view()),
     # path("message/", ChatMessageView.as_view()),
+    path("metrics/", ChatMetricsView.as_view()),
     path("", include(router.urls)),
 ]
@@ -1,22 +1,56 @@
-import json
-import os
-import time
-
-from django.http import StreamingHttpResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Exists, OuterRef
+from django.utils.cache import get_conditional_response, patch_cache_control
 from drf_spectacular.utils import extend_schema
-from openai import OpenAI
 from rest_framework.decorators import action
-from rest_framework.generics import GenericAPIView
+from rest_framework.permissions import IsAdminUser
+from rest_framework.settings import api_settings
+from rest_framework.generics import GenericAPIView, get_object_or_404
 from rest_framework.mixins import CreateModelMixin, ListModelMixin
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
+from chat.admission import AdmissionTicket, QueueFull
+from chat.cancellation import cancellation, clear_cancel, request_cancel
+from chat.catalog import model_catalog
+from chat.compression import event_stream_response
+from chat.conditional import (
+    ConditionalListMixin,
+    history_validators,
+    session_list_validators,
+)
+from chat.encoder import COMPACT_FORMAT, OPENAI_FORMAT, STREAM_FORMATS
+from chat.generation import (
+    generate_response_response,
+    agenerate_response_response,
+    get_previous_response_id,
+)
+from chat.history_cache import HistoryCacheMixin
+from chat.jobs import use_generation_worker, enqueue_generation
 from chat.models import ChatMessage, ChatSession, ChatModel
+from chat.singleflight import GenerationFlight
+from chat.sse import (
+    SSEGenerator,
+    AsyncSSEGenerator,
+    ChunkCoalescer,
+    EventStreamRenderer,
+)
+from chat.stream_buffer import StreamBuffer, stream_buffer_config
+from chat.tombstones import deleted_ids
+from chat.throttling import (
+    ChatMessageCreateThrottle,
+    ChatSessionCreateThrottle,
+    ChatTokenRateThrottle,
+)
 from chat.serializers import (
     ChatSessionSerializer,
     ChatMessageSerializer,
     ChatModelSerializer,
 )
+from utils import metrics
+from utils.fieldsets import SparseFieldsetMixin
+from utils.pagination import MessageKeysetPagination, SessionKeysetPagination
 from utils.response import (
     StandardResponse,
     StandardRetrieveModelMixin,
@@ -26,264 +60,54 @@ from utils.response import (
 )
 
 
-class Choice:
-    def __init__(
-        self,
-        content="",
-        role="assistant",
-        index=0,
-        reasoning_content="",
-        finish_reason=None,
-    ):
-        self.content = content
-        self.role = role
-        self.index = index
-        self.reasoning_content = reasoning_content
-        self.finish_reason = finish_reason
+@extend_schema(description="聊天消息")
+class ChatMessageView(
+    ConditionalListMixin,
+    HistoryCacheMixin,
+    SparseFieldsetMixin,
+    StandardListModelMixin,
+    CreateModelMixin,
+    GenericViewSet,
+):
+    serializer_class = ChatMessageSerializer
+    pagination_class = MessageKeysetPagination
+    # 游标分页需要 created_at，增量同步需要 updated_at
+    sparse_required_fields = ("id", "created_at", "updated_at")
+    # 精简模式下收集的会话与模型数据
+    included = None
 
-    def to_dict(self):
+    def use_async_stream(self, request):
         """
-        将 Choice 对象转换为字典格式
-        """
-        choice_dict = {
-            "index": self.index,
-            "delta": {
-                "role": self.role,
-                "content": self.content,
-            },
-        }
-
-        # 只有当 reasoning_content 不为空时才添加
-        if self.reasoning_content:
-            choice_dict["delta"]["reasoning_content"] = self.reasoning_content
-
-        # 只有当 finish_reason 不为空时才添加
-        if self.finish_reason:
-            choice_dict["finish_reason"] = self.finish_reason
+        判断是否使用异步流式响应
 
-        return choice_dict
-
-
-class SSEGenerator:
-    def __init__(self, data_generator):
+        CHAT_STREAM_MODE 为 "async" 时强制异步，为 "sync" 时强制同步，
+        为 "auto"（默认）时仅在 ASGI 下使用异步，WSGI 下回退为同步
         """
-        初始化 SSEGenerator
-
-        :param data_generator: 一个生成器，产生要发送给客户端的数据字典
+        mode = getattr(settings, "CHAT_STREAM_MODE", "auto")
+        if mode == "async":
+            return True
+        if mode == "sync":
+            return False
+        return isinstance(request._request, ASGIRequest)
+
+    def get_stream_format(self, request):
         """
-        self.data_generator = data_generator
+        协商AI回复的流式输出格式
 
-    @staticmethod
-    def create_chat_chunk(
-        id,
-        choices,
-        model,
-        created=int(time.time()),
-        object_type="response",
-        usage=None,
-    ):
-        """
-        创建一个符合格式的聊天块
-
-        :param id: 响应ID
-        :param choices: 选择项列表
-        :param created: 创建时间戳
-        :param model: 模型名称
-        :param object_type: 对象类型
-        :param usage: 使用情况统计
-        :return: 格式化的字典
-        """
-        chunk = {
-            "id": id,
-            "choices": choices,
-            "created": created,
-            "model": model,
-            "object": object_type,
-        }
-
-        if usage:
-            chunk["usage"] = usage
-
-        return chunk
-
-    def __iter__(self):
-        """
-        使对象可迭代，生成 SSE 格式的响应
+        查询参数 stream_format 优先，其次为 Accept: text/event-stream; format=compact，
+        默认为 OpenAI 风格的数据块
         """
-        try:
-            for data_dict in self.data_generator:
-                # 确保数据是字典格式
-                if isinstance(data_dict, dict):
-                    # 生成 SSE 格式的响应
-                    yield f"data: {json.dumps(data_dict, separators=(',', ':'))}\n\n"
-                else:
-                    # 如果不是字典，转换为字符串处理
-                    yield f"data: {str(data_dict)}\n\n"
-        except Exception as e:
-            # 发送错误信息给客户端
-            error_data = {"error": str(e)}
-            yield f"data: {json.dumps(error_data)}\n\n"
-
-
-@extend_schema(description="聊天消息")
-class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
-    think = ("disabled", "enabled", "auto")
-    api_key = os.environ.get("ARK_API_KEY")
-    OpenAI_client = OpenAI(
-        base_url="https://ark.cn-beijing.volces.com/api/v3",
-        api_key=api_key,
-        # 设置服务响应超时时间，单位秒，推荐1800秒及以上
-        timeout=1800,
-        # 设置重试次数
-        max_retries=2,
-    )
-    serializer_class = ChatMessageSerializer
-
-    # 获取 Response API 的响应数据
-    def generate_response_response(
-        self, user_message, chat_session, chat_model, think_type, previous_response_id
-    ):
-        # 创建 Response API 的配置
-        response_config = {
-            "model": chat_model.model_id,
-            "input": [{"role": "user", "content": user_message.content}],
-            "stream": True,
-            "extra_body": {
-                "thinking": {"type": self.think[think_type]},
-            },
-        }
-        if previous_response_id:
-            response_config["previous_response_id"] = previous_response_id
-
-        client = self.OpenAI_client
-        res = client.responses.create(**response_config)
-
-        # 收集AI回复消息
-        ai_content = {
-            "reasoning_content": "",
-            "content": "",
-            "tokens": 0,
-            "response_id": "",
-        }
-
-        # 先发送完整的消息结构（除了reasoning_content、content和tokens）
-        message_data = {
-            "id": -1,  # 将在保存后更新
-            "role": "assistant",
-            "reasoning_content": "",  # 将逐步更新
-            "content": "",  # 将逐步更新
-            "created_at": None,  # 将在保存后更新
-            "tokens": 0,  # 将逐步更新
-            "message_resp_id": None,  # 将在保存后更新
-            "session": ChatSessionSerializer(chat_session).data,
-            "model": ChatModelSerializer(chat_model).data,
-            # "session": {
-            #     "id": chat_session.id,
-            #     "title": chat_session.title,
-            #     "user": chat_session.user.id,
-            #     "updated_at": (
-            #         chat_session.updated_at.strftime("%Y-%m-%d %H:%M:%S")
-            #         if chat_session.updated_at
-            #         else None
-            #     ),
-            #     "is_active": chat_session.is_active,
-            #     "created_at": (
-            #         chat_session.created_at.strftime("%Y-%m-%d %H:%M:%S")
-            #         if chat_session.created_at
-            #         else None
-            #     ),
-            # },
-            # "model": {
-            #     "id": chat_model.id,
-            #     "name": chat_model.name,
-            #     "model_id": chat_model.model_id,
-            #     "description": chat_model.description,
-            #     "is_active": chat_model.is_active,
-            #     "ep_id": chat_model.ep_id,
-            # },
-            "parent_message": user_message.id,
-        }
-
-        # 发送初始消息结构
-        yield {"type": "message_start", "data": message_data}
-
-        try:
-            for chunk in res:
-                if hasattr(chunk, "type"):
-                    # 获取AI回复ID
-                    if (
-                        ai_content["response_id"] == ""
-                        and chunk.type == "response.created"
-                    ):
-                        ai_content["response_id"] = chunk.response.id
-                        continue
-                    # 收集AI回复消息
-                    if chunk.type == "response.reasoning_summary_text.delta":
-                        ai_content["reasoning_content"] += chunk.delta
-
-                        yield SSEGenerator.create_chat_chunk(
-                            id=chunk.item_id,
-                            choices=[
-                                Choice(
-                                    content="",
-                                    role="assistant",
-                                    reasoning_content=chunk.delta,
-                                ).to_dict()
-                            ],
-                            model=chat_model.model_id,
-                        )
-                    elif chunk.type == "response.output_text.delta":
-                        ai_content["content"] += chunk.delta
-                        yield SSEGenerator.create_chat_chunk(
-                            id=chunk.item_id,
-                            choices=[
-                                Choice(
-                                    content=chunk.delta,
-                                    role="assistant",
-                                ).to_dict()
-                            ],
-                            model=chat_model.model_id,
-                        )
-                    # 统计token
-                    if chunk.type == "response.completed":
-                        ai_content["tokens"] = chunk.response.usage.total_tokens
-                        yield SSEGenerator.create_chat_chunk(
-                            id=chunk.response.id,
-                            choices=[],
-                            usage=chunk.response.usage.total_tokens,
-                            model=chat_model.model_id,
-                        )
-        finally:
-            # 保存AI回复消息
-            ai_message_ser = ChatMessageSerializer(
-                data={
-                    "reasoning_content": ai_content["reasoning_content"],
-                    "content": ai_content["content"],
-                    "session": chat_session.id,
-                    "role": "assistant",
-                    "model": chat_model.id,
-                    "tokens": ai_content["tokens"],
-                    "parent_message": user_message.id,
-                    "message_resp_id": (
-                        ai_content["response_id"] if ai_content["response_id"] else None
-                    ),
-                }
-            )
-            ai_message_ser.is_valid(raise_exception=True)
-            ai_message_instance = ai_message_ser.save()
-
-            # 在流的最后发送完整的AI消息数据
-            yield {
-                "type": "message_end",
-                "data": {
-                    "id": ai_message_instance.id,
-                    "created_at": ai_message_instance.created_at.strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    ),
-                    "message_resp_id": ai_message_instance.message_resp_id,
-                    "tokens": ai_message_instance.tokens,
-                },
-            }
+        stream_format = request.query_params.get("stream_format")
+        if stream_format in STREAM_FORMATS:
+            return stream_format
+        for media_range in request.headers.get("Accept", "").split(","):
+            media_type, *params = [part.strip() for part in media_range.split(";")]
+            if (
+                media_type == "text/event-stream"
+                and f"format={COMPACT_FORMAT}" in params
+            ):
+                return COMPACT_FORMAT
+        return OPENAI_FORMAT
 
     def get_queryset(self):
         """
@@ -291,13 +115,60 @@ class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
         """
         user = self.request.user
         queryset = ChatMessage.objects.filter(session__user=user)
+        # 序列化时需要会话数据，模型数据来自模型目录
+        if self.sparse_field_selected("session"):
+            queryset = queryset.select_related("session")
 
         # 如果提供了session_id查询参数，则进一步过滤
         session_id = self.request.query_params.get("session_id")
         if session_id:
             queryset = queryset.filter(session_id=session_id)
 
-        return queryset
+        return self.sparse_queryset(queryset)
+
+    def get_list_validators(self, request):
+        """
+        只有按 session_id 查询当前用户的消息历史支持条件请求
+        """
+        session_id = request.query_params.get("session_id")
+        if not session_id or not session_id.isdigit():
+            return None
+        return history_validators(int(session_id), request.user.pk)
+
+    def get_deleted_ids(self, since):
+        """
+        增量同步时返回 since 之后删除的消息ID
+        """
+        session_id = self.request.query_params.get("session_id", "")
+        return deleted_ids(
+            self.request.user.pk,
+            "message",
+            since,
+            session_id=int(session_id) if session_id.isdigit() else None,
+        )
+
+    def get_serializer_context(self):
+        """
+        列表请求携带 slim=1 时使用精简模式，会话与模型数据只在 included 中出现一次
+        """
+        context = super().get_serializer_context()
+        self.included = None
+        if self.action == "list" and self.request.query_params.get("slim") in (
+            "1",
+            "true",
+        ):
+            self.included = {"sessions": {}, "models": {}}
+            context["included"] = self.included
+        return context
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if self.included is not None:
+            response.data["included"] = {
+                "sessions": list(self.included["sessions"].values()),
+                "models": list(self.included["models"].values()),
+            }
+        return response
 
     # def create(self, request, *args, **kwargs):
     #     user = request.user
@@ -366,6 +237,13 @@ class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
     #         content_type="text/event-stream",
     #     )
 
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if self.action == "create":
+            # 发送消息，不带 session_id 时同时创建会话
+            throttles += [ChatMessageCreateThrottle(), ChatSessionCreateThrottle()]
+        return throttles
+
     def create(self, request, *args, **kwargs):
         user = request.user
 
@@ -398,7 +276,7 @@ class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
 
         # 验证模型是否存在
         try:
-            chat_model = ChatModel.objects.get(model_id=model_id)
+            chat_model = model_catalog.get(model_id=model_id)
         except ChatModel.DoesNotExist:
             return StandardResponse(status=404, message="当前模型不存在")
 
@@ -424,7 +302,122 @@ class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
             data=ChatMessageSerializer(user_message).data,
         )
 
-    @action(detail=False, methods=["post"], url_path="ai-response")
+    @staticmethod
+    def relay_response(request, buffer, last_event_id, use_async):
+        """
+        从 SSE 帧缓冲转发AI回复：补发 last_event_id 之后的帧，并跟随生成直到结束
+        """
+        return event_stream_response(
+            request,
+            (
+                buffer.areplay(last_event_id)
+                if use_async
+                else buffer.replay(last_event_id)
+            ),
+        )
+
+    @action(detail=True, methods=["get"], url_path="reasoning")
+    def reasoning(self, request, *args, **kwargs):
+        """
+        获取消息的推理内容，配合列表的 exclude=reasoning_content 在用户展开时按需加载
+        """
+        queryset = (
+            ChatMessage.objects.filter(session__user=request.user)
+            .only("id", "reasoning_content")
+            .order_by()
+        )
+        message = get_object_or_404(queryset, pk=kwargs["pk"])
+        return StandardResponse(
+            data={"id": message.id, "reasoning_content": message.reasoning_content}
+        )
+
+    def get_tree_node(self, pk):
+        """
+        获取当前用户的消息在对话树中的位置
+        """
+        queryset = (
+            ChatMessage.objects.filter(session__user=self.request.user)
+            .only("id", "session_id", "parent_message_id", "tree_path")
+            .order_by()
+        )
+        return get_object_or_404(queryset, pk=pk)
+
+    def tree_response(self, queryset):
+        serializer = self.get_serializer(queryset, many=True)
+        return StandardResponse(data=serializer.data)
+
+    @action(detail=True, methods=["get"], url_path="branch")
+    def branch(self, request, *args, **kwargs):
+        """
+        获取从根消息到该消息的分支，按主键批量读取
+
+        父消息总是先于子消息创建，按ID排序即为层级顺序；分支只有 depth + 1 条消息，
+        在内存中排序，避免数据库对 IN 查询的结果再排序
+        """
+        node = self.get_tree_node(kwargs["pk"])
+        queryset = (
+            self.get_queryset()
+            .filter(id__in=[*node.ancestor_ids(), node.id])
+            .order_by()
+        )
+        return self.tree_response(sorted(queryset, key=lambda message: message.id))
+
+    @action(detail=True, methods=["get"], url_path="siblings")
+    def siblings(self, request, *args, **kwargs):
+        """
+        获取与该消息同一父消息的所有消息（包括自身），如重新生成的多个回复
+        """
+        node = self.get_tree_node(kwargs["pk"])
+        queryset = (
+            self.get_queryset()
+            .filter(
+                session_id=node.session_id, parent_message_id=node.parent_message_id
+            )
+            .order_by("created_at", "id")
+        )
+        return self.tree_response(queryset)
+
+    @action(detail=False, methods=["get"], url_path="tips")
+    def tips(self, request, *args, **kwargs):
+        """
+        获取会话中所有分支的末端消息（没有子消息的消息）
+        """
+        if not request.query_params.get("session_id"):
+            return StandardResponse(status=400, message="缺少 session_id 参数")
+        queryset = (
+            self.get_queryset()
+            .filter(
+                ~Exists(ChatMessage.objects.filter(parent_message_id=OuterRef("pk")))
+            )
+            .order_by("created_at", "id")
+        )
+        return self.tree_response(queryset)
+
+    @action(detail=True, methods=["post"], url_path="stop")
+    def stop(self, request, *args, **kwargs):
+        """
+        停止AI回复的生成，id 可以是用户消息或生成中的AI回复消息
+        """
+        message = self.get_object()
+        user_message_id = (
+            message.id if message.role == "user" else message.parent_message_id
+        )
+        if user_message_id is None:
+            return StandardResponse(status=400, message="该消息没有对应的生成")
+
+        request_cancel(user_message_id)
+        return StandardResponse(message="已停止生成")
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="ai-response",
+        renderer_classes=[*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer],
+        throttle_classes=[
+            *api_settings.DEFAULT_THROTTLE_CLASSES,
+            ChatTokenRateThrottle,
+        ],
+    )
     def ai_response(self, request, *args, **kwargs):
         """
         获取AI响应的独立端点
@@ -434,38 +427,119 @@ class ChatMessageView(StandardListModelMixin, CreateModelMixin, GenericViewSet):
         data = request.data
         user_message_id = data.get("user_message_id")
         think_type = data.get("think_type", 1)
+        # 增量合并的时间窗口（毫秒），不传时使用部署配置
+        coalesce_ms = data.get("coalesce_ms")
+        # 重新生成已完成的回复；不传时重复的请求得到同一个回复
+        regenerate = bool(data.get("regenerate", False))
+        stream_format = self.get_stream_format(request)
 
         try:
-            user_message = ChatMessage.objects.get(
-                id=user_message_id, session__user=user, role="user"
-            )
+            user_message = ChatMessage.objects.select_related(
+                "session", "parent_message"
+            ).get(id=user_message_id, session__user=user, role="user")
         except ChatMessage.DoesNotExist:
             return StandardResponse(status=404, message="用户消息不存在或无权限访问")
 
-        chat_session = user_message.session
-        chat_model = user_message.model
+        use_async = self.use_async_stream(request)
+        buffer = None
+        flight = None
+        if stream_buffer_config()["ENABLED"]:
+            buffer = StreamBuffer(user_message.id)
+            # 断线重连：补发错过的帧并继续跟随生成，不再重新请求上游
+            last_event_id = request.headers.get("Last-Event-ID")
+            if last_event_id is not None and buffer.exists():
+                return self.relay_response(request, buffer, last_event_id, use_async)
+            # 由后台工作进程生成，当前请求只订阅并转发；重复的请求转发同一个任务
+            if use_generation_worker():
+                enqueue_generation(
+                    user_message.id,
+                    think_type,
+                    coalesce_ms,
+                    stream_format,
+                    regenerate=regenerate,
+                )
+                return self.relay_response(request, buffer, 0, use_async)
 
-        previous_response_id = (
-            user_message.parent_message.message_resp_id
-            if user_message.parent_message
-            and user_message.parent_message.message_resp_id
-            else None
-        )
+        chat_session = user_message.session
+        try:
+            chat_model = model_catalog.get(id=user_message.model_id)
+        except ChatModel.DoesNotExist:
+            return StandardResponse(status=404, message="当前模型不存在")
 
-        sse_response = SSEGenerator(
-            self.generate_response_response(
-                user_message, chat_session, chat_model, think_type, previous_response_id
+        if buffer is not None:
+            # 同一条用户消息同时只有一个生成：重复的请求从头转发进行中或刚完成的流，
+            # 不再请求上游，也不会保存重复的AI回复
+            flight = GenerationFlight(user_message.id)
+            if not flight.claim(regenerate=regenerate):
+                metrics.incr("generation.coalesced")
+                return self.relay_response(request, buffer, 0, use_async)
+            # 只清空已结束的生成留下的流，进行中的生成不会被替换
+            if flight.replaces_stream:
+                buffer.reset()
+
+        # 上游并发名额：排队的请求已达上限时直接返回 429，否则在流中排队等待
+        ticket = AdmissionTicket.for_request(user.pk, chat_model)
+        if ticket is not None:
+            try:
+                ticket.enqueue()
+            except QueueFull as e:
+                if flight is not None:
+                    flight.release()
+                response = StandardResponse(status=429, message=str(e))
+                response["Retry-After"] = str(ticket.config["RETRY_AFTER"])
+                return response
+        previous_response_id = get_previous_response_id(user_message)
+
+        # 注册取消标记，支持通过 stop 端点从任意工作进程停止生成
+        clear_cancel(user_message.id)
+        cancel_token = cancellation.register(user_message.id)
+        coalescer = ChunkCoalescer.from_request(coalesce_ms)
+
+        if use_async:
+            # ASGI 下使用异步生成器，流式输出期间不占用工作线程
+            sse_response = AsyncSSEGenerator(
+                agenerate_response_response(
+                    user_message,
+                    chat_session,
+                    chat_model,
+                    think_type,
+                    previous_response_id,
+                    cancel_token=cancel_token,
+                    stream_format=stream_format,
+                    ticket=ticket,
+                ),
+                buffer=buffer,
+                cancel_token=cancel_token,
+                coalescer=coalescer,
+                flight=flight,
+            )
+        else:
+            sse_response = SSEGenerator(
+                generate_response_response(
+                    user_message,
+                    chat_session,
+                    chat_model,
+                    think_type,
+                    previous_response_id,
+                    cancel_token=cancel_token,
+                    stream_format=stream_format,
+                    ticket=ticket,
+                ),
+                buffer=buffer,
+                cancel_token=cancel_token,
+                coalescer=coalescer,
+                flight=flight,
             )
-        )
 
-        return StreamingHttpResponse(
-            sse_response,
-            content_type="text/event-stream",
-        )
+        response = event_stream_response(request, sse_response)
+        response["X-Stream-Format"] = stream_format
+        return response
 
 
 @extend_schema(description="聊天会话")
 class ChatSessionView(
+    ConditionalListMixin,
+    SparseFieldsetMixin,
     StandardListModelMixin,
     StandardRetrieveModelMixin,
     StandardUpdateModelMixin,
@@ -473,10 +547,53 @@ class ChatSessionView(
     GenericViewSet,
 ):
     serializer_class = ChatSessionSerializer
+    pagination_class = SessionKeysetPagination
+    # 游标分页需要 updated_at
+    sparse_required_fields = ("id", "updated_at")
 
     def get_queryset(self):
         # 从 request 中获取当前用户
         user = self.request.user
         queryset = ChatSession.objects.filter(user=user)
 
-        return queryset
+        return self.sparse_queryset(queryset)
+
+    def get_list_validators(self, request):
+        return session_list_validators(request.user.pk)
+
+    def get_deleted_ids(self, since):
+        """
+        增量同步时返回 since 之后删除的会话ID
+        """
+        return deleted_ids(self.request.user.pk, "session", since)
+
+
+@extend_schema(description="大模型")
+class ChatModelView(GenericViewSet):
+    serializer_class = ChatModelSerializer
+
+    def list(self, request, *args, **kwargs):
+        """
+        获取启用的模型列表，数据来自进程内的模型目录，支持 If-None-Match 协商缓存
+        """
+        data, etag = model_catalog.listing()
+        # 按 RFC 9110 解析 If-None-Match：逗号分隔的多个 ETag、弱比较以及 *
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = StandardResponse(data=data)
+        response["ETag"] = etag
+        # 每次使用前向服务端确认，模型变更后立即生效
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+@extend_schema(description="聊天服务运行统计")
+class ChatMetricsView(APIView):
+    # 统计中包含上游接入点标识、连接池占用与负载均衡状态，仅管理员可见
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        """
+        获取上游连接池等运行统计
+        """
+        return StandardResponse(data=metrics.snapshot())
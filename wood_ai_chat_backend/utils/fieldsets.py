@@ -0,0 +1,84 @@
+from rest_framework.exceptions import ValidationError
+
+
+class SparseFieldsetSerializerMixin:
+    """
+    按序列化器 context 中的 fields 裁剪输出字段，与 SparseFieldsetMixin 配合使用
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selected = self.context.get("fields")
+        if selected is not None:
+            for name in list(fields):
+                if name not in selected:
+                    fields.pop(name)
+        return fields
+
+
+class SparseFieldsetMixin:
+    """
+    视图的稀疏字段集：GET 请求可通过 fields= / exclude=（逗号分隔）指定返回的字段，
+    同时裁剪序列化器的输出与 SQL 查询的列（defer）
+    """
+
+    # 无论是否返回都需要从数据库读取的字段，如分页使用的排序字段
+    sparse_required_fields = ("id",)
+
+    def get_sparse_fieldset(self):
+        """
+        解析 fields / exclude 参数
+
+        :return: 需要返回的字段名集合，未指定时返回 None
+        """
+        if hasattr(self, "_sparse_fieldset"):
+            return self._sparse_fieldset
+        self._sparse_fieldset = None
+        if self.request.method != "GET":
+            return None
+
+        params = self.request.query_params
+        fields = {name.strip() for name in params.get("fields", "").split(",")} - {""}
+        exclude = {name.strip() for name in params.get("exclude", "").split(",")} - {""}
+        if not fields and not exclude:
+            return None
+
+        names = set(self.get_serializer_class()().fields)
+        unknown = (fields | exclude) - names
+        if unknown:
+            raise ValidationError(
+                {"fields": [f"未知字段: {', '.join(sorted(unknown))}"]}
+            )
+        # id 始终返回
+        self._sparse_fieldset = ((fields or names) - exclude) | {"id"}
+        return self._sparse_fieldset
+
+    def sparse_field_selected(self, name):
+        """
+        判断字段是否需要返回
+        """
+        selected = self.get_sparse_fieldset()
+        return selected is None or name in selected
+
+    def sparse_queryset(self, queryset):
+        """
+        延迟加载不需要返回的列
+        """
+        selected = self.get_sparse_fieldset()
+        if selected is None:
+            return queryset
+        deferred = [
+            field.name
+            for field in queryset.model._meta.concrete_fields
+            if not field.primary_key
+            and field.name not in selected
+            and field.name not in self.sparse_required_fields
+        ]
+        return queryset.defer(*deferred)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        selected = self.get_sparse_fieldset()
+        if selected is not None:
+            context["fields"] = selected
+        return context
@@ -0,0 +1,70 @@
+import threading
+
+from django_redis import get_redis_connection
+
+# 跨进程共享的计数器保存在 Redis 的这个 hash 中
+COUNTERS_KEY = "metrics:counters"
+
+# 进程内统计项：名称 -> 返回统计数据的函数
+_stats_providers = {}
+_lock = threading.Lock()
+
+
+def register_stats(name, provider):
+    """
+    注册一个进程内统计项
+
+    :param name: 统计项名称，作为 /chat/metrics/ 返回数据中的键
+    :param provider: 无参函数，返回可 JSON 序列化的统计数据
+    """
+    with _lock:
+        _stats_providers[name] = provider
+
+
+def incr(name, amount=1):
+    """
+    增加一个跨进程共享的计数器，Redis 不可用时静默忽略
+
+    :param name: 计数器名称
+    :param amount: 增加的数量
+    """
+    if not amount:
+        return
+    try:
+        get_redis_connection("default").hincrby(COUNTERS_KEY, name, int(amount))
+    except Exception:
+        pass
+
+
+def counters():
+    """
+    获取所有跨进程共享的计数器
+    """
+    try:
+        raw = get_redis_connection("default").hgetall(COUNTERS_KEY)
+    except Exception:
+        return {}
+    return {key.decode(): int(value) for key, value in raw.items()}
+
+
+def values(*names):
+    """
+    获取指定的跨进程共享计数器，不存在时为 0
+    """
+    try:
+        raw = get_redis_connection("default").hmget(COUNTERS_KEY, names)
+    except Exception:
+        return [0] * len(names)
+    return [int(value) if value else 0 for value in raw]
+
+
+def snapshot():
+    """
+    汇总计数器与所有进程内统计项
+    """
+    with _lock:
+        providers = dict(_stats_providers)
+    data = {"counters": counters()}
+    for name, provider in providers.items():
+        data[name] = provider()
+    return data
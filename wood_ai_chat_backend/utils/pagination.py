@@ -0,0 +1,155 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+
+from utils.response import StandardResponse
+
+
+class KeysetPagination(BasePagination):
+    """
+    基于 (排序字段, id) 的游标分页
+
+    只有请求携带 limit / cursor / since 参数时才分页，否则返回完整列表，兼容旧客户端。
+    每页按索引从上一页最后一条记录之后读取 limit + 1 条，不需要 COUNT(*) 与 OFFSET：
+
+    - cursor：上一页返回的 next_cursor，继续读取下一页
+    - since：之前返回的 sync_cursor，只读取同步字段在其之后的记录（增量同步），
+      按同步字段升序返回，数据较多时同样通过 next_cursor 分页；视图实现
+      get_deleted_ids(since) 时，首页同时在 deleted 中返回 since 之后删除的ID
+    """
+
+    # 排序字段，与 id 组成游标
+    ordering_field = "created_at"
+    # 增量同步的排序字段，需要在记录每次修改时更新，默认与 ordering_field 相同
+    sync_field = None
+    # 普通列表是否倒序（最新的在前），增量同步始终升序
+    descending = False
+    page_size = 50
+    max_page_size = 200
+    limit_query_param = "limit"
+    cursor_query_param = "cursor"
+    since_query_param = "since"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if not any(
+            name in params
+            for name in (
+                self.limit_query_param,
+                self.cursor_query_param,
+                self.since_query_param,
+            )
+        ):
+            return None
+
+        self.limit = self.get_limit(request)
+        cursor = self.decode_cursor(params.get(self.cursor_query_param))
+        since = self.decode_cursor(params.get(self.since_query_param))
+        if cursor is not None:
+            mode, *key = cursor
+        elif since is not None:
+            mode, key = "sync", since[1:]
+        else:
+            mode, key = "page", None
+        descending = self.descending and mode == "page"
+        sync_field = self.sync_field or self.ordering_field
+        field = sync_field if mode == "sync" else self.ordering_field
+
+        # 首次请求时返回当前的同步位置；先于分页查询获取，避免遗漏其间变更的记录
+        self.sync_cursor = None
+        if cursor is None:
+            latest = (
+                queryset.order_by(f"-{sync_field}", "-id")
+                .values_list(sync_field, "id")
+                .first()
+            )
+            if latest is not None:
+                self.sync_cursor = self.encode_cursor("sync", *latest)
+
+        # 增量同步的首页返回 since 之后删除的记录
+        self.deleted = None
+        get_deleted_ids = getattr(view, "get_deleted_ids", None)
+        if since is not None and cursor is None and get_deleted_ids is not None:
+            self.deleted = get_deleted_ids(since[1])
+
+        prefix = "-" if descending else ""
+        queryset = queryset.order_by(f"{prefix}{field}", f"{prefix}id")
+        if key:
+            queryset = queryset.filter(self.after(field, key, descending))
+        rows = list(queryset[: self.limit + 1])
+        self.next_cursor = None
+        if len(rows) > self.limit:
+            rows = rows[: self.limit]
+            last = rows[-1]
+            self.next_cursor = self.encode_cursor(mode, getattr(last, field), last.id)
+        return rows
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, 0))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    @staticmethod
+    def after(field, key, descending):
+        """
+        位于游标之后的记录：(field, id) 严格大于（倒序时小于）游标
+        """
+        value, id = key
+        op = "lt" if descending else "gt"
+        return Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"id__{op}": id})
+
+    @staticmethod
+    def encode_cursor(mode, value, id):
+        data = json.dumps([mode, value.isoformat(), id])
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        :return: (模式, 排序字段的值, id)，没有游标时返回 None
+        """
+        if not cursor:
+            return None
+        try:
+            padding = "=" * (-len(cursor) % 4)
+            mode, value, id = json.loads(base64.urlsafe_b64decode(cursor + padding))
+            if mode not in ("page", "sync"):
+                raise ValueError(mode)
+            return mode, datetime.fromisoformat(value), int(id)
+        except (TypeError, ValueError):
+            raise ValidationError({"cursor": ["无效的游标"]})
+
+    def get_paginated_response(self, data):
+        return StandardResponse(
+            data=data,
+            next_cursor=self.next_cursor,
+            sync_cursor=self.sync_cursor,
+            deleted=self.deleted,
+        )
+
+
+class MessageKeysetPagination(KeysetPagination):
+    """
+    消息按 (created_at, id) 升序分页；增量同步按 (updated_at, id) 返回 since 之后
+    新建或修改的消息，生成中的AI回复在之后的同步中返回最终内容
+    """
+
+    ordering_field = "created_at"
+    sync_field = "updated_at"
+
+
+class SessionKeysetPagination(KeysetPagination):
+    """
+    会话按 (updated_at, id) 倒序分页；增量同步返回 since 之后更新过的会话
+    """
+
+    ordering_field = "updated_at"
+    descending = True
@@ -0,0 +1,124 @@
+import logging
+import math
+
+from django_redis import get_redis_connection
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 令牌桶：按经过的时间补充令牌，令牌数不少于 required 时扣除 cost
+# 时间取 Redis 服务器时间，多个工作进程的时钟偏差不影响限速
+# 返回 {是否通过, 需要等待的毫秒数}
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local required = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= required then
+    allowed = 1
+    tokens = tokens - cost
+else
+    wait = math.ceil((required - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+-- 补满令牌后与不存在等价
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1000)
+return {allowed, wait}
+"""
+
+# 扣除令牌时不要求剩余令牌数，令牌数可以为负，之后的请求等待补足
+UNCONDITIONAL = -(2**53)
+
+
+class TokenBucket:
+    """
+    Redis 令牌桶，每次检查或扣除都是一次原子的 Redis 往返
+
+    :param capacity: 桶容量，即允许的突发量
+    :param duration: 补满整个桶的时间，单位秒
+    """
+
+    def __init__(self, capacity, duration):
+        self.capacity = capacity
+        self.rate = capacity / (duration * 1000)
+
+    def take(self, key, cost=1, required=None):
+        """
+        :param cost: 通过时扣除的令牌数
+        :param required: 通过需要的最少令牌数，默认为 cost
+        :return: (是否通过, 需要等待的秒数)
+        """
+        if required is None:
+            required = cost
+        script = get_redis_connection("default").register_script(TOKEN_BUCKET_SCRIPT)
+        allowed, wait_ms = script(
+            keys=[key], args=[self.capacity, repr(self.rate), cost, required]
+        )
+        return bool(allowed), wait_ms / 1000
+
+    def debit(self, key, cost):
+        """
+        按实际用量扣除令牌，令牌不足时记为欠额
+        """
+        self.take(key, cost=cost, required=UNCONDITIONAL)
+
+
+class RedisRateThrottleMixin:
+    """
+    用 Redis 令牌桶替代 SimpleRateThrottle 基于缓存的时间戳列表
+
+    SimpleRateThrottle 每次请求先读取再写回整个时间戳列表，并发请求之间会互相覆盖；
+    令牌桶在一个 Lua 脚本中完成补充与扣除，速率配置仍使用 DEFAULT_THROTTLE_RATES。
+    Redis 不可用时不限速
+    """
+
+    cache_format = "throttle:%(scope)s:%(ident)s"
+    # 每次请求扣除的令牌数
+    cost = 1
+    # 通过需要的最少令牌数，默认为 cost
+    required = None
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        bucket = TokenBucket(self.num_requests, self.duration)
+        try:
+            allowed, self.wait_seconds = bucket.take(
+                self.key, cost=self.cost, required=self.required
+            )
+        except Exception:
+            logger.exception("限速检查失败，不限制本次请求: %s", self.key)
+            return True
+        if not allowed:
+            metrics.incr(f"throttle.rejected.{self.scope}")
+        return allowed
+
+    def wait(self):
+        return math.ceil(self.wait_seconds) or None
+
+
+class RedisUserRateThrottle(RedisRateThrottleMixin, UserRateThrottle):
+    """
+    按用户限速，未登录时按 IP
+    """
+
+
+class RedisAnonRateThrottle(RedisRateThrottleMixin, AnonRateThrottle):
+    """
+    未登录用户按 IP 限速
+    """
@@ -3,6 +3,10 @@ ASGI config for wood_ai_chat_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serving through this module (e.g. ``uvicorn wood_ai_chat_backend.asgi:application``)
+lets ``ChatMessageView.ai_response`` stream with an async generator instead of
+holding a worker thread per response, see ``CHAT_STREAM_MODE`` in settings.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
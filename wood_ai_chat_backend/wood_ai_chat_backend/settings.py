@@ -168,8 +168,8 @@ AUTH_USER_MODEL = "users.User"  # 替换为你的 app 名和模型名
 REST_FRAMEWORK = {
     "UNAUTHENTICATED_USER": None,
     "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.AnonRateThrottle",
-        "rest_framework.throttling.UserRateThrottle",
+        "utils.throttling.RedisAnonRateThrottle",
+        "utils.throttling.RedisUserRateThrottle",
     ],
     "DEFAULT_THROTTLE_RATES": {
         "anon": "60/min",  # 匿名用户每分钟60次
@@ -178,6 +178,7 @@ REST_FRAMEWORK = {
         ),  # 认证用户每分钟1000次(开发)或5000次(生产)
         "chat_message_create": "120/min",  # 聊天消息创建限速，每分钟120次
         "chat_session_create": "30/min",  # 会话创建限速，每分钟30次
+        "chat_llm_tokens": "200000/min",  # 每个用户每分钟的大模型token预算
     },
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework_simplejwt.authentication.JWTAuthentication",
@@ -234,6 +235,7 @@ CORS_ALLOW_HEADERS = [
     "user-agent",
     "x-csrftoken",
     "x-requested-with",
+    "last-event-id",  # SSE 断线续传
 ]
 
 # 邮件配置
@@ -252,3 +254,124 @@ SITE_PROTOCOL = "http://" if DEBUG else "https://"
 
 # 前端验证结果页面URL
 FRONTEND_VERIFY_RESULT_URL = "http://localhost:5173/verify-result"
+
+# AI响应流式输出模式："auto" 在 ASGI 下使用异步流、WSGI 下使用同步流，
+# "async" 强制异步流（需通过 asgi.py 部署），"sync" 强制同步流
+CHAT_STREAM_MODE = "auto"
+
+# 上游大模型接入配置，按推理接入点（ep_id / model_id）维护长连接池，
+# 未配置的项使用 chat/clients.py 中的默认值
+CHAT_UPSTREAM = {
+    "BASE_URL": "https://ark.cn-beijing.volces.com/api/v3",
+    "TIMEOUT": 1800,  # 服务响应超时时间，单位秒，推荐1800秒及以上
+    "MAX_RETRIES": 2,  # 重试次数
+    "MAX_CONNECTIONS": 100,  # 每个接入点的最大连接数
+    "MAX_KEEPALIVE_CONNECTIONS": 20,  # 每个接入点保持的最大空闲长连接数
+    "KEEPALIVE_EXPIRY": 120,  # 空闲长连接过期时间，单位秒
+    "HTTP2": True,  # 安装 h2 后启用 HTTP/2
+    "WARMUP": False,  # 工作进程启动时是否预热连接
+    "WARMUP_CONNECTIONS": 2,  # 每个接入点预热的连接数
+    "ENDPOINTS": {},  # 按接入点覆盖，如 {"ep-xxx": {"MAX_CONNECTIONS": 50}}
+    # 模型的接入点池，如 {"doubao-seed-1-6-250615": ["ep-a", "ep-b"]}，
+    # 接入点的 BASE_URL / MODEL 在 ENDPOINTS 中配置
+    "POOLS": {},
+}
+
+# 同一模型多个接入点之间的负载均衡
+CHAT_BALANCER = {
+    "POLICY": "ewma",  # "ewma"（首token耗时）或 "least_outstanding"（进行中的请求数）
+    "FAILURE_THRESHOLD": 3,  # 连续失败多少次后暂时摘除接入点
+    "EJECT_SECONDS": 30,  # 摘除时间，单位秒
+    "MAX_ATTEMPTS": 2,  # 一次生成最多尝试的接入点数
+}
+
+# AI回复检查点：每累计多少个增量或间隔多少毫秒写回一次生成中的消息
+CHAT_CHECKPOINT_TOKENS = 64
+CHAT_CHECKPOINT_INTERVAL_MS = 1000
+
+# SSE 帧缓冲（断线续传），帧写入 default 缓存所在 Redis 的 Stream 中，
+# 客户端携带 Last-Event-ID 重连时补发错过的帧
+CHAT_STREAM_BUFFER = {
+    "ENABLED": True,
+    "TTL": 600,  # 缓冲过期时间，单位秒
+    "MAXLEN": 20000,  # 单条消息最多缓冲的帧数
+    "BLOCK_MS": 5000,  # 续传时阻塞等待新帧的时间，单位毫秒
+    "IDLE_TIMEOUT": 120,  # 续传时超过该时间无新帧则结束，单位秒
+    # 客户端断开后等待重连的宽限期，单位秒，超时则停止生成；为 0 时断开即停止，
+    # 大于 0 时启用断线后继续生成，主动停止需调用 stop 接口
+    "RESUME_GRACE": 0,
+}
+
+# AI回复生成方式："inline" 在请求内生成，"worker" 由后台工作进程生成
+# （python manage.py run_generation_worker），请求只订阅 SSE 帧缓冲并转发，
+# 需要启用 CHAT_STREAM_BUFFER；工作进程使用 BLMOVE / LMOVE，需要 Redis 6.2 及以上
+CHAT_GENERATION_MODE = "inline"
+
+# SSE 增量合并：时间窗口内的多个增量合并为一帧发送，减少帧数与系统调用
+# 客户端可通过 ai-response 请求的 coalesce_ms 参数指定窗口
+CHAT_SSE_COALESCE = {
+    "WINDOW_MS": 0,  # 默认时间窗口，单位毫秒，为 0 时逐个增量发送
+    "MAX_WINDOW_MS": 200,  # 客户端可请求的最大时间窗口，单位毫秒
+    "MAX_BYTES": 2048,  # 合并后的内容超过该字节数时立即发送
+}
+
+# SSE 帧的 JSON 序列化方式："json" 与原有输出逐字节一致（非 ASCII 字符转义）；
+# "orjson" 需要安装 orjson，非 ASCII 字符直接以 UTF-8 输出
+CHAT_SSE_JSON = "json"
+
+# SSE 流式响应压缩：按 Accept-Encoding 协商，整个流共用一个压缩器并逐帧 flush
+CHAT_SSE_COMPRESSION = {
+    "ENABLED": True,
+    "ENCODINGS": ["br", "gzip", "deflate"],  # 按优先级排列，br 需要安装 brotli
+    "ZLIB_LEVEL": 6,  # gzip / deflate 的压缩级别
+    "BROTLI_QUALITY": 5,  # brotli 的压缩质量
+}
+
+# 进程内模型目录的最长缓存时间，单位秒；模型变更时会通过 Redis 广播立即失效
+CHAT_MODEL_CATALOG_TTL = 300
+
+# 会话列表与消息历史的条件请求（ETag / Last-Modified），校验信息保存在 Redis 中，
+# 会话或消息变更时更新；客户端携带 If-None-Match 命中时直接返回 304
+CHAT_CONDITIONAL_GET = {
+    "ENABLED": True,
+    "TTL": 86400,  # 校验信息的过期时间，单位秒
+}
+
+# 会话消息历史的 Redis 读穿透缓存，消息与会话保存时写穿透；
+# 建议 Redis 使用 volatile-lru 淘汰策略
+CHAT_HISTORY_CACHE = {
+    "ENABLED": True,
+    "MAX_MESSAGES": 200,  # 单个会话最多缓存的消息数
+    "MAX_BYTES": 512 * 1024,  # 单个会话缓存的最大字节数
+    "TTL": 3600,  # 过期时间，单位秒，命中时刷新
+}
+
+# 多轮上下文：上一轮的 previous_response_id 不可用（生成未完成或超过上游保存时间）时，
+# 服务端沿分支组装历史消息，按模型的 context_budget 装入最近的消息
+CHAT_CONTEXT = {
+    "DEFAULT_BUDGET": 8000,  # 模型未配置 context_budget 时的token预算
+    "RESPONSE_TTL": 72 * 3600,  # 上游保存响应的时间，单位秒
+    "REASONING_TURNS": 0,  # 保留推理内容的最近AI回复数
+    "REASONING_MAX_TOKENS": 512,  # 每条推理内容最多保留的token数
+}
+
+# 无上下文首轮回复的精确匹配缓存，默认关闭
+CHAT_RESPONSE_CACHE = {
+    "ENABLED": False,
+    "TTL": 24 * 3600,  # 缓存时间，单位秒，应短于上游保存响应的时间
+    "MAX_PROMPT_CHARS": 2000,  # 可缓存的用户消息最大字符数
+    "MAX_BYTES": 64 * 1024,  # 单条缓存的最大字节数
+    "PACING_MS": 0,  # 回放时相邻增量的间隔，单位毫秒
+}
+
+# 上游并发控制：全局、每个推理接入点、每个用户同时进行的生成数，超出后公平排队
+CHAT_ADMISSION = {
+    "ENABLED": True,
+    "GLOBAL_LIMIT": 64,
+    "MODEL_LIMIT": 16,  # 每个推理接入点的并发数，可在 MODEL_LIMITS 中按接入点覆盖
+    "MODEL_LIMITS": {},
+    "USER_LIMIT": 2,
+    "QUEUE_LIMIT": 200,  # 排队的请求总数上限，超过后返回 429
+    "USER_QUEUE_LIMIT": 5,  # 每个用户排队的请求数上限
+    "QUEUE_TIMEOUT": 60,  # 最长排队时间，单位秒
+}
@@ -17,11 +17,20 @@ export const getMessageList = async (id: number) => {
 
 // 定义一个变量存储当前的AbortController，用于中断请求
 let abortController: AbortController | null = null;
+// 当前生成对应的用户消息ID，用于通知服务端停止生成
+let currentUserMessageId: number | null = null;
 // 中断当前请求的方法
 export const abortCurrentRequest = () => {
     if (abortController) {
         abortController.abort();
         abortController = null;
+        // 只中断请求时服务端可能仍在生成，通知服务端停止
+        if (currentUserMessageId !== null) {
+            api.post(chatPath(`/message/${currentUserMessageId}/stop/`)).catch(err => {
+                console.error("停止生成失败", err);
+            });
+            currentUserMessageId = null;
+        }
         // 清理临时消息
         // const chatStore = useChatStore();
         // chatStore.clearTempMessage();
@@ -44,6 +53,7 @@ export const sendMessage = async (data: CreateChatMessageRequest) => {
         const userMessageRes = await api.post(chatPath(`/message/`), data);
         chatStore.addMessage(userMessageRes.data);
         const user_message_id = userMessageRes.data.id;
+        currentUserMessageId = user_message_id;
 
         // 获取 AI 流式响应
         // 使用 fetch 发起 POST 请求并手动处理流式响应
@@ -52,6 +62,8 @@ export const sendMessage = async (data: CreateChatMessageRequest) => {
             body: JSON.stringify({...data, user_message_id}),
             headers: {
                 "Content-Type": "application/json",
+                // 使用精简的增量帧：{"c": 内容} / {"r": 思考内容}
+                Accept: "text/event-stream; format=compact",
                 Authorization: `Bearer ${localStorage.getItem("access_token")}`,
             },
             signal, // 将signal传递给fetch
@@ -83,14 +95,22 @@ export const sendMessage = async (data: CreateChatMessageRequest) => {
             const chunk = decoder.decode(value, {stream: true});
             const lines = chunk.split("\n\n");
 
-            for (const line of lines) {
-                if (line.startsWith("data:")) {
+            for (const event of lines) {
+                // 每个事件可能包含 "id:" 行，只解析 "data:" 行
+                const line = event.split("\n").find(field => field.startsWith("data:"));
+                if (line) {
                     const jsonStr = line.slice(5).trim(); // 去除 "data:" 前缀
                     try {
                         const data = JSON.parse(jsonStr);
                         const message = data.data;
+                        // 上游并发已满时排队，直到 message_start 前持续更新排队位置
+                        if (data.type === "queued") {
+                            chatStore.setQueuePosition(message.position);
+                            continue;
+                        }
                         // 获取初始化数据
                         if (data.type === "message_start") {
+                            chatStore.setQueuePosition(null);
                             finalMessage = {
                                 id: message.id,
                                 role: "assistant",
@@ -131,11 +151,17 @@ export const sendMessage = async (data: CreateChatMessageRequest) => {
                             chatStore.clearTempMessage();
                             // 清除控制器引用
                             abortController = null;
+                            currentUserMessageId = null;
                             return finalMessage;
                         }
 
-                        const reasoningContent = data.choices[0]?.delta?.reasoning_content || "";
-                        const content = data.choices[0]?.delta?.content || "";
+                        // token 统计帧无需更新临时消息
+                        if (data.u !== undefined) continue;
+
+                        // 兼容 OpenAI 风格的数据块与精简的增量帧
+                        const delta = data.choices ? data.choices[0]?.delta : {content: data.c, reasoning_content: data.r};
+                        const reasoningContent = delta?.reasoning_content || "";
+                        const content = delta?.content || "";
 
                         // 临时消息更新
                         chatStore.updateTempMessage(content, isFirstChunk, reasoningContent);
@@ -157,8 +183,10 @@ export const sendMessage = async (data: CreateChatMessageRequest) => {
             ElMessage.error("消息接收失败: " + (err instanceof Error ? err.message : "未知错误"));
         }
         chatStore.clearTempMessage();
+        chatStore.setQueuePosition(null);
         // 清除控制器引用
         abortController = null;
+        currentUserMessageId = null;
         throw err;
     }
 };
@@ -10,6 +10,8 @@ interface ChatState {
         reasoningContent: string;
         content: string;
     } | null;
+    // 等待上游并发名额时的排队位置，开始生成后为 null
+    queuePosition: number | null;
 }
 
 export const useChatStore = defineStore("chat", {
@@ -18,6 +20,7 @@ export const useChatStore = defineStore("chat", {
         activeSessionId: undefined,
         messageList: [],
         tempMessage: null,
+        queuePosition: null,
     }),
     actions: {
         // 会话
@@ -86,6 +89,11 @@ export const useChatStore = defineStore("chat", {
         clearTempMessage() {
             this.tempMessage = null;
         },
+
+        // 更新排队位置
+        setQueuePosition(position: number | null) {
+            this.queuePosition = position;
+        },
     },
     getters: {
         // 获取包括临时消息在内的完整消息列表